@@ -5,51 +5,208 @@ import seaborn as sns
 import os
 
 ARQUIVO_BD_SERVIDOR = "servidor_log.db"
+ARQUIVO_BD_CLIENTE = "client_log.db" # Opcional: se existir na pasta, as fases do lado do cliente também entram na análise
+STATUS_SUCESSO = 'SUCCESS_CHECKSUM_OK'
+TAMANHO_LOTE_LEITURA = 50000 # Linhas por lote lido do banco; a memória fica limitada a um lote por vez
+MAXIMO_PONTOS_GRAFICO = 20000 # Acima disso o gráfico de dispersão e os percentis usam uma amostra (filtrada no SQL)
+NUMERO_FAIXAS_HISTOGRAMA = 20
+DIAS_RESUMO_EXIBIDOS = 14
+PERCENTIS_LATENCIA = (0.5, 0.9, 0.99)
+MARGEM_MARCA_DAGUA_SEGUNDOS = 60 # O servidor carimba a linha antes de o gravador em lote fazer o commit: linhas até isto mais antigas que a marca ainda podem aparecer
+# Colunas de tempo por fase (ns, relógio monotônico) gravadas pelo servidor e pelo cliente
+COLUNAS_FASES_SERVIDOR = ("prepare_ns", "network_receive_ns", "disk_write_ns", "checksum_ns", "verify_ns", "data_transfer_ns")
+COLUNAS_FASES_CLIENTE = ("checksum_ns", "prepare_ns", "send_ns", "server_verify_ns")
+STATUS_SUCESSO_CLIENTE = 'SUCCESS_SENT_SERVER_OK'
 
-def carregar_dados_do_servidor(caminho_bd):
-
+def abrir_conexao_analise(caminho_bd):
     if not os.path.exists(caminho_bd):
         print(f"Erro: O arquivo de banco de dados '{caminho_bd}' não foi encontrado.")
         print("Certifique-se de que o servidor já foi executado e transferiu alguns arquivos.")
         return None
 
     try:
-        conexao_bd = sqlite3.connect(caminho_bd)
-        query_sql = "SELECT * FROM file_transfer_log"
-        
-        df = pd.read_sql_query(query_sql, conexao_bd)
-        
-        print(f"Dados carregados com sucesso de '{caminho_bd}'. {len(df)} registros encontrados.")
-        
-        conexao_bd.close()
-        return df
+        conexao_bd = sqlite3.connect(caminho_bd, timeout=30)
+        garantir_estrutura_analise(conexao_bd)
+        return conexao_bd
     except Exception as e:
-        print(f"Ocorreu um erro ao carregar os dados do banco de dados: {e}")
+        print(f"Ocorreu um erro ao abrir o banco de dados: {e}")
         return None
 
-def analisar_e_plotar(df):
-    if df is None or df.empty:
-        print("DataFrame vazio. Nenhuma análise a ser feita.")
+def garantir_estrutura_analise(conexao_bd):
+    # Índices que as consultas abaixo usam (bancos de servidores antigos não têm) e o resumo diário persistido.
+    # Resumo por (dia em que o arquivo apareceu, status): first_seen_timestamp não muda quando a linha é atualizada,
+    # então uma linha alterada só afeta o dia dela.
+    conexao_bd.execute("CREATE INDEX IF NOT EXISTS idx_file_transfer_log_status ON file_transfer_log(status)")
+    conexao_bd.execute("CREATE INDEX IF NOT EXISTS idx_file_transfer_log_first_seen ON file_transfer_log(first_seen_timestamp)")
+    conexao_bd.execute("CREATE INDEX IF NOT EXISTS idx_file_transfer_log_last_update ON file_transfer_log(last_update_timestamp)")
+    conexao_bd.execute('''
+    CREATE TABLE IF NOT EXISTS transfer_daily_rollup (
+        day TEXT NOT NULL,
+        status TEXT NOT NULL,
+        transfer_count INTEGER NOT NULL,
+        total_bytes INTEGER,
+        total_duration_seconds REAL,
+        speed_count INTEGER NOT NULL,
+        speed_sum_KBps REAL,
+        speed_min_KBps REAL,
+        speed_max_KBps REAL,
+        PRIMARY KEY (day, status)
+    )''')
+    conexao_bd.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_watermark (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    )''')
+    conexao_bd.commit()
+
+SQL_AGREGAR_RESUMO_DIARIO = '''
+    INSERT INTO transfer_daily_rollup
+    SELECT date(first_seen_timestamp), status, COUNT(*), SUM(total_file_size_bytes), SUM(final_duration_seconds),
+           COUNT(final_speed_KBps), SUM(final_speed_KBps), MIN(final_speed_KBps), MAX(final_speed_KBps)
+    FROM file_transfer_log {filtro}
+    GROUP BY date(first_seen_timestamp), status'''
+
+def atualizar_resumo_diario(conexao_bd):
+    # As linhas do log são atualizadas no lugar (retomadas, reenvios), então a marca d'água é o last_update_timestamp
+    # mais recente já processado: cada execução só recalcula os dias que têm linhas alteradas desde então. O carimbo é
+    # posto pela sessão e o commit vem depois, de várias sessões fora de ordem, por isso a busca recua uma margem.
+    cursor_bd = conexao_bd.cursor()
+    linha_marca = cursor_bd.execute("SELECT value FROM analytics_watermark WHERE name = 'file_transfer_log.last_update_timestamp'").fetchone()
+    marca_anterior = linha_marca[0] if linha_marca else None
+    marca_nova = cursor_bd.execute("SELECT MAX(last_update_timestamp) FROM file_transfer_log").fetchone()[0]
+    if marca_nova is None:
+        return 0
+
+    cursor_bd.execute("BEGIN")
+    if marca_anterior is None:
+        cursor_bd.execute("DELETE FROM transfer_daily_rollup")
+        cursor_bd.execute(SQL_AGREGAR_RESUMO_DIARIO.format(filtro=""))
+        dias_recalculados = cursor_bd.execute("SELECT COUNT(DISTINCT day) FROM transfer_daily_rollup").fetchone()[0]
+    else:
+        # Recalcular um dia a mais é inofensivo; o que não pode é pular uma linha commitada depois da leitura da marca
+        dias_alterados = [linha[0] for linha in cursor_bd.execute(
+            "SELECT DISTINCT date(first_seen_timestamp) FROM file_transfer_log WHERE last_update_timestamp >= datetime(?, ?)",
+            (marca_anterior, f"-{MARGEM_MARCA_DAGUA_SEGUNDOS} seconds"))]
+        for dia in dias_alterados:
+            cursor_bd.execute("DELETE FROM transfer_daily_rollup WHERE day IS ?", (dia,))
+            if dia is None:
+                cursor_bd.execute(SQL_AGREGAR_RESUMO_DIARIO.format(filtro="WHERE first_seen_timestamp IS NULL"))
+            else:
+                cursor_bd.execute(SQL_AGREGAR_RESUMO_DIARIO.format(filtro="WHERE first_seen_timestamp >= ? AND first_seen_timestamp < date(?, '+1 day')"), (dia, dia))
+        dias_recalculados = len(dias_alterados)
+    cursor_bd.execute("INSERT OR REPLACE INTO analytics_watermark (name, value) VALUES ('file_transfer_log.last_update_timestamp', ?)", (marca_nova,))
+    conexao_bd.commit()
+    return dias_recalculados
+
+def carregar_resumo_diario(conexao_bd):
+    return pd.read_sql_query("SELECT * FROM transfer_daily_rollup ORDER BY day, status", conexao_bd)
+
+def ler_sucessos_em_lotes(conexao_bd, colunas, filtro_extra="", parametros=()):
+    # Só as colunas pedidas e só as linhas de sucesso; o filtro roda no SQL, com o índice de status
+    query_sql = f"SELECT {', '.join(colunas)} FROM file_transfer_log WHERE status = ? {filtro_extra}"
+    return pd.read_sql_query(query_sql, conexao_bd, params=(STATUS_SUCESSO, *parametros), chunksize=TAMANHO_LOTE_LEITURA)
+
+def calcular_histograma_em_lotes(conexao_bd, coluna, minimo, maximo):
+    # Faixas fixas a partir do mínimo/máximo do resumo, somadas lote a lote
+    if minimo == maximo:
+        maximo = minimo + 1
+    bordas = [minimo + (maximo - minimo) * i / NUMERO_FAIXAS_HISTOGRAMA for i in range(NUMERO_FAIXAS_HISTOGRAMA + 1)]
+    contagens = pd.Series(0, index=range(NUMERO_FAIXAS_HISTOGRAMA))
+    for lote in ler_sucessos_em_lotes(conexao_bd, [coluna], f"AND {coluna} IS NOT NULL"):
+        faixas = pd.cut(lote[coluna], bins=bordas, labels=False, include_lowest=True)
+        contagens = contagens.add(faixas.value_counts(), fill_value=0)
+    return bordas, contagens.astype(int)
+
+def carregar_amostra_sucessos(conexao_bd, total_sucessos):
+    # Amostra sistemática pelo id, filtrada no próprio SQL para não trazer a tabela inteira
+    passo = max(1, -(-total_sucessos // MAXIMO_PONTOS_GRAFICO))
+    colunas = ['total_file_size_bytes', 'final_duration_seconds', 'final_speed_KBps']
+    lotes = list(ler_sucessos_em_lotes(conexao_bd, colunas, "AND id % ? = 0", (passo,)))
+    amostra = pd.concat(lotes, ignore_index=True) if lotes else pd.DataFrame(columns=colunas)
+    return amostra, passo
+
+def carregar_tempos_fases(conexao_bd, tabela, coluna_status, status, colunas_fases):
+    # Mesma amostragem por id das velocidades; bancos antigos podem não ter todas as colunas de fase
+    colunas_tabela = {linha[1] for linha in conexao_bd.execute(f"PRAGMA table_info({tabela})")}
+    colunas = [coluna for coluna in colunas_fases if coluna in colunas_tabela]
+    if not colunas:
+        return None, 1
+    total_linhas = conexao_bd.execute(f"SELECT COUNT(*) FROM {tabela} WHERE {coluna_status} = ?", (status,)).fetchone()[0]
+    passo = max(1, -(-total_linhas // MAXIMO_PONTOS_GRAFICO))
+    query_sql = f"SELECT {', '.join(colunas)} FROM {tabela} WHERE {coluna_status} = ? AND id % ? = 0"
+    lotes = list(pd.read_sql_query(query_sql, conexao_bd, params=(status, passo), chunksize=TAMANHO_LOTE_LEITURA))
+    amostra = pd.concat(lotes, ignore_index=True) if lotes else pd.DataFrame(columns=colunas)
+    return amostra, passo
+
+def calcular_percentis_fases(amostra):
+    # Percentis em ms por fase; cada fase ignora as linhas em que não foi medida (NULL)
+    linhas = {}
+    for coluna in amostra.columns:
+        tempos_ms = pd.to_numeric(amostra[coluna], errors='coerce').dropna() / 1e6
+        if tempos_ms.empty:
+            continue
+        linhas[coluna.removesuffix('_ns')] = {'medicoes': len(tempos_ms), **{f"p{round(p * 100)}_ms": tempos_ms.quantile(p) for p in PERCENTIS_LATENCIA},
+                                             'max_ms': tempos_ms.max()}
+    return pd.DataFrame.from_dict(linhas, orient='index')
+
+def exibir_percentis_fases(titulo, amostra, passo):
+    print(f"\n--- Latência por Fase: {titulo} (ms) ---")
+    percentis = calcular_percentis_fases(amostra) if amostra is not None else pd.DataFrame()
+    if percentis.empty:
+        print("Nenhum tempo por fase registrado (transferências anteriores à medição por fase).")
+        return percentis
+    if passo > 1:
+        print(f"Percentis calculados sobre uma amostra (1 a cada {passo} arquivos).")
+    print(percentis.round(3))
+    return percentis
+
+def analisar_e_plotar(conexao_bd, conexao_bd_cliente=None):
+    dias_recalculados = atualizar_resumo_diario(conexao_bd)
+    resumo = carregar_resumo_diario(conexao_bd)
+    if resumo.empty:
+        print("Nenhuma transferência registrada. Nenhuma análise a ser feita.")
         return
+    print(f"Resumo diário atualizado ({dias_recalculados} dia(s) recalculado(s)). {int(resumo['transfer_count'].sum())} registros no total.")
 
-    df['first_seen_timestamp'] = pd.to_datetime(df['first_seen_timestamp'])
-    
-    df['tamanho_total_kb'] = df['total_file_size_bytes'] / 1024
-    
+    contagem_status = resumo.groupby('status')['transfer_count'].sum().sort_values(ascending=False)
+    resumo_sucesso = resumo[resumo['status'] == STATUS_SUCESSO]
+    total_sucessos = int(resumo_sucesso['transfer_count'].sum())
+
+    print("\n--- Transferências por Dia (últimos dias) ---")
+    por_dia = resumo.pivot_table(index='day', columns='status', values='transfer_count', aggfunc='sum', fill_value=0)
+    print(por_dia.tail(DIAS_RESUMO_EXIBIDOS))
 
-    df_sucesso = df[df['status'] == 'SUCCESS_CHECKSUM_OK'].copy()
-    
     print("\n--- Análise Descritiva dos Arquivos Transferidos com Sucesso ---")
-    if not df_sucesso.empty:
-        estatisticas = df_sucesso[['tamanho_total_kb', 'final_duration_seconds', 'final_speed_KBps']].describe()
+    amostra = None
+    if total_sucessos:
+        # Contagem, soma, mínimo e máximo saem exatos do resumo; os percentis vêm da amostra quando a tabela é grande
+        amostra, passo = carregar_amostra_sucessos(conexao_bd, total_sucessos)
+        amostra['tamanho_total_kb'] = amostra['total_file_size_bytes'] / 1024
+        contagem_velocidades = resumo_sucesso['speed_count'].sum()
+        print(f"Arquivos: {total_sucessos}, total: {resumo_sucesso['total_bytes'].sum() / 1024:.1f} KB, duração total: {resumo_sucesso['total_duration_seconds'].sum():.2f} s")
+        if contagem_velocidades:
+            print(f"Velocidade (KB/s): média {resumo_sucesso['speed_sum_KBps'].sum() / contagem_velocidades:.2f}, "
+                  f"mín {resumo_sucesso['speed_min_KBps'].min():.2f}, máx {resumo_sucesso['speed_max_KBps'].max():.2f}")
+        if passo > 1:
+            print(f"Percentis calculados sobre uma amostra de {len(amostra)} arquivos (1 a cada {passo}).")
+        estatisticas = amostra[['tamanho_total_kb', 'final_duration_seconds', 'final_speed_KBps']].describe()
         print(estatisticas)
     else:
         print("Nenhum arquivo transferido com sucesso encontrado para análise de performance.")
 
+    percentis_por_lado = {}
+    if total_sucessos:
+        amostra_fases, passo_fases = carregar_tempos_fases(conexao_bd, 'file_transfer_log', 'status', STATUS_SUCESSO, COLUNAS_FASES_SERVIDOR)
+        percentis_por_lado['servidor'] = exibir_percentis_fases("Servidor", amostra_fases, passo_fases)
+    if conexao_bd_cliente is not None:
+        amostra_fases, passo_fases = carregar_tempos_fases(conexao_bd_cliente, 'client_file_send_log', 'client_send_status',
+                                                           STATUS_SUCESSO_CLIENTE, COLUNAS_FASES_CLIENTE)
+        percentis_por_lado['cliente'] = exibir_percentis_fases("Cliente", amostra_fases, passo_fases)
+
     sns.set_theme(style="whitegrid")
 
     plt.figure(figsize=(12, 7))
-    sns.countplot(data=df, y='status', order=df['status'].value_counts().index, palette="viridis")
+    sns.barplot(x=contagem_status.values, y=contagem_status.index, hue=contagem_status.index, palette="viridis", legend=False)
     plt.title('Contagem de Status de Todas as Transferências de Arquivos', fontsize=16)
     plt.xlabel('Contagem (Nº de Tentativas)', fontsize=12)
     plt.ylabel('Status Final', fontsize=12)
@@ -58,11 +215,26 @@ def analisar_e_plotar(df):
     print("\nGráfico 'grafico_status_transferencias.png' salvo.")
     plt.show()
 
-    if df_sucesso.empty:
+    percentis_por_lado = {lado: percentis for lado, percentis in percentis_por_lado.items() if not percentis.empty}
+    if percentis_por_lado:
+        colunas_percentis = [f"p{round(p * 100)}_ms" for p in PERCENTIS_LATENCIA]
+        tabela_grafico = pd.concat([percentis[colunas_percentis].rename(index=lambda fase: f"{lado}: {fase}")
+                                    for lado, percentis in percentis_por_lado.items()])
+        tabela_grafico.plot.barh(figsize=(12, 7))
+        plt.title('Latência por Fase da Transferência (Percentis)', fontsize=16)
+        plt.xlabel('Tempo (ms)', fontsize=12)
+        plt.ylabel('Fase', fontsize=12)
+        plt.xscale('log')
+        plt.tight_layout()
+        plt.savefig('grafico_latencia_fases.png')
+        print("Gráfico 'grafico_latencia_fases.png' salvo.")
+        plt.show()
+
+    if not total_sucessos:
         return
-    
+
     plt.figure(figsize=(10, 6))
-    sns.scatterplot(data=df_sucesso, x='tamanho_total_kb', y='final_speed_KBps', alpha=0.7)
+    sns.scatterplot(data=amostra, x='tamanho_total_kb', y='final_speed_KBps', alpha=0.7)
     plt.title('Velocidade de Transferência vs. Tamanho do Arquivo', fontsize=16)
     plt.xlabel('Tamanho do Arquivo (KB)', fontsize=12)
     plt.ylabel('Velocidade Média (KB/s)', fontsize=12)
@@ -71,8 +243,12 @@ def analisar_e_plotar(df):
     print("Gráfico 'grafico_velocidade_vs_tamanho.png' salvo.")
     plt.show()
 
+    if not resumo_sucesso['speed_count'].sum():
+        return
+
+    bordas, contagens = calcular_histograma_em_lotes(conexao_bd, 'final_speed_KBps', resumo_sucesso['speed_min_KBps'].min(), resumo_sucesso['speed_max_KBps'].max())
     plt.figure(figsize=(10, 6))
-    sns.histplot(data=df_sucesso, x='final_speed_KBps', bins=20, kde=True)
+    plt.bar(bordas[:-1], contagens.values, width=[bordas[i + 1] - bordas[i] for i in range(len(bordas) - 1)], align='edge', edgecolor='white')
     plt.title('Distribuição das Velocidades de Transferência (Arquivos com Sucesso)', fontsize=16)
     plt.xlabel('Velocidade (KB/s)', fontsize=12)
     plt.ylabel('Frequência (Nº de Arquivos)', fontsize=12)
@@ -82,8 +258,16 @@ def analisar_e_plotar(df):
 
 def main():
     print("Iniciando script de análise de logs de transferência...")
-    dataframe_logs = carregar_dados_do_servidor(ARQUIVO_BD_SERVIDOR)
-    analisar_e_plotar(dataframe_logs)
+    conexao_bd = abrir_conexao_analise(ARQUIVO_BD_SERVIDOR)
+    if conexao_bd is None:
+        return
+    conexao_bd_cliente = sqlite3.connect(ARQUIVO_BD_CLIENTE, timeout=30) if os.path.exists(ARQUIVO_BD_CLIENTE) else None
+    try:
+        analisar_e_plotar(conexao_bd, conexao_bd_cliente)
+    finally:
+        conexao_bd.close()
+        if conexao_bd_cliente is not None:
+            conexao_bd_cliente.close()
     print("\nAnálise concluída.")
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import shutil
+import filecmp
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import sqlite3
+import urllib.request
+
+# Benchmark de ponta a ponta: cada cenário sobe um servidor novo em localhost numa pasta temporária, gera uma árvore
+# sintética determinística (mesma semente = mesmos bytes), roda o cliente sem interação e mede vazão, arquivos/s,
+# CPU e pico de memória dos dois processos. A saída é JSON com o commit, para comparar execuções entre commits.
+PASTA_REPOSITORIO = os.path.dirname(os.path.abspath(__file__))
+SEMENTE_PADRAO = 1234
+REPETICOES_PADRAO = 3
+TIMEOUT_INICIO_SERVIDOR_SEGUNDOS = 15
+TIMEOUT_EXECUCAO_SEGUNDOS = 1800
+INTERVALO_SONDAGEM_SEGUNDOS = 0.02
+FRACAO_ANTES_DA_QUEDA = 0.4 # No cenário de retomada, o cliente é morto depois que o servidor recebeu esta fração do arquivo
+DURACAO_ENVIO_ANTES_DA_QUEDA_SEGUNDOS = 5 # O cliente que será morto envia limitado a ponto de o arquivo levar isto, para a queda cair no meio dele
+CENARIOS = ("arquivos_pequenos", "arquivos_grandes", "diretorios_profundos", "retomada_apos_queda")
+
+# O servidor é configurado pelas constantes, como o restante do projeto: o processo filho só troca as portas
+CODIGO_SERVIDOR = "import sys, servidor; servidor.PORTA_SERVIDOR = int(sys.argv[1]); servidor.PORTA_METRICAS = int(sys.argv[2]); servidor.main()"
+CODIGO_CLIENTE = "import sys, cliente; sys.exit(cliente.main(['--porta', sys.argv[1], *sys.argv[3:], sys.argv[2]]))"
+# O ru_maxrss de wait4 (e de getrusage) herda o pico do processo do benchmark através do fork+exec, e este guarda as
+# árvores geradas. Por isso cada filho grava ao sair o próprio VmHWM, que o exec zera, num arquivo indicado pelo ambiente.
+CODIGO_REGISTRO_PICO_MEMORIA = """import atexit, os
+def _gravar_pico_memoria(caminho=os.environ['BENCH_ARQUIVO_PICO_RSS']):
+    with open('/proc/self/status') as status:
+        pico_kb = next(int(linha.split()[1]) for linha in status if linha.startswith('VmHWM:'))
+    with open(caminho, 'w') as arquivo:
+        arquivo.write(str(pico_kb))
+atexit.register(_gravar_pico_memoria)
+"""
+
+def escrever_arquivo(caminho_arquivo, tamanho, gerador, texto=False):
+    os.makedirs(os.path.dirname(caminho_arquivo), exist_ok=True)
+    with open(caminho_arquivo, 'wb') as arquivo:
+        restante = tamanho
+        while restante > 0:
+            bloco = min(restante, 8 * 1024 * 1024)
+            if texto:
+                linha = f"registro {gerador.randrange(10 ** 9)} valor {gerador.random():.6f}\n".encode()
+                arquivo.write((linha * (bloco // len(linha) + 1))[:bloco])
+            else:
+                arquivo.write(gerador.randbytes(bloco))
+            restante -= bloco
+
+def gerar_arvore(cenario, pasta_destino, escala, semente):
+    # Retorna (nº de arquivos, bytes totais); os tamanhos escalam com --escala para rodadas rápidas em CI
+    gerador = random.Random(f"{semente}-{cenario}")
+    arquivos = []
+    if cenario == "arquivos_pequenos":
+        for i in range(max(1, int(5000 * escala))):
+            arquivos.append((os.path.join(f"d{i % 50:02d}", f"p{i:05d}.txt"), gerador.randint(0, 4096), True))
+    elif cenario == "arquivos_grandes":
+        for i in range(3):
+            arquivos.append((f"g{i}.bin", int(256 * 1024 * 1024 * escala), False))
+    elif cenario == "diretorios_profundos":
+        for nivel in range(max(1, int(40 * escala))):
+            caminho_nivel = os.path.join(*[f"n{profundidade:02d}" for profundidade in range(nivel + 1)])
+            for i in range(10):
+                arquivos.append((os.path.join(caminho_nivel, f"a{i}.dat"), gerador.randint(1024, 256 * 1024), i % 2 == 0))
+    elif cenario == "retomada_apos_queda":
+        arquivos.append(("retomada.bin", int(512 * 1024 * 1024 * escala), False))
+    for caminho_relativo, tamanho, texto in arquivos:
+        escrever_arquivo(os.path.join(pasta_destino, caminho_relativo), tamanho, gerador, texto)
+    return len(arquivos), sum(tamanho for _, tamanho, _ in arquivos)
+
+def porta_livre():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def esperar_porta(porta, timeout):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            socket.create_connection(('127.0.0.1', porta), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def iniciar_processo(codigo, argumentos, pasta_trabalho):
+    descritor, arquivo_pico_rss = tempfile.mkstemp(prefix="pico_rss_", dir=pasta_trabalho)
+    os.close(descritor)
+    ambiente = dict(os.environ, PYTHONPATH=PASTA_REPOSITORIO + os.pathsep + os.environ.get("PYTHONPATH", ""), BENCH_ARQUIVO_PICO_RSS=arquivo_pico_rss)
+    processo = subprocess.Popen([sys.executable, "-c", CODIGO_REGISTRO_PICO_MEMORIA + codigo, *map(str, argumentos)], cwd=pasta_trabalho, env=ambiente,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    processo.arquivo_pico_rss = arquivo_pico_rss
+    return processo
+
+def ler_pico_rss_kb(processo):
+    # None se o filho não saiu normalmente (ex.: morto com SIGKILL no cenário de retomada)
+    try:
+        with open(processo.arquivo_pico_rss, 'r') as arquivo:
+            return int(arquivo.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            os.remove(processo.arquivo_pico_rss)
+        except OSError:
+            pass
+
+def aguardar_processo(processo, timeout=TIMEOUT_EXECUCAO_SEGUNDOS):
+    # wait4 devolve o tempo de CPU só deste filho (e dos netos que ele esperou, como o pool de checksums)
+    limite = time.monotonic() + timeout
+    while True:
+        pid, status, uso = os.wait4(processo.pid, os.WNOHANG)
+        if pid:
+            processo.returncode = os.waitstatus_to_exitcode(status)
+            return {"cpu_usuario_s": uso.ru_utime, "cpu_sistema_s": uso.ru_stime, "pico_rss_kb": ler_pico_rss_kb(processo), "codigo_saida": processo.returncode}
+        if time.monotonic() > limite:
+            processo.kill()
+            limite = float('inf')
+        time.sleep(INTERVALO_SONDAGEM_SEGUNDOS)
+
+def bytes_recebidos_servidor(porta_metricas):
+    with urllib.request.urlopen(f"http://127.0.0.1:{porta_metricas}/metrics.json", timeout=5) as resposta:
+        metricas = json.load(resposta)["metrics"]
+    return metricas["file_server_received_bytes_total"]["samples"][0]["value"]
+
+def comparar_arvores(origem, destino):
+    for raiz, _, nomes in os.walk(origem):
+        for nome in nomes:
+            caminho_origem = os.path.join(raiz, nome)
+            caminho_destino = os.path.join(destino, os.path.relpath(caminho_origem, origem))
+            if not os.path.isfile(caminho_destino) or not filecmp.cmp(caminho_origem, caminho_destino, shallow=False):
+                return False
+    return True
+
+def esperar_pausa_no_servidor(pasta_servidor, timeout=10):
+    # Depois de matar o cliente, a retomada só é justa quando o servidor já gravou o offset da sessão interrompida
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            conexao = sqlite3.connect(os.path.join(pasta_servidor, "servidor_log.db"), timeout=5)
+            try:
+                if not conexao.execute("SELECT COUNT(*) FROM file_transfer_log WHERE status IN ('RECEIVING', 'AWAITING_DATA')").fetchone()[0]:
+                    return
+            finally:
+                conexao.close()
+        except sqlite3.Error:
+            pass
+        time.sleep(0.1)
+
+def executar_cenario(cenario, pasta_origem, numero_arquivos, total_bytes):
+    pasta_execucao = tempfile.mkdtemp(prefix=f"bench_{cenario}_")
+    pasta_servidor, pasta_cliente = os.path.join(pasta_execucao, "servidor"), os.path.join(pasta_execucao, "cliente")
+    os.makedirs(pasta_servidor)
+    os.makedirs(pasta_cliente)
+    porta, porta_metricas = porta_livre(), porta_livre()
+    servidor = iniciar_processo(CODIGO_SERVIDOR, (porta, porta_metricas), pasta_servidor)
+    resultado = {}
+    try:
+        if not esperar_porta(porta, TIMEOUT_INICIO_SERVIDOR_SEGUNDOS):
+            raise RuntimeError("servidor não abriu a porta")
+        if cenario == "retomada_apos_queda":
+            limite_kbps = max(1, total_bytes / 1024 / DURACAO_ENVIO_ANTES_DA_QUEDA_SEGUNDOS)
+            cliente = iniciar_processo(CODIGO_CLIENTE, (porta, pasta_origem, "--limite-kbps", limite_kbps), pasta_cliente)
+            while cliente.poll() is None and bytes_recebidos_servidor(porta_metricas) < total_bytes * FRACAO_ANTES_DA_QUEDA:
+                time.sleep(INTERVALO_SONDAGEM_SEGUNDOS)
+            cliente.send_signal(signal.SIGKILL)
+            uso_cliente_derrubado = aguardar_processo(cliente)
+            esperar_pausa_no_servidor(pasta_servidor)
+            resultado["bytes_antes_da_queda"] = bytes_recebidos_servidor(porta_metricas)
+            # Só houve retomada se o SIGKILL pegou o cliente ainda vivo e com parte do arquivo por enviar
+            resultado["retomada_valida"] = uso_cliente_derrubado["codigo_saida"] == -signal.SIGKILL and resultado["bytes_antes_da_queda"] < total_bytes
+
+        bytes_antes = bytes_recebidos_servidor(porta_metricas)
+        inicio = time.perf_counter()
+        cliente = iniciar_processo(CODIGO_CLIENTE, (porta, pasta_origem), pasta_cliente)
+        uso_cliente = aguardar_processo(cliente)
+        duracao = time.perf_counter() - inicio
+        bytes_na_rede = bytes_recebidos_servidor(porta_metricas) - bytes_antes
+    finally:
+        servidor.send_signal(signal.SIGTERM) # Mesmo caminho do Ctrl+C: o gravador do BD descarrega antes de sair
+        uso_servidor = aguardar_processo(servidor, timeout=60)
+
+    resultado.update({
+        "duracao_s": duracao,
+        "mb_por_s": total_bytes / (1024 * 1024) / duracao,
+        "arquivos_por_s": numero_arquivos / duracao,
+        "mb_por_s_rede": bytes_na_rede / (1024 * 1024) / duracao, # Na retomada, só o que faltava atravessa a rede
+        "bytes_recebidos_rede": bytes_na_rede,
+        "cliente": uso_cliente,
+        "servidor": uso_servidor,
+        "verificado": uso_cliente["codigo_saida"] == 0 and resultado.get("retomada_valida", True)
+                      and comparar_arvores(pasta_origem, os.path.join(pasta_servidor, "uploads_servidor", os.path.basename(pasta_origem))),
+    })
+    shutil.rmtree(pasta_execucao, ignore_errors=True)
+    return resultado
+
+def resumir_execucoes(execucoes):
+    chaves = ("duracao_s", "mb_por_s", "mb_por_s_rede", "arquivos_por_s")
+    resumo = {f"{chave}_mediana": statistics.median(execucao[chave] for execucao in execucoes) for chave in chaves}
+    for lado in ("cliente", "servidor"):
+        resumo[f"{lado}_cpu_s_mediana"] = statistics.median(execucao[lado]["cpu_usuario_s"] + execucao[lado]["cpu_sistema_s"] for execucao in execucoes)
+        resumo[f"{lado}_pico_rss_kb_max"] = max((execucao[lado]["pico_rss_kb"] for execucao in execucoes if execucao[lado]["pico_rss_kb"] is not None), default=None)
+    resumo["verificado"] = all(execucao["verificado"] for execucao in execucoes)
+    return resumo
+
+def informacoes_ambiente():
+    def git(*argumentos):
+        try:
+            return subprocess.run(["git", *argumentos], cwd=PASTA_REPOSITORIO, capture_output=True, text=True, timeout=60).stdout.strip()
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "arvore_alterada": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def comparar_com_anterior(resultados, caminho_anterior):
+    with open(caminho_anterior, 'r', encoding='utf-8') as arquivo:
+        anterior = json.load(arquivo)
+    print(f"Comparação com {anterior['ambiente'].get('commit')} (MB/s, mediana):", file=sys.stderr)
+    for cenario, dados in resultados["cenarios"].items():
+        dados_anteriores = anterior["cenarios"].get(cenario)
+        if not dados_anteriores or dados_anteriores["parametros"] != dados["parametros"]:
+            print(f"  {cenario}: sem base comparável", file=sys.stderr)
+            continue
+        atual, base = dados["resumo"]["mb_por_s_mediana"], dados_anteriores["resumo"]["mb_por_s_mediana"]
+        print(f"  {cenario}: {base:.1f} -> {atual:.1f} ({(atual / base - 1) * 100:+.1f}%)", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ponta a ponta do envio de pastas (cliente.py -> servidor.py).")
+    parser.add_argument("--cenarios", nargs="+", choices=CENARIOS, default=list(CENARIOS))
+    parser.add_argument("--repeticoes", type=int, default=REPETICOES_PADRAO)
+    parser.add_argument("--escala", type=float, default=1.0, help="Multiplica nº e tamanho dos arquivos (ex.: 0.05 para uma rodada rápida)")
+    parser.add_argument("--semente", type=int, default=SEMENTE_PADRAO)
+    parser.add_argument("--saida", help="Grava o JSON neste arquivo além de imprimir")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior para comparar a vazão")
+    argumentos = parser.parse_args()
+
+    resultados = {"ambiente": informacoes_ambiente(), "cenarios": {}}
+    pasta_dados = tempfile.mkdtemp(prefix="bench_dados_")
+    try:
+        for cenario in argumentos.cenarios:
+            pasta_origem = os.path.join(pasta_dados, cenario)
+            numero_arquivos, total_bytes = gerar_arvore(cenario, pasta_origem, argumentos.escala, argumentos.semente)
+            execucoes = []
+            for repeticao in range(argumentos.repeticoes):
+                print(f"{cenario}: execução {repeticao + 1}/{argumentos.repeticoes} ({numero_arquivos} arquivos, {total_bytes} bytes)", file=sys.stderr)
+                execucoes.append(executar_cenario(cenario, pasta_origem, numero_arquivos, total_bytes))
+            resultados["cenarios"][cenario] = {
+                "parametros": {"arquivos": numero_arquivos, "bytes": total_bytes, "escala": argumentos.escala, "semente": argumentos.semente},
+                "resumo": resumir_execucoes(execucoes),
+                "execucoes": execucoes,
+            }
+    finally:
+        shutil.rmtree(pasta_dados, ignore_errors=True)
+
+    saida_json = json.dumps(resultados, indent=2, ensure_ascii=False)
+    print(saida_json)
+    if argumentos.saida:
+        with open(argumentos.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(saida_json + "\n")
+    if argumentos.comparar:
+        comparar_com_anterior(resultados, argumentos.comparar)
+    if not all(dados["resumo"]["verificado"] for dados in resultados["cenarios"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
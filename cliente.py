@@ -3,14 +3,82 @@ import os
 import logging
 import time
 import hashlib
+import sys
+import json
 import sqlite3
+import struct
+import threading
+import queue
+import uuid
+import mmap
+import stat
+import multiprocessing
+import concurrent.futures
+import zlib
+import lzma
+import argparse
+from collections import deque
+try:
+    import zstandard
+except ImportError: # Opcional: sem ele a compressão fica só com zlib/lzma
+    zstandard = None
 
 ENDERECO_IP_SERVIDOR = '127.0.0.1'
 PORTA_SERVIDOR = 65432
 TAMANHO_BUFFER = 4096
+VERSOES_PROTOCOLO_SUPORTADAS = (1,)
+ESTRUTURA_CABECALHO_QUADRO = struct.Struct('!BI')
+TAMANHO_MAXIMO_QUADRO = 16 * 1024 * 1024
+TIMEOUT_NEGOCIACAO_SEGUNDOS = 3
+TAMANHO_LOTE_MANIFESTO = 256
+USAR_SENDFILE = True
+TAMANHO_FATIA_SENDFILE = 8 * 1024 * 1024
+LIMITE_ENVIO_KBPS = 0 # Limite de envio em KB/s somando todas as conexões (0 = sem limite)
+TAMANHO_FATIA_LIMITADA = 64 * 1024 # Com limite ativo os dados saem em fatias menores, para o ritmo ficar uniforme
+RAJADA_MAXIMA_BANDA_SEGUNDOS = 0.5 # Folga que o balde ocioso acumula para gastar de uma vez
+MODO_CHECKSUM_TRAILER = True # No protocolo de quadros, o checksum vai depois dos dados e é calculado durante o envio
+TAMANHO_AMOSTRA_IMPRESSAO = 64 * 1024
+TAMANHO_BLOCO_LEITURA = 1024 * 1024
+USAR_MMAP = True
+LIMIAR_ARQUIVO_MMAP = 64 * 1024 * 1024 # A partir deste tamanho, hash e envio leem fatias de um mmap em vez de copiar para buffers
+TAMANHO_FATIA_MMAP = 8 * 1024 * 1024
+NUMERO_CONEXOES_PARALELAS = 4 # Conexões simultâneas por pasta no protocolo de quadros (1 = uma única conexão)
+MAXIMO_BYTES_LOTE_PARALELO = 64 * 1024 * 1024
+LIMIAR_ARQUIVO_EM_PEDACOS = 1024 * 1024 * 1024 # Arquivos a partir deste tamanho vão em pedaços pelas conexões paralelas
+TAMANHO_PEDACO = 64 * 1024 * 1024
+USAR_TRANSFERENCIA_DELTA = True # Arquivos alterados que o servidor já tem são enviados como literais + cópias de blocos
+MODULO_ADLER = 65521
+USAR_COMPRESSAO = True
+CODECS_COMPRESSAO_PREFERIDOS = ("zstd", "zlib", "lzma") # Ordem de preferência; o servidor responde com os que suporta
+NIVEL_COMPRESSAO_ZLIB = 6
+NIVEL_COMPRESSAO_LZMA = 1
+NIVEL_COMPRESSAO_ZSTD = 3
+TAMANHO_MINIMO_COMPRESSAO = 4096
+TAMANHO_AMOSTRA_COMPRESSAO = 64 * 1024
+RAZAO_MAXIMA_COMPRESSAO = 0.9 # Amostra que não cai abaixo desta fração do tamanho original vai sem compressão
+EXTENSOES_JA_COMPRIMIDAS = {'.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.br', '.zip', '.7z', '.rar', '.jar', '.apk',
+                            '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.ogg', '.flac', '.mp4', '.mkv', '.mov', '.avi', '.webm',
+                            '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods'}
+MAXIMO_BLOCOS_BUSCA_DELTA = 16 # Blocos literais após o último bloco reaproveitado em que ainda se procura um bloco deslocado
+TIMEOUT_BD_SEGUNDOS = 30
+MAXIMO_ESCRITAS_LOTE_BD = 500 # Escritas acumuladas antes de um commit
+INTERVALO_MAXIMO_LOTE_BD_SEGUNDOS = 0.5
+DIAS_RETENCAO_CACHE_CHECKSUM = 30 # Entradas do cache de checksums não usadas nesse período são removidas
 ARQUIVO_LOG_CLIENTE_TEXTO = "cliente.log"
 ARQUIVO_BD_CLIENTE = "client_log.db"
-ALGORITMO_CHECKSUM_PADRAO = 'md5'
+MAXIMO_TENTATIVAS_TAREFA = 3 # Pastas da fila que falham por erro de conexão voltam para a fila até este nº de tentativas
+ALGORITMO_CHECKSUM_PADRAO = 'md5' # Protocolo texto legado ou servidor sem negociação de checksum
+ALGORITMOS_CHECKSUM_PREFERIDOS = ("sha256", "blake2b", "md5") # sha256 usa a aceleração do OpenSSL (SHA-NI/ARMv8); "crc32" só detecta corrupção acidental
+ALGORITMOS_CHECKSUM_BENCHMARK = ("sha256", "blake2b", "blake2s", "sha1", "sha512", "md5", "crc32")
+TAMANHO_BENCHMARK_CHECKSUM = 256 * 1024 * 1024
+NUMERO_PROCESSOS_CHECKSUM = os.cpu_count() or 1 # Processos que calculam checksums na pré-varredura (1 = só a thread de varredura)
+MAXIMO_ENTRADAS_PRE_VARREDURA = 4096 # Entradas prontas aguardando o envio; limita a memória e quanto a varredura se adianta
+MAXIMO_ARQUIVOS_TAREFA_CHECKSUM = 64 # Arquivos pequenos vão juntos numa tarefa do pool para diluir o custo de IPC
+MAXIMO_BYTES_TAREFA_CHECKSUM = 32 * 1024 * 1024
+# Fases de cada envio em ns (perf_counter_ns); cada nome é também a coluna de client_file_send_log.
+# checksum: quanto o envio esperou pelo checksum (cache, cálculo ou pool); no modo trailer o hash corre junto com o envio
+# prepare: ida e volta da preparação (num lote, a parte de cada arquivo); server_verify: do fim dos dados ao status final
+COLUNAS_TEMPOS_FASES = ("checksum_ns", "prepare_ns", "send_ns", "server_verify_ns")
 
 def configurar_logger_texto(nome_logger, arquivo_log, nivel=logging.INFO):
     formatador = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,9 +96,227 @@ def configurar_logger_texto(nome_logger, arquivo_log, nivel=logging.INFO):
 logger_texto = configurar_logger_texto('LoggerClienteTexto_Fase6', ARQUIVO_LOG_CLIENTE_TEXTO)
 
 conexao_bd_cliente_global = None
+id_cliente_global = None
+gravador_bd_cliente_global = None
+algoritmo_checksum_global = ALGORITMO_CHECKSUM_PADRAO
+
+# Protocolo de quadros (v1): cada mensagem de comando vai como [versão: 1 byte][tamanho: 4 bytes big-endian][payload UTF-8].
+# Os dados dos arquivos continuam indo como bytes brutos logo após o ACK, pois o tamanho já é conhecido pelos dois lados.
+# Sem negociação (clientes antigos) o canal continua no protocolo texto, onde cada recv() é tratado como um comando.
+class ErroProtocolo(Exception):
+    pass
+
+class BaldeTokens:
+    # Token bucket com débito: reservar() desconta os bytes na hora e devolve quanto esperar até o saldo voltar a zero,
+    # então várias threads dividem a mesma taxa sem dormir segurando a trava. A taxa (bytes/s, 0 = sem limite) vem de
+    # uma função, para que um limite alterado valha já no próximo bloco.
+    def __init__(self, obter_taxa):
+        self.obter_taxa = obter_taxa
+        self.trava = threading.Lock()
+        self.saldo = 0.0
+        self.ultima_reposicao = time.monotonic()
+
+    def reservar(self, quantidade):
+        taxa = self.obter_taxa()
+        with self.trava:
+            agora = time.monotonic()
+            if not taxa:
+                self.saldo, self.ultima_reposicao = 0.0, agora
+                return 0
+            self.saldo = min(taxa * RAJADA_MAXIMA_BANDA_SEGUNDOS, self.saldo + (agora - self.ultima_reposicao) * taxa) - quantidade
+            self.ultima_reposicao = agora
+            return -self.saldo / taxa if self.saldo < 0 else 0
+
+    def consumir(self, quantidade):
+        espera = self.reservar(quantidade)
+        if espera > 0:
+            time.sleep(espera)
+
+balde_envio_global = BaldeTokens(lambda: LIMITE_ENVIO_KBPS * 1024)
+
+# Mantida idêntica à cópia em servidor.py: o enquadramento é o protocolo, então as duas pontas precisam concordar.
+# O que muda por papel entra pelos ganchos: ao_receber (contagem de bytes no servidor) e balde_envio (limite de envio no cliente).
+class CanalMensagens:
+    def __init__(self, sock, ao_receber=None, balde_envio=None):
+        self.sock = sock
+        self.versao_quadros = 0  # 0 = protocolo texto legado
+        self.codecs_compressao = [] # Negociados com o servidor, na ordem de preferência do cliente
+        self.buffer_leitura = bytearray()
+        self.ao_receber = ao_receber
+        self.balde_envio = balde_envio
+
+    def _recebido(self, quantidade):
+        if self.ao_receber is not None:
+            self.ao_receber(quantidade)
+        return quantidade
+
+    def _enviado(self, quantidade):
+        if self.balde_envio is not None:
+            self.balde_envio.consumir(quantidade)
+
+    def _preencher_buffer(self, minimo_bytes):
+        while len(self.buffer_leitura) < minimo_bytes:
+            bloco = self.sock.recv(max(TAMANHO_BUFFER, minimo_bytes - len(self.buffer_leitura)))
+            if not bloco:
+                return False
+            self._recebido(len(bloco))
+            self.buffer_leitura += bloco
+        return True
+
+    def _consumir_buffer(self, quantidade):
+        dados = bytes(self.buffer_leitura[:quantidade])
+        del self.buffer_leitura[:quantidade]
+        return dados
+
+    def enviar_mensagem(self, mensagem):
+        if isinstance(mensagem, str):
+            mensagem = mensagem.encode('utf-8')
+        if self.versao_quadros:
+            self.sock.sendall(ESTRUTURA_CABECALHO_QUADRO.pack(self.versao_quadros, len(mensagem)) + mensagem)
+        else:
+            self.sock.sendall(mensagem)
+        self._enviado(len(mensagem))
+
+    def receber_mensagem(self):
+        if not self.versao_quadros:
+            if self.buffer_leitura:
+                return self._consumir_buffer(len(self.buffer_leitura))
+            mensagem = self.sock.recv(TAMANHO_BUFFER)
+            self._recebido(len(mensagem))
+            return mensagem
+
+        if not self._preencher_buffer(ESTRUTURA_CABECALHO_QUADRO.size):
+            if self.buffer_leitura:
+                raise ErroProtocolo("Conexão encerrada no meio do cabeçalho de um quadro.")
+            return b""
+        versao, tamanho_payload = ESTRUTURA_CABECALHO_QUADRO.unpack_from(self.buffer_leitura)
+        if versao != self.versao_quadros:
+            raise ErroProtocolo(f"Versão de quadro inesperada: {versao} (negociada: {self.versao_quadros}).")
+        if tamanho_payload > TAMANHO_MAXIMO_QUADRO:
+            raise ErroProtocolo(f"Quadro de {tamanho_payload} bytes excede o limite de {TAMANHO_MAXIMO_QUADRO}.")
+        if not self._preencher_buffer(ESTRUTURA_CABECALHO_QUADRO.size + tamanho_payload):
+            raise ErroProtocolo("Conexão encerrada no meio do payload de um quadro.")
+        del self.buffer_leitura[:ESTRUTURA_CABECALHO_QUADRO.size]
+        return self._consumir_buffer(tamanho_payload)
+
+    def receber_bytes(self, quantidade_maxima):
+        # Dados brutos: primeiro o que sobrou no buffer do leitor de quadros, depois direto do socket
+        if self.buffer_leitura:
+            return self._consumir_buffer(min(quantidade_maxima, len(self.buffer_leitura)))
+        dados = self.sock.recv(quantidade_maxima)
+        self._recebido(len(dados))
+        return dados
+
+    def receber_bytes_em(self, visao_destino):
+        if self.buffer_leitura:
+            quantidade = min(len(visao_destino), len(self.buffer_leitura))
+            visao_destino[:quantidade] = self.buffer_leitura[:quantidade]
+            del self.buffer_leitura[:quantidade]
+            return quantidade
+        return self._recebido(self.sock.recv_into(visao_destino))
+
+    def enviar_bytes(self, dados):
+        if self.balde_envio is None or not self.balde_envio.obter_taxa():
+            self.sock.sendall(dados)
+            return
+        visao_dados = memoryview(dados)
+        for posicao in range(0, len(visao_dados), TAMANHO_FATIA_LIMITADA):
+            fatia = visao_dados[posicao:posicao + TAMANHO_FATIA_LIMITADA]
+            self.sock.sendall(fatia)
+            self._enviado(len(fatia))
+
+# As conexões paralelas de envio rodam em threads próprias e cada uma abre sua conexão com o BD
+def abrir_conexao_bd(arquivo_bd):
+    return sqlite3.connect(arquivo_bd, timeout=TIMEOUT_BD_SEGUNDOS)
+
+# Write-behind: as escritas das threads de envio entram numa fila e uma única thread as aplica em transações agrupadas.
+# Escritas duráveis (estado usado na retomada) só retornam depois do commit que as inclui; as demais vão no próximo lote.
+# Mantida idêntica à cópia em servidor.py: correções no gravador valem para os dois lados.
+class GravadorBD:
+    def __init__(self, arquivo_bd, maximo_escritas_lote=MAXIMO_ESCRITAS_LOTE_BD, intervalo_maximo_lote=INTERVALO_MAXIMO_LOTE_BD_SEGUNDOS, ao_commit=None):
+        self.arquivo_bd = arquivo_bd
+        self.ao_commit = ao_commit # Recebe a duração de cada commit (métricas do servidor)
+        self.maximo_escritas_lote = maximo_escritas_lote
+        self.intervalo_maximo_lote = intervalo_maximo_lote
+        self.fila = queue.Queue()
+        self.thread = threading.Thread(target=self._executar, name="GravadorBD", daemon=True)
+        self.thread.start()
+
+    def executar(self, sql, parametros=(), duravel=False, com_resultado=False):
+        evento = threading.Event() if (duravel or com_resultado) else None
+        resultado = [] if com_resultado else None
+        self.fila.put((sql, parametros, duravel, evento, resultado))
+        if evento is not None:
+            evento.wait()
+        return resultado[0] if resultado else None
+
+    def sincronizar(self):
+        self.executar(None, duravel=True)
+
+    def encerrar(self):
+        self.fila.put(None)
+        self.thread.join()
+
+    def _executar(self):
+        conexao = abrir_conexao_bd(self.arquivo_bd)
+        conexao.execute("PRAGMA synchronous=FULL")
+        escritas_pendentes, aguardando_commit, inicio_lote = 0, [], None
+        encerrando = False
+        while not encerrando:
+            espera = None if inicio_lote is None else max(0, inicio_lote + self.intervalo_maximo_lote - time.monotonic())
+            try:
+                item = self.fila.get(timeout=espera)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                encerrando = True
+            elif item:
+                sql, parametros, duravel, evento, resultado = item
+                if sql is not None:
+                    try:
+                        linhas = conexao.execute(sql, parametros).fetchall()
+                        if resultado is not None:
+                            resultado.append(linhas[0] if linhas else None)
+                    except Exception as e:
+                        logger_texto.error(f"BD Erro (GravadorBD): {e} em {sql.strip()[:120]}", exc_info=True)
+                    escritas_pendentes += 1
+                    if inicio_lote is None:
+                        inicio_lote = time.monotonic()
+                if duravel:
+                    aguardando_commit.append(evento)
+                elif evento is not None:
+                    evento.set()
+
+            if encerrando or aguardando_commit or escritas_pendentes >= self.maximo_escritas_lote or (inicio_lote is not None and time.monotonic() - inicio_lote >= self.intervalo_maximo_lote):
+                inicio_commit = time.perf_counter()
+                try:
+                    conexao.commit()
+                except Exception as e:
+                    logger_texto.error(f"BD Erro (GravadorBD commit): {e}", exc_info=True)
+                if self.ao_commit is not None:
+                    self.ao_commit(time.perf_counter() - inicio_commit)
+                for evento in aguardando_commit:
+                    evento.set()
+                escritas_pendentes, aguardando_commit, inicio_lote = 0, [], None
+        conexao.close()
+
+def executar_escrita_bd(conexao_bd_local, sql, parametros=(), duravel=False, com_resultado=False):
+    # Sem o gravador (ex.: scripts que importam o módulo) a escrita vai direto na conexão recebida
+    if gravador_bd_cliente_global is not None:
+        return gravador_bd_cliente_global.executar(sql, parametros, duravel, com_resultado)
+    linhas = conexao_bd_local.execute(sql, parametros).fetchall()
+    conexao_bd_local.commit()
+    return linhas[0] if com_resultado and linhas else None
+
+def adicionar_coluna_se_ausente(cursor_bd, tabela, coluna, definicao):
+    # Bancos criados por versões anteriores não têm as colunas novas
+    colunas_existentes = {linha[1] for linha in cursor_bd.execute(f"PRAGMA table_info({tabela})")}
+    if coluna not in colunas_existentes:
+        cursor_bd.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
 
 def inicializar_banco_dados_cliente(arquivo_bd):
-    conexao = sqlite3.connect(arquivo_bd)
+    conexao = abrir_conexao_bd(arquivo_bd)
+    conexao.execute("PRAGMA journal_mode=WAL")
     cursor_bd = conexao.cursor()
     cursor_bd.execute('''
     CREATE TABLE IF NOT EXISTS client_event_log (
@@ -53,57 +339,404 @@ def inicializar_banco_dados_cliente(arquivo_bd):
         send_speed_KBps REAL,
         server_final_response TEXT,
         client_send_status TEXT NOT NULL,
+        error_details TEXT,
+        checksum_ns INTEGER,
+        prepare_ns INTEGER,
+        send_ns INTEGER,
+        server_verify_ns INTEGER
+    )''')
+    for coluna_tempo in COLUNAS_TEMPOS_FASES:
+        adicionar_coluna_se_ausente(cursor_bd, "client_file_send_log", coluna_tempo, "INTEGER")
+    cursor_bd.execute('''
+    CREATE TABLE IF NOT EXISTS client_checksum_cache (
+        source_local_file_path TEXT NOT NULL,
+        checksum_algorithm TEXT NOT NULL,
+        file_size_bytes INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        checksum_hex TEXT NOT NULL,
+        last_used_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (source_local_file_path, checksum_algorithm)
+    )''')
+    cursor_bd.execute("CREATE INDEX IF NOT EXISTS idx_checksum_cache_last_used ON client_checksum_cache(last_used_timestamp)")
+    cursor_bd.execute('''
+    CREATE TABLE IF NOT EXISTS client_job_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        folder_path TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'QUEUED',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker_pid INTEGER,
+        server_address TEXT,
+        enqueued_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        started_timestamp DATETIME,
+        finished_timestamp DATETIME,
         error_details TEXT
     )''')
+    cursor_bd.execute("CREATE INDEX IF NOT EXISTS idx_client_job_queue_status ON client_job_queue(status, id)")
+    cursor_bd.execute('''
+    CREATE TABLE IF NOT EXISTS client_identity (
+        client_id TEXT PRIMARY KEY,
+        created_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
     conexao.commit()
     return conexao
 
+def obter_id_cliente_bd(conexao_bd):
+    # Gerado uma única vez por instalação: o servidor indexa a retomada por ele, não pelo ip:porta da conexão
+    cursor_bd = conexao_bd.cursor()
+    cursor_bd.execute("SELECT client_id FROM client_identity ORDER BY created_timestamp LIMIT 1")
+    linha = cursor_bd.fetchone()
+    if linha:
+        return linha[0]
+    id_cliente = uuid.uuid4().hex
+    cursor_bd.execute("INSERT INTO client_identity (client_id) VALUES (?)", (id_cliente,))
+    conexao_bd.commit()
+    return id_cliente
+
 def registrar_evento_geral_cliente_bd(conexao_bd, tipo_evento, details=None):
     try:
-        cursor_bd = conexao_bd.cursor()
-        cursor_bd.execute("INSERT INTO client_event_log (event_type, details) VALUES (?, ?)", (tipo_evento, details))
-        conexao_bd.commit()
+        executar_escrita_bd(conexao_bd, "INSERT INTO client_event_log (event_type, details) VALUES (?, ?)", (tipo_evento, details))
     except Exception as e:
         logger_texto.error(f"BD Cliente Erro (registrar_evento_geral): {e}", exc_info=True)
 
-def registrar_envio_arquivo_cliente_bd(conexao_bd, end_servidor, caminho_origem, caminho_rel, tamanho, algo, checksum, duracao, velocidade, resposta_servidor, status_cliente, detalhes_erro=None, tempo_evento=None):
+def registrar_envio_arquivo_cliente_bd(conexao_bd, end_servidor, caminho_origem, caminho_rel, tamanho, algo, checksum, duracao, velocidade, resposta_servidor, status_cliente, detalhes_erro=None, tempo_evento=None, tempos_ns=None):
     try:
-        cursor_bd = conexao_bd.cursor()
         timestamp_log = tempo_evento if tempo_evento else sqlite3.CURRENT_TIMESTAMP
-        cursor_bd.execute('''
-        INSERT INTO client_file_send_log (event_timestamp, server_address, source_local_file_path, relative_file_path_sent, file_size_bytes, checksum_algorithm, calculated_checksum_hex, send_duration_seconds, send_speed_KBps, server_final_response, client_send_status, error_details)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp_log, end_servidor, caminho_origem, caminho_rel, tamanho, algo, checksum, duracao, velocidade, resposta_servidor, status_cliente, detalhes_erro))
-        conexao_bd.commit()
+        tempos_ns = tempos_ns or {}
+        executar_escrita_bd(conexao_bd, '''
+        INSERT INTO client_file_send_log (event_timestamp, server_address, source_local_file_path, relative_file_path_sent, file_size_bytes, checksum_algorithm, calculated_checksum_hex, send_duration_seconds, send_speed_KBps, server_final_response, client_send_status, error_details,
+                                          checksum_ns, prepare_ns, send_ns, server_verify_ns)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (timestamp_log, end_servidor, caminho_origem, caminho_rel, tamanho, algo, checksum, duracao, velocidade, resposta_servidor, status_cliente, detalhes_erro,
+              *(tempos_ns.get(coluna_tempo) for coluna_tempo in COLUNAS_TEMPOS_FASES)))
     except Exception as e:
         logger_texto.error(f"BD Cliente Erro (registrar_envio_arquivo): {e}", exc_info=True)
 
+def assinatura_arquivo(info_arquivo):
+    return info_arquivo.st_size, info_arquivo.st_mtime_ns, info_arquivo.st_ino
+
+def obter_checksum_em_cache_bd(conexao_bd, caminho_arquivo, algoritmo, info_arquivo):
+    try:
+        cursor_bd = conexao_bd.cursor()
+        cursor_bd.execute("SELECT file_size_bytes, mtime_ns, inode, checksum_hex FROM client_checksum_cache WHERE source_local_file_path = ? AND checksum_algorithm = ?",
+                          (os.path.abspath(caminho_arquivo), algoritmo))
+        linha = cursor_bd.fetchone()
+        if not linha:
+            return None
+        if tuple(linha[:3]) != assinatura_arquivo(info_arquivo):
+            # Arquivo mudou desde o último cálculo: a entrada não vale mais
+            executar_escrita_bd(conexao_bd, "DELETE FROM client_checksum_cache WHERE source_local_file_path = ? AND checksum_algorithm = ?", (os.path.abspath(caminho_arquivo), algoritmo))
+            return None
+        executar_escrita_bd(conexao_bd, "UPDATE client_checksum_cache SET last_used_timestamp = CURRENT_TIMESTAMP WHERE source_local_file_path = ? AND checksum_algorithm = ?",
+                          (os.path.abspath(caminho_arquivo), algoritmo))
+        return linha[3]
+    except Exception as e:
+        logger_texto.error(f"BD Cliente Erro (obter_checksum_em_cache): {e}", exc_info=True)
+        return None
+
+def guardar_checksum_em_cache_bd(conexao_bd, caminho_arquivo, algoritmo, info_arquivo, checksum_hex):
+    try:
+        # Só guarda se o arquivo não mudou enquanto era lido
+        if assinatura_arquivo(os.stat(caminho_arquivo)) != assinatura_arquivo(info_arquivo):
+            return
+        executar_escrita_bd(conexao_bd, '''
+        INSERT OR REPLACE INTO client_checksum_cache (source_local_file_path, checksum_algorithm, file_size_bytes, mtime_ns, inode, checksum_hex, last_used_timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (os.path.abspath(caminho_arquivo), algoritmo, *assinatura_arquivo(info_arquivo), checksum_hex))
+    except Exception as e:
+        logger_texto.error(f"BD Cliente Erro (guardar_checksum_em_cache): {e}", exc_info=True)
+
+def limpar_cache_checksums_bd(conexao_bd, dias_retencao=DIAS_RETENCAO_CACHE_CHECKSUM):
+    try:
+        cursor_bd = conexao_bd.cursor()
+        cursor_bd.execute("SELECT COUNT(*) FROM client_checksum_cache WHERE last_used_timestamp < datetime('now', ?)", (f"-{dias_retencao} days",))
+        removidas = cursor_bd.fetchone()[0]
+        if removidas:
+            executar_escrita_bd(conexao_bd, "DELETE FROM client_checksum_cache WHERE last_used_timestamp < datetime('now', ?)", (f"-{dias_retencao} days",))
+            logger_texto.info(f"{removidas} entradas antigas removidas do cache de checksums.")
+    except Exception as e:
+        logger_texto.error(f"BD Cliente Erro (limpar_cache_checksums): {e}", exc_info=True)
+
+def calcular_checksum_com_cache(conexao_bd, caminho_arquivo, algoritmo='md5'):
+    try:
+        info_arquivo = os.stat(caminho_arquivo)
+    except OSError as e:
+        logger_texto.error(f"Erro ao ler metadados de {caminho_arquivo}: {e}")
+        return None
+    checksum_hex = obter_checksum_em_cache_bd(conexao_bd, caminho_arquivo, algoritmo, info_arquivo)
+    if checksum_hex:
+        return checksum_hex
+    checksum_hex = calcular_checksum(caminho_arquivo, algoritmo)
+    if checksum_hex:
+        guardar_checksum_em_cache_bd(conexao_bd, caminho_arquivo, algoritmo, info_arquivo, checksum_hex)
+    return checksum_hex
+
+class HasheadorCRC32:
+    # Checksum não criptográfico (zlib.crc32, em C) com a mesma interface dos objetos do hashlib
+    name = "crc32"
+
+    def __init__(self, valor=0):
+        self.valor = valor
+
+    def update(self, dados):
+        self.valor = zlib.crc32(dados, self.valor)
+
+    def hexdigest(self):
+        return f"{self.valor:08x}"
+
+    def copy(self):
+        return HasheadorCRC32(self.valor)
+
+def criar_hasheador(algoritmo):
+    return HasheadorCRC32() if algoritmo == "crc32" else hashlib.new(algoritmo)
+
+def mapear_arquivo(arquivo_local):
+    # Só arquivos regulares a partir de LIMIAR_ARQUIVO_MMAP; pipes, /proc, dispositivos ou falha do mmap seguem por leitura
+    if not USAR_MMAP:
+        return None
+    try:
+        info_arquivo = os.fstat(arquivo_local.fileno())
+        if not stat.S_ISREG(info_arquivo.st_mode) or info_arquivo.st_size < LIMIAR_ARQUIVO_MMAP:
+            return None
+        mapa = mmap.mmap(arquivo_local.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        logger_texto.warning(f"mmap indisponível para '{arquivo_local.name}' ({e}); lendo em blocos.")
+        return None
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapa.madvise(mmap.MADV_SEQUENTIAL)
+    return mapa
+
+def ler_fatias_arquivo(arquivo_local, offset_inicial, tamanho_a_ler):
+    # Gera memoryviews do trecho pedido: fatias do próprio mapeamento em arquivos grandes (nada é copiado para objetos
+    # Python; o mapeamento é solto quando a última fatia sai de uso) ou um buffer reutilizado por readinto nos demais.
+    # Quem consome não pode guardar a fatia depois da próxima iteração.
+    if tamanho_a_ler <= 0:
+        return
+    lidos_total = 0
+    mapa = mapear_arquivo(arquivo_local)
+    if mapa is not None:
+        fim = min(offset_inicial + tamanho_a_ler, len(mapa))
+        visao_mapa = memoryview(mapa)
+        for posicao in range(offset_inicial, fim, TAMANHO_FATIA_MMAP):
+            fatia = visao_mapa[posicao:min(posicao + TAMANHO_FATIA_MMAP, fim)]
+            yield fatia
+            lidos_total += len(fatia)
+    else:
+        visao_buffer = memoryview(bytearray(TAMANHO_BLOCO_LEITURA))
+        arquivo_local.seek(offset_inicial)
+        while lidos_total < tamanho_a_ler:
+            lidos = arquivo_local.readinto(visao_buffer[:min(len(visao_buffer), tamanho_a_ler - lidos_total)])
+            if not lidos:
+                break
+            yield visao_buffer[:lidos]
+            lidos_total += lidos
+    if lidos_total < tamanho_a_ler:
+        logger_texto.warning("Leitura do arquivo local terminou inesperadamente antes do esperado.")
+
 def calcular_checksum(caminho_arquivo, algoritmo='md5'):
-    hasheador = hashlib.new(algoritmo)
+    # hashlib.file_digest (3.11+) lê em blocos grandes direto para um buffer reutilizado e solta o GIL nos algoritmos do OpenSSL;
+    # arquivos grandes vão direto do mmap para o hash, sem a cópia para o buffer
     try:
         with open(caminho_arquivo, 'rb') as f:
-            while bloco := f.read(TAMANHO_BUFFER):
+            tamanho_arquivo = os.fstat(f.fileno()).st_size
+            if USAR_MMAP and tamanho_arquivo >= LIMIAR_ARQUIVO_MMAP:
+                hasheador = criar_hasheador(algoritmo)
+                for fatia in ler_fatias_arquivo(f, 0, tamanho_arquivo):
+                    hasheador.update(fatia)
+                return hasheador.hexdigest()
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(f, lambda: criar_hasheador(algoritmo)).hexdigest()
+            hasheador = criar_hasheador(algoritmo)
+            while bloco := f.read(TAMANHO_BLOCO_LEITURA):
                 hasheador.update(bloco)
-        return hasheador.hexdigest()
+            return hasheador.hexdigest()
     except Exception as e:
         logger_texto.error(f"Erro ao calcular checksum para {caminho_arquivo}: {e}", exc_info=True)
         return None
 
-def enviar_dados_arquivo(socket_cliente, caminho_arquivo_local, offset_inicial, tamanho_total):
+def calcular_impressao_rapida(caminho_arquivo, algoritmo='md5'):
+    # Pré-verificação barata para pular/retomar sem ler o arquivo inteiro: tamanho, mtime e os blocos inicial e final
+    try:
+        info_arquivo = os.stat(caminho_arquivo)
+        hasheador = criar_hasheador(algoritmo)
+        hasheador.update(f"{info_arquivo.st_size}:{info_arquivo.st_mtime_ns}".encode('utf-8'))
+        with open(caminho_arquivo, 'rb') as f:
+            hasheador.update(f.read(TAMANHO_AMOSTRA_IMPRESSAO))
+            if info_arquivo.st_size > TAMANHO_AMOSTRA_IMPRESSAO:
+                f.seek(max(TAMANHO_AMOSTRA_IMPRESSAO, info_arquivo.st_size - TAMANHO_AMOSTRA_IMPRESSAO))
+                hasheador.update(f.read(TAMANHO_AMOSTRA_IMPRESSAO))
+        return hasheador.hexdigest()
+    except Exception as e:
+        logger_texto.error(f"Erro ao calcular impressão rápida para {caminho_arquivo}: {e}", exc_info=True)
+        return None
+
+def varrer_arvore(caminho_pasta_origem, caminho_relativo_diretorio=""):
+    # os.scandir traz o tipo de cada entrada junto com a listagem; como os.walk, lista links para pastas mas não desce por eles
+    pastas, arquivos, subpastas_a_varrer = [], [], []
+    try:
+        with os.scandir(os.path.join(caminho_pasta_origem, caminho_relativo_diretorio)) as entradas:
+            for entrada in entradas:
+                caminho_relativo = f"{caminho_relativo_diretorio}/{entrada.name}" if caminho_relativo_diretorio else entrada.name
+                try:
+                    if entrada.is_dir():
+                        pastas.append(caminho_relativo)
+                        if not entrada.is_symlink():
+                            subpastas_a_varrer.append(caminho_relativo)
+                    else:
+                        arquivos.append((entrada.path, caminho_relativo, entrada.stat()))
+                except OSError as e:
+                    logger_texto.error(f"Não foi possível ler metadados de '{entrada.path}': {e}. Arquivo ignorado.")
+    except OSError as e:
+        logger_texto.error(f"Não foi possível listar '{os.path.join(caminho_pasta_origem, caminho_relativo_diretorio)}': {e}")
+        return
+    yield pastas, arquivos
+    for caminho_relativo in subpastas_a_varrer:
+        yield from varrer_arvore(caminho_pasta_origem, caminho_relativo)
+
+def calcular_checksums_em_processo(caminhos_arquivos, algoritmo):
+    # Roda num processo do pool: só lê os arquivos; cache e BD ficam com o processo principal
+    return [calcular_checksum(caminho_arquivo, algoritmo) for caminho_arquivo in caminhos_arquivos]
+
+def criar_pool_checksums():
+    if NUMERO_PROCESSOS_CHECKSUM <= 1:
+        return None
+    try:
+        # spawn: o cliente já tem threads (gravador do BD, leitores de respostas) e um fork herdaria travas tomadas por elas
+        return concurrent.futures.ProcessPoolExecutor(max_workers=NUMERO_PROCESSOS_CHECKSUM, mp_context=multiprocessing.get_context("spawn"))
+    except (OSError, ValueError, NotImplementedError) as e:
+        logger_texto.warning(f"Pool de processos indisponível ({e}); checksums calculados no próprio processo.")
+        return None
+
+def submeter_checksums(pool, arquivos, algoritmo):
+    # arquivos: [(caminho, tamanho)]. Devolve {caminho: (futuro, posição no resultado da tarefa)}; quem ficar de fora
+    # (pool quebrado) é calculado no próprio processo
+    futuros_checksums, grupo, bytes_grupo = {}, [], 0
+    try:
+        for posicao_arquivo, (caminho_arquivo, tamanho_arquivo) in enumerate(arquivos):
+            grupo.append(caminho_arquivo)
+            bytes_grupo += tamanho_arquivo
+            if len(grupo) >= MAXIMO_ARQUIVOS_TAREFA_CHECKSUM or bytes_grupo >= MAXIMO_BYTES_TAREFA_CHECKSUM or posicao_arquivo == len(arquivos) - 1:
+                futuro = pool.submit(calcular_checksums_em_processo, grupo, algoritmo)
+                futuros_checksums.update((caminho, (futuro, posicao)) for posicao, caminho in enumerate(grupo))
+                grupo, bytes_grupo = [], 0
+    except RuntimeError as e:
+        logger_texto.warning(f"Pool de processos falhou ({e}); checksums restantes calculados no próprio processo.")
+    return futuros_checksums
+
+def obter_checksum_de_processo(conexao_bd, futuro_checksum, caminho_arquivo, info_arquivo):
+    # None quando o arquivo não foi para o pool ou a tarefa falhou: quem chama calcula no próprio processo
+    if futuro_checksum is None:
+        return None
+    futuro, posicao = futuro_checksum
+    try:
+        checksum_hex = futuro.result()[posicao]
+    except Exception as e:
+        logger_texto.warning(f"Checksum de '{caminho_arquivo}' falhou no pool de processos ({e}); calculando no próprio processo.")
+        return None
+    if checksum_hex:
+        guardar_checksum_em_cache_bd(conexao_bd, caminho_arquivo, algoritmo_checksum_global, info_arquivo, checksum_hex)
+    return checksum_hex
+
+def enviar_dados_com_hash(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar, hasheador):
+    # Leitura única: cada bloco entra no hash e vai para o socket; o prefixo que o servidor já tem só entra no hash
+    for fatia in ler_fatias_arquivo(arquivo_local, 0, offset_inicial):
+        hasheador.update(fatia)
+
+    bytes_enviados = 0
+    for fatia in ler_fatias_arquivo(arquivo_local, offset_inicial, tamanho_a_enviar):
+        hasheador.update(fatia)
+        canal_servidor.enviar_bytes(fatia)
+        bytes_enviados += len(fatia)
+    return bytes_enviados
+
+def enviar_dados_sendfile(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar):
+    # Zero-copy: o kernel copia do page cache direto para o socket, em fatias para acompanhar o progresso
+    bytes_enviados = 0
+    while bytes_enviados < tamanho_a_enviar:
+        fatia = min(TAMANHO_FATIA_LIMITADA if LIMITE_ENVIO_KBPS else TAMANHO_FATIA_SENDFILE, tamanho_a_enviar - bytes_enviados)
+        enviados_na_fatia = canal_servidor.sock.sendfile(arquivo_local, offset_inicial + bytes_enviados, fatia)
+        if not enviados_na_fatia:
+            logger_texto.warning("Leitura do arquivo local terminou inesperadamente antes do esperado.")
+            break # Fim inesperado do arquivo
+        bytes_enviados += enviados_na_fatia
+        balde_envio_global.consumir(enviados_na_fatia)
+    return bytes_enviados
+
+def enviar_dados_em_blocos(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar):
+    bytes_enviados = 0
+    for fatia in ler_fatias_arquivo(arquivo_local, offset_inicial, tamanho_a_enviar):
+        canal_servidor.enviar_bytes(fatia)
+        bytes_enviados += len(fatia)
+    return bytes_enviados
+
+# Compressores em fluxo: todos expõem compress()/flush(), então o envio não depende do codec
+COMPRESSORES = {
+    "zlib": lambda: zlib.compressobj(NIVEL_COMPRESSAO_ZLIB),
+    "lzma": lambda: lzma.LZMACompressor(preset=NIVEL_COMPRESSAO_LZMA),
+}
+if zstandard:
+    COMPRESSORES["zstd"] = lambda: zstandard.ZstdCompressor(level=NIVEL_COMPRESSAO_ZSTD).compressobj()
+
+def escolher_codec_compressao(canal_servidor, caminho_arquivo_local, offset_inicial, tamanho_total):
+    # Por arquivo: formatos já comprimidos e amostras que não encolhem vão crus
+    if not canal_servidor.codecs_compressao or tamanho_total - offset_inicial < TAMANHO_MINIMO_COMPRESSAO:
+        return None
+    if os.path.splitext(caminho_arquivo_local)[1].lower() in EXTENSOES_JA_COMPRIMIDAS:
+        return None
+    try:
+        with open(caminho_arquivo_local, 'rb') as arquivo_local:
+            arquivo_local.seek(offset_inicial)
+            amostra = arquivo_local.read(TAMANHO_AMOSTRA_COMPRESSAO)
+    except OSError:
+        return None
+    if not amostra or len(zlib.compress(amostra, 1)) > len(amostra) * RAZAO_MAXIMA_COMPRESSAO:
+        return None
+    return canal_servidor.codecs_compressao[0]
+
+def enviar_dados_comprimidos(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar, codec_compressao, hasheador=None):
+    # Lê em blocos e manda quadros com a saída do compressor, terminando com um quadro vazio.
+    # Offsets e contagens continuam em bytes descomprimidos, então a retomada funciona igual.
+    compressor = COMPRESSORES[codec_compressao]()
+    if hasheador is not None:
+        for fatia in ler_fatias_arquivo(arquivo_local, 0, offset_inicial):
+            hasheador.update(fatia)
+
+    bytes_enviados = 0
+    bytes_comprimidos = 0
+    saida_pendente = bytearray()
+    for fatia in ler_fatias_arquivo(arquivo_local, offset_inicial, tamanho_a_enviar):
+        if hasheador is not None:
+            hasheador.update(fatia)
+        saida_pendente += compressor.compress(fatia)
+        bytes_enviados += len(fatia)
+        if len(saida_pendente) >= TAMANHO_BLOCO_LEITURA:
+            canal_servidor.enviar_mensagem(bytes(saida_pendente))
+            bytes_comprimidos += len(saida_pendente)
+            saida_pendente = bytearray()
+    saida_pendente += compressor.flush()
+    if saida_pendente:
+        canal_servidor.enviar_mensagem(bytes(saida_pendente))
+        bytes_comprimidos += len(saida_pendente)
+    canal_servidor.enviar_mensagem(b"")
+    logger_texto.info(f"Compressão {codec_compressao}: {bytes_enviados} bytes enviados como {bytes_comprimidos}.")
+    return bytes_enviados
+
+def enviar_dados_arquivo(canal_servidor, caminho_arquivo_local, offset_inicial, tamanho_total, hasheador=None, codec_compressao=None):
     bytes_enviados = 0
     tamanho_a_enviar = tamanho_total - offset_inicial
     logger_texto.info(f"Enviando dados de '{os.path.basename(caminho_arquivo_local)}' a partir do byte {offset_inicial}. Total a enviar: {tamanho_a_enviar} bytes.")
     
     try:
         with open(caminho_arquivo_local, 'rb') as arquivo_local:
-            arquivo_local.seek(offset_inicial) # Pula para o ponto de retomada
-            while bytes_enviados < tamanho_a_enviar:
-                bloco_dados = arquivo_local.read(TAMANHO_BUFFER)
-                if not bloco_dados:
-                    logger_texto.warning("Leitura do arquivo local terminou inesperadamente antes do esperado.")
-                    break # Fim inesperado do arquivo
-                socket_cliente.sendall(bloco_dados)
-                bytes_enviados += len(bloco_dados)
+            # socket.sendfile já recai sozinho para send() quando os.sendfile não está disponível ou falha antes do primeiro byte
+            if codec_compressao:
+                bytes_enviados = enviar_dados_comprimidos(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar, codec_compressao, hasheador)
+            elif hasheador is not None:
+                bytes_enviados = enviar_dados_com_hash(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar, hasheador)
+            elif USAR_SENDFILE and canal_servidor.sock.gettimeout() != 0:
+                bytes_enviados = enviar_dados_sendfile(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar)
+            else:
+                bytes_enviados = enviar_dados_em_blocos(canal_servidor, arquivo_local, offset_inicial, tamanho_a_enviar)
         
         logger_texto.info(f"Envio de dados para '{os.path.basename(caminho_arquivo_local)}' concluído. Total enviado nesta sessão: {bytes_enviados} bytes.")
         return True 
@@ -111,77 +744,306 @@ def enviar_dados_arquivo(socket_cliente, caminho_arquivo_local, offset_inicial,
         logger_texto.error(f"Exceção durante o envio de dados do arquivo '{os.path.basename(caminho_arquivo_local)}': {e}", exc_info=True)
         return False
 
-def enviar_pasta(socket_cliente, caminho_pasta_origem, endereco_servidor_str):
+# Transferência delta: o servidor manda assinaturas dos blocos da cópia que tem (Adler-32 + BLAKE2b de 128 bits)
+# e o cliente percorre o próprio arquivo mandando literais para o que mudou e cópias de blocos para o resto.
+class EmissorDelta:
+    # Agrupa literais em quadros de até TAMANHO_BLOCO_LEITURA e blocos consecutivos numa única instrução de cópia
+    def __init__(self, canal_servidor):
+        self.canal_servidor = canal_servidor
+        self.literais = bytearray()
+        self.inicio_copia = None
+        self.quantidade_copia = 0
+        self.bytes_literais = 0
+
+    def literal(self, dados):
+        self._descarregar_copia()
+        self.literais += dados
+        self.bytes_literais += len(dados)
+        if len(self.literais) >= TAMANHO_BLOCO_LEITURA:
+            self._descarregar_literais()
+
+    def copiar(self, indice_bloco):
+        self._descarregar_literais()
+        if self.inicio_copia is not None and indice_bloco == self.inicio_copia + self.quantidade_copia:
+            self.quantidade_copia += 1
+            return
+        self._descarregar_copia()
+        self.inicio_copia, self.quantidade_copia = indice_bloco, 1
+
+    def encerrar(self, checksum_hex):
+        self._descarregar_literais()
+        self._descarregar_copia()
+        self.canal_servidor.enviar_mensagem(f"DELTA_END:{checksum_hex}")
+
+    def _descarregar_literais(self):
+        if self.literais:
+            self.canal_servidor.enviar_mensagem(b"DELTA_LITERAL:" + self.literais)
+            self.literais = bytearray()
+
+    def _descarregar_copia(self):
+        if self.inicio_copia is not None:
+            self.canal_servidor.enviar_mensagem(f"DELTA_COPY:{self.inicio_copia}:{self.quantidade_copia}")
+            self.inicio_copia = None
+
+def procurar_bloco_delta(mapa_fracas, fortes, fraca, dados):
+    candidatos = mapa_fracas.get(fraca)
+    if candidatos:
+        forte = hashlib.blake2b(dados, digest_size=16).hexdigest()
+        for indice_bloco in candidatos:
+            if fortes[indice_bloco] == forte:
+                return indice_bloco
+    return None
+
+def procurar_bloco_deslocado(dados, posicao, tamanho_bloco, tamanho_total, mapa_fracas, fortes):
+    # Janela rolante byte a byte por até um bloco: reencontra blocos do servidor depois de uma inserção ou remoção.
+    # Retorna (deslocamento a partir de posicao, índice do bloco) ou (None, None).
+    fraca = zlib.adler32(dados[posicao:posicao + tamanho_bloco])
+    soma_a, soma_b = fraca & 0xffff, fraca >> 16
+    for inicio in range(posicao, min(posicao + tamanho_bloco, tamanho_total - tamanho_bloco)):
+        saindo, entrando = dados[inicio], dados[inicio + tamanho_bloco]
+        soma_a = (soma_a - saindo + entrando) % MODULO_ADLER
+        soma_b = (soma_b - tamanho_bloco * saindo + soma_a - 1) % MODULO_ADLER
+        fraca = (soma_b << 16) | soma_a
+        if fraca in mapa_fracas:
+            indice_bloco = procurar_bloco_delta(mapa_fracas, fortes, fraca, dados[inicio + 1:inicio + 1 + tamanho_bloco])
+            if indice_bloco is not None:
+                return inicio + 1 - posicao, indice_bloco
+    return None, None
+
+def enviar_delta_arquivo(canal_servidor, caminho_arquivo_local, assinaturas, hasheador):
+    # Blocos na mesma posição (edições no lugar) saem a custo de C; a busca rolante em Python só roda nos primeiros
+    # blocos literais depois de um bloco reaproveitado, onde inserções e remoções deslocam o resto do arquivo
+    tamanho_bloco = assinaturas["block_size"]
+    fortes = assinaturas["strong"]
+    mapa_fracas = {}
+    for indice_bloco, fraca in enumerate(assinaturas["weak"]):
+        mapa_fracas.setdefault(fraca, []).append(indice_bloco)
+    emissor = EmissorDelta(canal_servidor)
+    try:
+        with open(caminho_arquivo_local, 'rb') as arquivo_local:
+            tamanho_total = os.fstat(arquivo_local.fileno()).st_size
+            dados = mmap.mmap(arquivo_local.fileno(), 0, access=mmap.ACCESS_READ) if tamanho_total else b""
+            try:
+                posicao = 0
+                blocos_sem_copia = 0
+                while posicao < tamanho_total:
+                    bloco = dados[posicao:posicao + tamanho_bloco]
+                    indice_bloco = procurar_bloco_delta(mapa_fracas, fortes, zlib.adler32(bloco), bloco)
+                    if indice_bloco is not None:
+                        emissor.copiar(indice_bloco)
+                        hasheador.update(bloco)
+                        posicao += len(bloco)
+                        blocos_sem_copia = 0
+                        continue
+                    if blocos_sem_copia < MAXIMO_BLOCOS_BUSCA_DELTA and len(bloco) == tamanho_bloco:
+                        blocos_sem_copia += 1
+                        deslocamento, _ = procurar_bloco_deslocado(dados, posicao, tamanho_bloco, tamanho_total, mapa_fracas, fortes)
+                        if deslocamento is not None:
+                            bloco = dados[posicao:posicao + deslocamento] # O bloco encontrado é reaproveitado na próxima volta
+                    emissor.literal(bloco)
+                    hasheador.update(bloco)
+                    posicao += len(bloco)
+            finally:
+                if tamanho_total:
+                    dados.close()
+        emissor.encerrar(hasheador.hexdigest())
+        logger_texto.info(f"Delta de '{os.path.basename(caminho_arquivo_local)}' enviado: {emissor.bytes_literais} de {tamanho_total} bytes como literais.")
+        return True
+    except Exception as e:
+        logger_texto.error(f"Exceção durante o envio delta do arquivo '{os.path.basename(caminho_arquivo_local)}': {e}", exc_info=True)
+        return False
+
+def negociar_protocolo(canal_servidor, timeout_segundos=TIMEOUT_NEGOCIACAO_SEGUNDOS):
+    # Servidores antigos não respondem a comandos desconhecidos: sem resposta dentro do timeout, segue no protocolo texto
+    timeout_anterior = canal_servidor.sock.gettimeout()
+    try:
+        canal_servidor.sock.settimeout(timeout_segundos)
+        canal_servidor.enviar_mensagem("NEGOTIATE_PROTOCOL:" + ",".join(str(v) for v in VERSOES_PROTOCOLO_SUPORTADAS))
+        resposta = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+    except socket.timeout:
+        logger_texto.warning("Servidor não respondeu à negociação de protocolo. Usando protocolo texto legado.")
+        return 0
+    finally:
+        canal_servidor.sock.settimeout(timeout_anterior)
+
+    if resposta.startswith("ACK_PROTOCOL:"):
+        versao = int(resposta.split(":", 1)[1])
+        if versao in VERSOES_PROTOCOLO_SUPORTADAS:
+            canal_servidor.versao_quadros = versao
+            logger_texto.info(f"Protocolo de quadros v{versao} negociado com o servidor.")
+            return versao
+    logger_texto.info(f"Servidor não aceitou protocolo de quadros ({resposta}). Usando protocolo texto legado.")
+    return 0
+
+def apresentar_cliente(canal_servidor):
+    # Só no protocolo de quadros: servidores antigos não respondem a comandos desconhecidos
+    if not canal_servidor.versao_quadros:
+        return False
+    canal_servidor.enviar_mensagem(f"HELLO_CLIENT:{id_cliente_global}")
+    resposta = canal_servidor.receber_mensagem()
+    if resposta != b"ACK_HELLO_CLIENT":
+        logger_texto.warning(f"Servidor não aceitou o id do cliente ({resposta.decode('utf-8', 'ignore')}). A retomada usará o endereço da conexão.")
+        return False
+    return True
+
+def negociar_compressao(canal_servidor):
+    # Também só no protocolo de quadros; sem codecs em comum os dados seguem crus
+    if not canal_servidor.versao_quadros or not USAR_COMPRESSAO:
+        return []
+    codecs_locais = [codec for codec in CODECS_COMPRESSAO_PREFERIDOS if codec in COMPRESSORES]
+    canal_servidor.enviar_mensagem("NEGOTIATE_COMPRESSION:" + ",".join(codecs_locais))
+    resposta = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+    if not resposta.startswith("ACK_COMPRESSION:"):
+        logger_texto.warning(f"Servidor não aceitou a negociação de compressão ({resposta}). Dados seguem sem compressão.")
+        return []
+    codecs_servidor = set(resposta.split(":", 1)[1].split(","))
+    canal_servidor.codecs_compressao = [codec for codec in codecs_locais if codec in codecs_servidor]
+    logger_texto.info(f"Compressão negociada: {', '.join(canal_servidor.codecs_compressao) or 'nenhuma'}.")
+    return canal_servidor.codecs_compressao
+
+def negociar_checksum(canal_servidor):
+    # O algoritmo escolhido vale para todas as conexões da pasta; sem negociação fica o padrão legado
+    global algoritmo_checksum_global
+    if not canal_servidor.versao_quadros:
+        return algoritmo_checksum_global
+    canal_servidor.enviar_mensagem("NEGOTIATE_CHECKSUM:" + ",".join(ALGORITMOS_CHECKSUM_PREFERIDOS))
+    resposta = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+    if resposta.startswith("ACK_CHECKSUM:") and resposta.split(":", 1)[1] in ALGORITMOS_CHECKSUM_PREFERIDOS:
+        algoritmo_checksum_global = resposta.split(":", 1)[1]
+        logger_texto.info(f"Algoritmo de checksum negociado: {algoritmo_checksum_global}.")
+    else:
+        logger_texto.warning(f"Servidor não aceitou nenhum algoritmo de checksum preferido ({resposta}). Usando {algoritmo_checksum_global}.")
+    return algoritmo_checksum_global
+
+def medir_velocidade_checksums(caminho_arquivo=None):
+    # Vazão de cada algoritmo nesta máquina: em memória (só CPU) ou, com um arquivo, incluindo a leitura pelo calcular_checksum
+    dados = memoryview(os.urandom(TAMANHO_BLOCO_LEITURA))
+    resultados = []
+    for algoritmo in ALGORITMOS_CHECKSUM_BENCHMARK:
+        try:
+            hasheador = criar_hasheador(algoritmo)
+        except ValueError:
+            continue # Indisponível neste OpenSSL (ex.: md5 em modo FIPS)
+        inicio = time.perf_counter()
+        if caminho_arquivo:
+            calcular_checksum(caminho_arquivo, algoritmo)
+            total_bytes = os.path.getsize(caminho_arquivo)
+        else:
+            for _ in range(TAMANHO_BENCHMARK_CHECKSUM // len(dados)):
+                hasheador.update(dados)
+            hasheador.hexdigest()
+            total_bytes = TAMANHO_BENCHMARK_CHECKSUM
+        duracao = time.perf_counter() - inicio
+        resultados.append((algoritmo, total_bytes / (1024 * 1024) / duracao if duracao > 0 else 0))
+    return resultados
+
+def status_cliente_para_resposta_final(status_final_servidor):
+    if status_final_servidor == "FILE_CHECKSUM_OK":
+        return "SUCCESS_SENT_SERVER_OK"
+    elif status_final_servidor == "FILE_CHECKSUM_MISMATCH":
+        return "SUCCESS_SENT_SERVER_CHECKSUM_FAIL"
+    return f"FAIL_SERVER_REPORTED_ERROR_{status_final_servidor}"
+
+def interpretar_resposta_preparacao(resposta_servidor_str):
+    # Retorna o offset a enviar, None para pular (já existe) ou -1 para resposta inesperada
+    if resposta_servidor_str == "FILE_ALREADY_EXISTS_CHECKSUM_OK":
+        return None
+    elif resposta_servidor_str.startswith("RESUME_FROM_OFFSET:"):
+        return int(resposta_servidor_str.split(":", 1)[1])
+    elif resposta_servidor_str == "SEND_FROM_OFFSET:0":
+        return 0
+    return -1
+
+def enviar_pasta(canal_servidor, caminho_pasta_origem, endereco_servidor_str):
     global conexao_bd_cliente_global
     if not os.path.isdir(caminho_pasta_origem):
         logger_texto.error(f"'{caminho_pasta_origem}' não é um diretório válido.")
         registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_FOLDER_NOT_FOUND", details=f"Caminho: {caminho_pasta_origem}")
-        return
+        return False
 
     nome_pasta_base = os.path.basename(caminho_pasta_origem)
     logger_texto.info(f"Iniciando transferência da pasta: {nome_pasta_base}")
     registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "SEND_FOLDER_START", details=f"Pasta: {nome_pasta_base}, Destino: {endereco_servidor_str}")
 
-    socket_cliente.sendall(f"START_FOLDER_TRANSFER:{nome_pasta_base}".encode('utf-8'))
-    ack_inicio_pasta = socket_cliente.recv(TAMANHO_BUFFER)
+    if canal_servidor.versao_quadros and NUMERO_CONEXOES_PARALELAS > 1:
+        ack_fim_pasta = enviar_arquivos_em_paralelo(canal_servidor, caminho_pasta_origem, nome_pasta_base, endereco_servidor_str, NUMERO_CONEXOES_PARALELAS)
+        if ack_fim_pasta == b"ACK_END_FOLDER":
+            logger_texto.info(f"Servidor confirmou fim do processamento da pasta '{nome_pasta_base}'.")
+        else:
+            logger_texto.warning(f"Servidor não confirmou fim do processamento da pasta: {ack_fim_pasta.decode('utf-8', 'ignore')}")
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "SEND_FOLDER_END", details=f"Pasta: {nome_pasta_base}")
+        return ack_fim_pasta == b"ACK_END_FOLDER"
+
+    canal_servidor.enviar_mensagem(f"START_FOLDER_TRANSFER:{nome_pasta_base}".encode('utf-8'))
+    ack_inicio_pasta = canal_servidor.receber_mensagem()
     if ack_inicio_pasta != b"ACK_START_FOLDER":
         logger_texto.error(f"Servidor não confirmou início da transferência da pasta: {ack_inicio_pasta.decode('utf-8', 'ignore')}")
-        return
+        return False
 
-    for diretorio_atual, subdiretorios, nomes_arquivos in os.walk(caminho_pasta_origem):
-        caminho_relativo_diretorio = os.path.relpath(diretorio_atual, caminho_pasta_origem)
-        if caminho_relativo_diretorio == ".": caminho_relativo_diretorio = ""
+    if canal_servidor.versao_quadros:
+        ack_fim_pasta = enviar_arquivos_em_lotes(canal_servidor, caminho_pasta_origem, endereco_servidor_str)
+    else:
+        ack_fim_pasta = enviar_arquivos_sequencial(canal_servidor, caminho_pasta_origem, endereco_servidor_str)
 
-        for nome_subdiretorio in subdiretorios:
-            caminho_rel_sub = os.path.join(caminho_relativo_diretorio, nome_subdiretorio).replace(os.sep, '/')
+    if ack_fim_pasta == b"ACK_END_FOLDER":
+        logger_texto.info(f"Servidor confirmou fim do processamento da pasta '{nome_pasta_base}'.")
+    else:
+        logger_texto.warning(f"Servidor não confirmou fim do processamento da pasta: {ack_fim_pasta.decode('utf-8', 'ignore')}")
+    
+    registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "SEND_FOLDER_END", details=f"Pasta: {nome_pasta_base}")
+    return ack_fim_pasta == b"ACK_END_FOLDER"
+
+def enviar_arquivos_sequencial(canal_servidor, caminho_pasta_origem, endereco_servidor_str):
+    # Protocolo texto legado: uma ida e volta por comando. A pré-varredura calcula os checksums seguintes enquanto isso
+    for pastas, entrada_manifesto in PreVarredura(caminho_pasta_origem, True).entradas(conexao_bd_cliente_global):
+        for caminho_rel_sub in pastas:
             logger_texto.info(f"  Enviando comando para criar subpasta: {caminho_rel_sub}")
-            socket_cliente.sendall(f"NEW_FOLDER:{caminho_rel_sub}".encode('utf-8'))
-            socket_cliente.recv(TAMANHO_BUFFER)
+            canal_servidor.enviar_mensagem(f"NEW_FOLDER:{caminho_rel_sub}".encode('utf-8'))
+            canal_servidor.receber_mensagem()
 
-        for nome_arquivo in nomes_arquivos:
-            caminho_completo_arquivo = os.path.join(diretorio_atual, nome_arquivo)
-            caminho_relativo_arquivo = os.path.join(caminho_relativo_diretorio, nome_arquivo).replace(os.sep, '/')
-            tamanho_arquivo_bytes = os.path.getsize(caminho_completo_arquivo)
+        if entrada_manifesto:
+            caminho_completo_arquivo = entrada_manifesto["origem"]
+            caminho_relativo_arquivo = entrada_manifesto["relativo"]
+            tamanho_arquivo_bytes = entrada_manifesto["tamanho"]
             timestamp_inicio_envio_arquivo = time.strftime('%Y-%m-%d %H:%M:%S')
+            checksum_hex_calculado = entrada_manifesto["checksum"]
 
-            checksum_hex_calculado = calcular_checksum(caminho_completo_arquivo, ALGORITMO_CHECKSUM_PADRAO)
-            if not checksum_hex_calculado:
-                logger_texto.error(f"Não foi possível calcular checksum para '{caminho_completo_arquivo}'. Arquivo ignorado.")
-                continue
+            tempos_ns = entrada_manifesto["tempos_ns"]
 
             logger_texto.info(f"Preparando para enviar '{caminho_relativo_arquivo}'. Tamanho: {tamanho_arquivo_bytes}, Checksum: {checksum_hex_calculado[:10]}...")
-            cabecalho_preparacao = f"PREPARE_FILE_TRANSFER:{caminho_relativo_arquivo}:{tamanho_arquivo_bytes}:{ALGORITMO_CHECKSUM_PADRAO}:{checksum_hex_calculado}"
-            socket_cliente.sendall(cabecalho_preparacao.encode('utf-8'))
-            resposta_servidor_str = socket_cliente.recv(TAMANHO_BUFFER).decode('utf-8', 'ignore')
+            cabecalho_preparacao = f"PREPARE_FILE_TRANSFER:{caminho_relativo_arquivo}:{tamanho_arquivo_bytes}:{algoritmo_checksum_global}:{checksum_hex_calculado}"
+            inicio_preparacao_ns = time.perf_counter_ns()
+            canal_servidor.enviar_mensagem(cabecalho_preparacao.encode('utf-8'))
+            resposta_servidor_str = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+            tempos_ns["prepare_ns"] = time.perf_counter_ns() - inicio_preparacao_ns
             
-            offset_para_enviar = -1
+            offset_para_enviar = interpretar_resposta_preparacao(resposta_servidor_str)
 
-            if resposta_servidor_str == "FILE_ALREADY_EXISTS_CHECKSUM_OK":
+            if offset_para_enviar is None:
                 logger_texto.info(f"Servidor informou que '{caminho_relativo_arquivo}' já existe e está OK. Pulando.")
-                registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, ALGORITMO_CHECKSUM_PADRAO, checksum_hex_calculado, 0, 0, resposta_servidor_str, "SKIPPED_ALREADY_EXISTS", tempo_evento=timestamp_inicio_envio_arquivo)
+                registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, algoritmo_checksum_global, checksum_hex_calculado, 0, 0, resposta_servidor_str, "SKIPPED_ALREADY_EXISTS", tempo_evento=timestamp_inicio_envio_arquivo, tempos_ns=tempos_ns)
                 continue 
-            elif resposta_servidor_str.startswith("RESUME_FROM_OFFSET:"):
-                offset_para_enviar = int(resposta_servidor_str.split(":", 1)[1])
+            elif offset_para_enviar > 0:
                 logger_texto.info(f"Servidor instruiu a retomar '{caminho_relativo_arquivo}' do byte {offset_para_enviar}.")
-            elif resposta_servidor_str == "SEND_FROM_OFFSET:0":
-                offset_para_enviar = 0
+            elif offset_para_enviar == 0:
                 logger_texto.info(f"Servidor instruiu a enviar '{caminho_relativo_arquivo}' desde o início.")
             else:
                 logger_texto.error(f"Resposta inesperada do servidor ao preparar arquivo '{caminho_relativo_arquivo}': {resposta_servidor_str}")
-                registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, ALGORITMO_CHECKSUM_PADRAO, checksum_hex_calculado, 0, 0, resposta_servidor_str, "FAIL_UNEXPECTED_PREPARE_RESPONSE", detalhes_erro=resposta_servidor_str, tempo_evento=timestamp_inicio_envio_arquivo)
+                registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, algoritmo_checksum_global, checksum_hex_calculado, 0, 0, resposta_servidor_str, "FAIL_UNEXPECTED_PREPARE_RESPONSE", detalhes_erro=resposta_servidor_str, tempo_evento=timestamp_inicio_envio_arquivo)
                 continue
 
             if offset_para_enviar >= 0:
-                socket_cliente.sendall(f"START_FILE_DATA:{caminho_relativo_arquivo}".encode('utf-8'))
-                ack_inicio_dados = socket_cliente.recv(TAMANHO_BUFFER)
+                canal_servidor.enviar_mensagem(f"START_FILE_DATA:{caminho_relativo_arquivo}".encode('utf-8'))
+                ack_inicio_dados = canal_servidor.receber_mensagem()
                 if ack_inicio_dados != b"ACK_START_FILE_DATA":
                     logger_texto.error(f"Servidor não confirmou início do envio de dados para '{caminho_relativo_arquivo}'.")
                     continue
                 
-                inicio_envio_dados_ts = time.time()
-                sucesso_envio_dados = enviar_dados_arquivo(socket_cliente, caminho_completo_arquivo, offset_para_enviar, tamanho_arquivo_bytes)
-                fim_envio_dados_ts = time.time()
-                duracao_envio = fim_envio_dados_ts - inicio_envio_dados_ts
+                inicio_envio_dados_ns = time.perf_counter_ns()
+                sucesso_envio_dados = enviar_dados_arquivo(canal_servidor, caminho_completo_arquivo, offset_para_enviar, tamanho_arquivo_bytes)
+                fim_envio_dados_ns = time.perf_counter_ns()
+                tempos_ns["send_ns"] = fim_envio_dados_ns - inicio_envio_dados_ns
+                duracao_envio = tempos_ns["send_ns"] / 1e9
                 
                 velocidade_envio_kbps = 0
                 bytes_enviados_sessao = tamanho_arquivo_bytes - offset_para_enviar
@@ -189,71 +1051,771 @@ def enviar_pasta(socket_cliente, caminho_pasta_origem, endereco_servidor_str):
                     velocidade_envio_kbps = (bytes_enviados_sessao / 1024) / duracao_envio
 
                 if sucesso_envio_dados:
-                    status_final_servidor = socket_cliente.recv(TAMANHO_BUFFER).decode('utf-8', 'ignore')
+                    status_final_servidor = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+                    tempos_ns["server_verify_ns"] = time.perf_counter_ns() - fim_envio_dados_ns
                     logger_texto.info(f"Status final do servidor para '{caminho_relativo_arquivo}': {status_final_servidor}")
                     
-                    status_cliente_bd = "UNKNOWN"
-                    if status_final_servidor == "FILE_CHECKSUM_OK":
-                        status_cliente_bd = "SUCCESS_SENT_SERVER_OK"
-                    elif status_final_servidor == "FILE_CHECKSUM_MISMATCH":
-                        status_cliente_bd = "SUCCESS_SENT_SERVER_CHECKSUM_FAIL"
-                    else:
-                        status_cliente_bd = f"FAIL_SERVER_REPORTED_ERROR_{status_final_servidor}"
-                    
-                    registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, ALGORITMO_CHECKSUM_PADRAO, checksum_hex_calculado, duracao_envio, velocidade_envio_kbps, status_final_servidor, status_cliente_bd, tempo_evento=timestamp_inicio_envio_arquivo)
+                    status_cliente_bd = status_cliente_para_resposta_final(status_final_servidor)
+                    registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, algoritmo_checksum_global, checksum_hex_calculado, duracao_envio, velocidade_envio_kbps, status_final_servidor, status_cliente_bd, tempo_evento=timestamp_inicio_envio_arquivo, tempos_ns=tempos_ns)
                 else:
                     logger_texto.error(f"Falha local ao enviar dados do arquivo '{caminho_relativo_arquivo}'.")
-                    registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, ALGORITMO_CHECKSUM_PADRAO, checksum_hex_calculado, duracao_envio, 0, "N/A", "FAIL_LOCAL_SEND_DATA", "Falha na função enviar_dados_arquivo", tempo_evento=timestamp_inicio_envio_arquivo)
+                    registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, caminho_completo_arquivo, caminho_relativo_arquivo, tamanho_arquivo_bytes, algoritmo_checksum_global, checksum_hex_calculado, duracao_envio, 0, "N/A", "FAIL_LOCAL_SEND_DATA", "Falha na função enviar_dados_arquivo", tempo_evento=timestamp_inicio_envio_arquivo, tempos_ns=tempos_ns)
 
+    canal_servidor.enviar_mensagem(b"END_FOLDER_TRANSFER")
+    return canal_servidor.receber_mensagem()
 
-    socket_cliente.sendall(b"END_FOLDER_TRANSFER")
-    ack_fim_pasta = socket_cliente.recv(TAMANHO_BUFFER)
-    if ack_fim_pasta == b"ACK_END_FOLDER":
-        logger_texto.info(f"Servidor confirmou fim do processamento da pasta '{nome_pasta_base}'.")
+def ler_respostas_servidor(canal_servidor, fila_respostas, fila_status):
+    # Thread leitora do modo em lotes: FILE_STATUS chega de forma assíncrona, o resto vai para quem está esperando resposta
+    try:
+        while True:
+            mensagem = canal_servidor.receber_mensagem()
+            if not mensagem:
+                break
+            if mensagem.startswith(b"FILE_STATUS:"):
+                fila_status.put((mensagem.decode('utf-8', 'ignore'), time.perf_counter_ns())) # Chegada do status: fim da verificação no servidor
+                continue
+            fila_respostas.put(mensagem)
+            if mensagem == b"ACK_END_FOLDER":
+                return
+    except Exception as e:
+        logger_texto.error(f"Erro lendo respostas do servidor: {e}")
+    fila_respostas.put(b"")
+
+def aguardar_resposta_servidor(fila_respostas):
+    resposta = fila_respostas.get()
+    if not resposta:
+        raise ConnectionAbortedError("Conexão com o servidor perdida durante a transferência em lotes.")
+    return resposta
+
+def registrar_status_recebidos(conexao_bd, fila_status, envios_pendentes, endereco_servidor_str):
+    while True:
+        try:
+            mensagem_status, chegada_status_ns = fila_status.get_nowait()
+        except queue.Empty:
+            return
+        _, status_final_servidor, caminho_relativo_arquivo = mensagem_status.split(":", 2)
+        envio = envios_pendentes.pop(caminho_relativo_arquivo, None)
+        if not envio:
+            logger_texto.warning(f"Status recebido para arquivo não pendente '{caminho_relativo_arquivo}': {status_final_servidor}")
+            continue
+        logger_texto.info(f"Status final do servidor para '{caminho_relativo_arquivo}': {status_final_servidor}")
+        tempos_ns = dict(envio["tempos_ns"], server_verify_ns=chegada_status_ns - envio["fim_envio_ns"])
+        registrar_envio_arquivo_cliente_bd(conexao_bd, endereco_servidor_str, envio["origem"], caminho_relativo_arquivo, envio["tamanho"], algoritmo_checksum_global, envio["checksum"], envio["duracao"], envio["velocidade"], status_final_servidor, status_cliente_para_resposta_final(status_final_servidor), tempo_evento=envio["inicio"], tempos_ns=tempos_ns)
+
+def processar_lote_manifesto(canal_servidor, conexao_bd, fila_respostas, fila_status, pastas_lote, arquivos_lote, envios_pendentes, endereco_servidor_str):
+    manifesto = {
+        "delta": USAR_TRANSFERENCIA_DELTA,
+        "folders": pastas_lote,
+        "files": [{"path": a["relativo"], "size": a["tamanho"], "algorithm": algoritmo_checksum_global, "checksum": a["checksum"], "fingerprint": a["impressao"]} for a in arquivos_lote],
+    }
+    inicio_preparacao_ns = time.perf_counter_ns()
+    canal_servidor.enviar_mensagem("PREPARE_FILE_BATCH:" + json.dumps(manifesto))
+    resposta_lote = aguardar_resposta_servidor(fila_respostas).decode('utf-8', 'ignore')
+    tempo_preparacao_por_arquivo_ns = (time.perf_counter_ns() - inicio_preparacao_ns) // max(1, len(arquivos_lote))
+    if not resposta_lote.startswith("BATCH_DECISIONS:"):
+        raise ErroProtocolo(f"Resposta inesperada ao manifesto em lote: {resposta_lote[:200]}")
+    decisoes = json.loads(resposta_lote.split(":", 1)[1])
+    if len(decisoes) != len(arquivos_lote):
+        raise ErroProtocolo(f"Servidor devolveu {len(decisoes)} decisões para {len(arquivos_lote)} arquivos.")
+
+    for arquivo, resposta_servidor_str in zip(arquivos_lote, decisoes):
+        arquivo = dict(arquivo, tempos_ns=dict(arquivo["tempos_ns"], prepare_ns=tempo_preparacao_por_arquivo_ns))
+        caminho_relativo_arquivo = arquivo["relativo"]
+        if resposta_servidor_str.startswith("SEND_DELTA:"):
+            # As assinaturas chegam logo depois das decisões, uma mensagem por arquivo e na mesma ordem
+            mensagem_assinaturas = aguardar_resposta_servidor(fila_respostas).decode('utf-8', 'ignore')
+            if not mensagem_assinaturas.startswith("DELTA_SIGNATURES:"):
+                raise ErroProtocolo(f"Assinaturas delta esperadas para '{caminho_relativo_arquivo}': {mensagem_assinaturas[:200]}")
+            assinaturas = json.loads(mensagem_assinaturas.split(":", 1)[1])
+            logger_texto.info(f"Servidor tem uma versão anterior de '{caminho_relativo_arquivo}'. Enviando delta.")
+            bytes_enviados_sessao = arquivo["tamanho"]
+            canal_servidor.enviar_mensagem(f"START_FILE_DELTA:{caminho_relativo_arquivo}")
+            hasheador_envio = criar_hasheador(algoritmo_checksum_global)
+            inicio_envio_dados_ns = time.perf_counter_ns()
+            sucesso_envio_dados = enviar_delta_arquivo(canal_servidor, arquivo["origem"], assinaturas, hasheador_envio)
+            if sucesso_envio_dados and arquivo["checksum"] is None:
+                arquivo = dict(arquivo, checksum=hasheador_envio.hexdigest())
+                guardar_checksum_em_cache_bd(conexao_bd, arquivo["origem"], algoritmo_checksum_global, arquivo["info"], arquivo["checksum"])
+            concluir_envio_pipeline(conexao_bd, fila_status, arquivo, sucesso_envio_dados, bytes_enviados_sessao, inicio_envio_dados_ns, envios_pendentes, endereco_servidor_str)
+            continue
+
+        offset_para_enviar = interpretar_resposta_preparacao(resposta_servidor_str)
+        if offset_para_enviar is None:
+            logger_texto.info(f"Servidor informou que '{caminho_relativo_arquivo}' já existe e está OK. Pulando.")
+            registrar_envio_arquivo_cliente_bd(conexao_bd, endereco_servidor_str, arquivo["origem"], caminho_relativo_arquivo, arquivo["tamanho"], algoritmo_checksum_global, arquivo["checksum"], 0, 0, resposta_servidor_str, "SKIPPED_ALREADY_EXISTS", tempo_evento=arquivo["inicio"], tempos_ns=arquivo["tempos_ns"])
+            continue
+        elif offset_para_enviar < 0:
+            logger_texto.error(f"Resposta inesperada do servidor ao preparar arquivo '{caminho_relativo_arquivo}': {resposta_servidor_str}")
+            registrar_envio_arquivo_cliente_bd(conexao_bd, endereco_servidor_str, arquivo["origem"], caminho_relativo_arquivo, arquivo["tamanho"], algoritmo_checksum_global, arquivo["checksum"], 0, 0, resposta_servidor_str, "FAIL_UNEXPECTED_PREPARE_RESPONSE", detalhes_erro=resposta_servidor_str, tempo_evento=arquivo["inicio"])
+            continue
+
+        bytes_enviados_sessao = arquivo["tamanho"] - offset_para_enviar
+        codec_compressao = escolher_codec_compressao(canal_servidor, arquivo["origem"], offset_para_enviar, arquivo["tamanho"])
+        if codec_compressao:
+            canal_servidor.enviar_mensagem(f"START_FILE_DATA_COMPRESSED:{codec_compressao}:{offset_para_enviar}:{bytes_enviados_sessao}:{caminho_relativo_arquivo}")
+        else:
+            canal_servidor.enviar_mensagem(f"START_FILE_DATA_PIPELINED:{offset_para_enviar}:{bytes_enviados_sessao}:{caminho_relativo_arquivo}")
+        hasheador_envio = criar_hasheador(algoritmo_checksum_global) if arquivo["checksum"] is None else None
+        inicio_envio_dados_ns = time.perf_counter_ns()
+        sucesso_envio_dados = enviar_dados_arquivo(canal_servidor, arquivo["origem"], offset_para_enviar, arquivo["tamanho"], hasheador_envio, codec_compressao)
+        if sucesso_envio_dados and hasheador_envio is not None:
+            arquivo = dict(arquivo, checksum=hasheador_envio.hexdigest())
+            canal_servidor.enviar_mensagem(f"FILE_CHECKSUM_TRAILER:{arquivo['checksum']}")
+            guardar_checksum_em_cache_bd(conexao_bd, arquivo["origem"], algoritmo_checksum_global, arquivo["info"], arquivo["checksum"])
+        concluir_envio_pipeline(conexao_bd, fila_status, arquivo, sucesso_envio_dados, bytes_enviados_sessao, inicio_envio_dados_ns, envios_pendentes, endereco_servidor_str)
+
+def concluir_envio_pipeline(conexao_bd, fila_status, arquivo, sucesso_envio_dados, bytes_enviados_sessao, inicio_envio_dados_ns, envios_pendentes, endereco_servidor_str):
+    caminho_relativo_arquivo = arquivo["relativo"]
+    fim_envio_dados_ns = time.perf_counter_ns()
+    tempos_ns = dict(arquivo["tempos_ns"], send_ns=fim_envio_dados_ns - inicio_envio_dados_ns)
+    duracao_envio = tempos_ns["send_ns"] / 1e9
+    if not sucesso_envio_dados:
+        logger_texto.error(f"Falha local ao enviar dados do arquivo '{caminho_relativo_arquivo}'.")
+        registrar_envio_arquivo_cliente_bd(conexao_bd, endereco_servidor_str, arquivo["origem"], caminho_relativo_arquivo, arquivo["tamanho"], algoritmo_checksum_global, arquivo["checksum"], duracao_envio, 0, "N/A", "FAIL_LOCAL_SEND_DATA", "Falha na função enviar_dados_arquivo", tempo_evento=arquivo["inicio"], tempos_ns=tempos_ns)
+        # O servidor espera um número exato de bytes (ou o fim do delta): sem eles o fluxo fica dessincronizado
+        raise ErroProtocolo(f"Fluxo de dados de '{caminho_relativo_arquivo}' interrompido.")
+
+    velocidade_envio_kbps = (bytes_enviados_sessao / 1024) / duracao_envio if duracao_envio > 0 else 0
+    envios_pendentes[caminho_relativo_arquivo] = dict(arquivo, duracao=duracao_envio, velocidade=velocidade_envio_kbps, tempos_ns=tempos_ns, fim_envio_ns=fim_envio_dados_ns)
+    registrar_status_recebidos(conexao_bd, fila_status, envios_pendentes, endereco_servidor_str)
+
+def montar_entrada_manifesto(conexao_bd, caminho_completo_arquivo, caminho_relativo_arquivo, info_arquivo=None, checksum_hex_calculado=None, tempo_checksum_ns=0):
+    # tempo_checksum_ns: o que quem chama já gastou obtendo checksum_hex_calculado (espera pelo pool, cálculo na varredura)
+    timestamp_inicio_envio_arquivo = time.strftime('%Y-%m-%d %H:%M:%S')
+    inicio_checksum_ns = time.perf_counter_ns()
+    try:
+        if info_arquivo is None:
+            info_arquivo = os.stat(caminho_completo_arquivo)
+    except OSError as e:
+        logger_texto.error(f"Não foi possível ler metadados de '{caminho_completo_arquivo}': {e}. Arquivo ignorado.")
+        return None
+    # Arquivo inalterado desde o último cálculo: o checksum do cache dispensa ler o conteúdo
+    if not checksum_hex_calculado:
+        checksum_hex_calculado = obter_checksum_em_cache_bd(conexao_bd, caminho_completo_arquivo, algoritmo_checksum_global, info_arquivo)
+    impressao_rapida = None
+    if not checksum_hex_calculado:
+        if MODO_CHECKSUM_TRAILER:
+            # A impressão não depende do algoritmo negociado: trocar de algoritmo não invalida o que o servidor já registrou
+            impressao_rapida = calcular_impressao_rapida(caminho_completo_arquivo, ALGORITMO_CHECKSUM_PADRAO)
+        else:
+            checksum_hex_calculado = calcular_checksum_com_cache(conexao_bd, caminho_completo_arquivo, algoritmo_checksum_global)
+    if not checksum_hex_calculado and not impressao_rapida:
+        logger_texto.error(f"Não foi possível calcular checksum para '{caminho_completo_arquivo}'. Arquivo ignorado.")
+        return None
+    tempo_checksum_ns += time.perf_counter_ns() - inicio_checksum_ns
+    return {"origem": caminho_completo_arquivo, "relativo": caminho_relativo_arquivo, "tamanho": info_arquivo.st_size, "info": info_arquivo,
+            "checksum": checksum_hex_calculado, "impressao": impressao_rapida, "inicio": timestamp_inicio_envio_arquivo, "tempos_ns": {"checksum_ns": tempo_checksum_ns}}
+
+class PreVarredura:
+    # Varre a árvore numa thread própria enquanto o envio consome as entradas prontas, na ordem da árvore, por uma fila
+    # limitada. Checksums completos que faltam no cache são calculados pelo pool de processos; uma entrada à espera do
+    # pool segura as seguintes, e quem consome só bloqueia no checksum do próximo arquivo.
+    def __init__(self, caminho_pasta_origem, calcular_checksums):
+        self.calcular_checksums = calcular_checksums
+        self.fila = queue.Queue(maxsize=MAXIMO_ENTRADAS_PRE_VARREDURA)
+        self.encerrada = threading.Event()
+        self.pool = criar_pool_checksums() if calcular_checksums else None
+        self.thread = threading.Thread(target=self._varrer, args=(caminho_pasta_origem,), name="PreVarredura", daemon=True)
+        self.thread.start()
+
+    def _montar_com_checksum(self, conexao_bd, origem, relativo, info_arquivo, checksum_hex, tempo_checksum_ns):
+        if not checksum_hex:
+            logger_texto.error(f"Não foi possível calcular checksum para '{origem}'. Arquivo ignorado.")
+            return None
+        return montar_entrada_manifesto(conexao_bd, origem, relativo, info_arquivo, checksum_hex, tempo_checksum_ns)
+
+    def _colocar(self, item):
+        while not self.encerrada.is_set():
+            try:
+                self.fila.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _liberar_retidos(self, retidos, pendentes):
+        if pendentes:
+            futuros_checksums = submeter_checksums(self.pool, [(e["origem"], e["info"].st_size) for e in pendentes], algoritmo_checksum_global)
+            for entrada in pendentes:
+                entrada["futuro"] = futuros_checksums.get(entrada["origem"])
+        for item in retidos:
+            self._colocar(item)
+        retidos.clear()
+        pendentes.clear()
+
+    def _varrer(self, caminho_pasta_origem):
+        conexao_bd = abrir_conexao_bd(ARQUIVO_BD_CLIENTE)
+        retidos, pendentes = [], []
+        try:
+            for pastas, arquivos in varrer_arvore(caminho_pasta_origem):
+                retidos.append((pastas, None))
+                for origem, relativo, info_arquivo in arquivos:
+                    if self.encerrada.is_set():
+                        return
+                    if not self.calcular_checksums:
+                        entrada = montar_entrada_manifesto(conexao_bd, origem, relativo, info_arquivo)
+                    else:
+                        inicio_checksum_ns = time.perf_counter_ns()
+                        checksum_hex = obter_checksum_em_cache_bd(conexao_bd, origem, algoritmo_checksum_global, info_arquivo)
+                        if not checksum_hex and self.pool is not None:
+                            entrada = {"origem": origem, "relativo": relativo, "info": info_arquivo, "futuro": None}
+                            pendentes.append(entrada)
+                        else:
+                            checksum_hex = checksum_hex or calcular_checksum_com_cache(conexao_bd, origem, algoritmo_checksum_global)
+                            entrada = self._montar_com_checksum(conexao_bd, origem, relativo, info_arquivo, checksum_hex, time.perf_counter_ns() - inicio_checksum_ns)
+                    if entrada is not None:
+                        retidos.append(([], entrada))
+                    if (not pendentes or len(pendentes) >= MAXIMO_ARQUIVOS_TAREFA_CHECKSUM or len(retidos) >= TAMANHO_LOTE_MANIFESTO
+                            or sum(e["info"].st_size for e in pendentes) >= MAXIMO_BYTES_TAREFA_CHECKSUM):
+                        self._liberar_retidos(retidos, pendentes)
+            self._liberar_retidos(retidos, pendentes)
+        except Exception as e:
+            logger_texto.error(f"Pré-varredura de '{caminho_pasta_origem}' falhou: {e}", exc_info=True)
+        finally:
+            self._colocar(None)
+            conexao_bd.close()
+
+    def entradas(self, conexao_bd):
+        # Gera (pastas, entrada do manifesto ou None) na ordem da árvore
+        try:
+            while (item := self.fila.get()) is not None:
+                pastas, entrada = item
+                if entrada is not None and "futuro" in entrada:
+                    inicio_checksum_ns = time.perf_counter_ns()
+                    checksum_hex = (obter_checksum_de_processo(conexao_bd, entrada["futuro"], entrada["origem"], entrada["info"])
+                                    or calcular_checksum_com_cache(conexao_bd, entrada["origem"], algoritmo_checksum_global))
+                    entrada = self._montar_com_checksum(conexao_bd, entrada["origem"], entrada["relativo"], entrada["info"], checksum_hex, time.perf_counter_ns() - inicio_checksum_ns)
+                    if entrada is None:
+                        continue
+                yield pastas, entrada
+        finally:
+            self.encerrar()
+
+    def encerrar(self):
+        self.encerrada.set()
+        self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+def gerar_lotes_da_arvore(conexao_bd, caminho_pasta_origem):
+    pastas_lote, arquivos_lote = [], []
+    # Com checksum no trailer a varredura só consulta o cache e tira impressões; os checksums completos ficam para o envio
+    for pastas, entrada_manifesto in PreVarredura(caminho_pasta_origem, not MODO_CHECKSUM_TRAILER).entradas(conexao_bd):
+        pastas_lote.extend(pastas)
+        if entrada_manifesto:
+            arquivos_lote.append(entrada_manifesto)
+        if len(arquivos_lote) >= TAMANHO_LOTE_MANIFESTO:
+            yield pastas_lote, arquivos_lote
+            pastas_lote, arquivos_lote = [], []
+
+    if pastas_lote or arquivos_lote:
+        yield pastas_lote, arquivos_lote
+
+def transmitir_lotes(canal_servidor, conexao_bd, lotes, endereco_servidor_str):
+    # Protocolo de quadros: um manifesto por lote, dados em sequência sem esperar ACK e status recebidos em segundo plano
+    fila_respostas = queue.Queue()
+    fila_status = queue.Queue()
+    envios_pendentes = {}
+    thread_leitora = threading.Thread(target=ler_respostas_servidor, args=(canal_servidor, fila_respostas, fila_status), daemon=True)
+    thread_leitora.start()
+
+    for pastas_lote, arquivos_lote in lotes:
+        processar_lote_manifesto(canal_servidor, conexao_bd, fila_respostas, fila_status, pastas_lote, arquivos_lote, envios_pendentes, endereco_servidor_str)
+
+    canal_servidor.enviar_mensagem(b"END_FOLDER_TRANSFER")
+    ack_fim_pasta = fila_respostas.get()
+    thread_leitora.join()
+    # Todos os FILE_STATUS chegam antes do ACK_END_FOLDER
+    registrar_status_recebidos(conexao_bd, fila_status, envios_pendentes, endereco_servidor_str)
+    for caminho_relativo_arquivo, envio in envios_pendentes.items():
+        logger_texto.error(f"Servidor não enviou status final para '{caminho_relativo_arquivo}'.")
+        registrar_envio_arquivo_cliente_bd(conexao_bd, endereco_servidor_str, envio["origem"], caminho_relativo_arquivo, envio["tamanho"], algoritmo_checksum_global, envio["checksum"], envio["duracao"], envio["velocidade"], "N/A", "FAIL_NO_SERVER_STATUS", tempo_evento=envio["inicio"], tempos_ns=envio["tempos_ns"])
+    return ack_fim_pasta
+
+def enviar_arquivos_em_lotes(canal_servidor, caminho_pasta_origem, endereco_servidor_str):
+    return transmitir_lotes(canal_servidor, conexao_bd_cliente_global, gerar_lotes_da_arvore(conexao_bd_cliente_global, caminho_pasta_origem), endereco_servidor_str)
+
+class FilaRoubaTrabalho:
+    # Uma deque por conexão, cada uma ordenada do maior para o menor arquivo. Metade das conexões começa pelos
+    # arquivos grandes e a outra metade pelos pequenos, que preenchem as lacunas enquanto os grandes trafegam.
+    # Quem esvazia a própria deque rouba os menores arquivos da deque com mais bytes pendentes.
+    def __init__(self, arquivos, numero_trabalhadores):
+        self.trava = threading.Lock()
+        self.deques = [deque() for _ in range(numero_trabalhadores)]
+        self.bytes_pendentes = [0] * numero_trabalhadores
+        for posicao, arquivo in enumerate(sorted(arquivos, key=lambda a: a[2].st_size, reverse=True)):
+            indice = posicao % numero_trabalhadores
+            self.deques[indice].append(arquivo)
+            self.bytes_pendentes[indice] += arquivo[2].st_size
+
+    def _retirar(self, indice, do_inicio):
+        arquivo = self.deques[indice].popleft() if do_inicio else self.deques[indice].pop()
+        self.bytes_pendentes[indice] -= arquivo[2].st_size
+        return arquivo
+
+    def obter_lote(self, indice, maximo_arquivos, maximo_bytes):
+        lote, bytes_lote = [], 0
+        prefere_grandes = indice % 2 == 0
+        with self.trava:
+            while len(lote) < maximo_arquivos and bytes_lote < maximo_bytes:
+                if self.deques[indice]:
+                    arquivo = self._retirar(indice, prefere_grandes)
+                else:
+                    vitima = max(range(len(self.deques)), key=lambda i: self.bytes_pendentes[i] if self.deques[i] else -1)
+                    if not self.deques[vitima]:
+                        break
+                    arquivo = self._retirar(vitima, False)
+                lote.append(arquivo)
+                bytes_lote += arquivo[2].st_size
+        return lote
+
+def gerar_lotes_da_fila(conexao_bd, fila_trabalho, indice, pastas_iniciais, futuros_checksums):
+    pastas_lote = pastas_iniciais
+    while True:
+        arquivos_fila = fila_trabalho.obter_lote(indice, TAMANHO_LOTE_MANIFESTO, MAXIMO_BYTES_LOTE_PARALELO)
+        if not arquivos_fila:
+            break
+        arquivos_lote = []
+        for origem, relativo, info in arquivos_fila:
+            inicio_checksum_ns = time.perf_counter_ns()
+            checksum_hex = obter_checksum_de_processo(conexao_bd, futuros_checksums.pop(origem, None), origem, info)
+            entrada = montar_entrada_manifesto(conexao_bd, origem, relativo, info, checksum_hex, time.perf_counter_ns() - inicio_checksum_ns)
+            if entrada:
+                arquivos_lote.append(entrada)
+        yield pastas_lote, arquivos_lote
+        pastas_lote = []
+    if pastas_lote:
+        yield pastas_lote, []
+
+def abrir_canal_servidor():
+    socket_extra = socket.create_connection((ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR))
+    canal_extra = CanalMensagens(socket_extra, balde_envio=balde_envio_global)
+    if not negociar_protocolo(canal_extra):
+        socket_extra.close()
+        raise ErroProtocolo("Conexão adicional não negociou o protocolo de quadros.")
+    apresentar_cliente(canal_extra)
+    negociar_compressao(canal_extra)
+    return canal_extra
+
+def entrar_sessao_pasta_servidor(canal_servidor, id_sessao_pasta, nome_pasta_base):
+    canal_servidor.enviar_mensagem(f"START_FOLDER_TRANSFER_SESSION:{id_sessao_pasta}:{nome_pasta_base}")
+    ack_inicio_pasta = canal_servidor.receber_mensagem()
+    if ack_inicio_pasta != b"ACK_START_FOLDER":
+        raise ErroProtocolo(f"Servidor não confirmou entrada na sessão de pasta: {ack_inicio_pasta.decode('utf-8', 'ignore')}")
+
+# Conexões paralelas que terminaram uma pasta limpas (ACK_END_FOLDER) ficam abertas para a próxima pasta do mesmo processo
+canais_paralelos_ociosos = []
+trava_canais_paralelos = threading.Lock()
+
+def abrir_canal_paralelo_na_sessao(id_sessao_pasta, nome_pasta_base):
+    while True:
+        with trava_canais_paralelos:
+            canal_servidor = canais_paralelos_ociosos.pop() if canais_paralelos_ociosos else None
+        if canal_servidor is None:
+            break
+        try:
+            entrar_sessao_pasta_servidor(canal_servidor, id_sessao_pasta, nome_pasta_base)
+            return canal_servidor
+        except (OSError, ErroProtocolo) as e:
+            logger_texto.info(f"Conexão paralela ociosa não respondeu ({e}); abrindo outra.")
+            canal_servidor.sock.close()
+    canal_servidor = abrir_canal_servidor()
+    entrar_sessao_pasta_servidor(canal_servidor, id_sessao_pasta, nome_pasta_base)
+    return canal_servidor
+
+def fechar_canais_paralelos_ociosos():
+    with trava_canais_paralelos:
+        canais_para_fechar = canais_paralelos_ociosos[:]
+        canais_paralelos_ociosos.clear()
+    for canal_servidor in canais_para_fechar:
+        canal_servidor.sock.close()
+
+def registrar_fim_arquivo_em_pedacos(conexao_bd, arquivo, resposta_servidor_str, endereco_servidor_str):
+    # Pedaços vão por várias conexões ao mesmo tempo: a duração é do plano até a finalização, sem separar as fases
+    duracao_envio = (time.perf_counter_ns() - arquivo["inicio_ns"]) / 1e9
+    velocidade_envio_kbps = (arquivo["bytes_a_enviar"] / 1024) / duracao_envio if duracao_envio > 0 else 0
+    registrar_envio_arquivo_cliente_bd(conexao_bd, endereco_servidor_str, arquivo["origem"], arquivo["relativo"], arquivo["tamanho"], algoritmo_checksum_global, arquivo["checksum"], duracao_envio, velocidade_envio_kbps, resposta_servidor_str, status_cliente_para_resposta_final(resposta_servidor_str), tempo_evento=arquivo["inicio"], tempos_ns=arquivo["tempos_ns"])
+
+def preparar_arquivo_em_pedacos(canal_servidor, origem, relativo, info_arquivo, fila_pedacos, endereco_servidor_str, futuros_checksums):
+    # O checksum do arquivo inteiro vai na preparação: o servidor só consegue conferi-lo depois de juntar os pedaços
+    timestamp_inicio_envio_arquivo = time.strftime('%Y-%m-%d %H:%M:%S')
+    inicio_checksum_ns = time.perf_counter_ns()
+    checksum_hex_calculado = (obter_checksum_de_processo(conexao_bd_cliente_global, futuros_checksums.pop(origem, None), origem, info_arquivo)
+                              or calcular_checksum_com_cache(conexao_bd_cliente_global, origem, algoritmo_checksum_global))
+    if not checksum_hex_calculado:
+        logger_texto.error(f"Não foi possível calcular checksum para '{origem}'. Arquivo ignorado.")
+        return None
+    inicio_preparacao_ns = time.perf_counter_ns()
+    pedido_pedacos = {"path": relativo, "size": info_arquivo.st_size, "algorithm": algoritmo_checksum_global, "checksum": checksum_hex_calculado, "chunk_size": TAMANHO_PEDACO}
+    canal_servidor.enviar_mensagem("PREPARE_CHUNKED_FILE:" + json.dumps(pedido_pedacos))
+    resposta_servidor_str = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+    fim_preparacao_ns = time.perf_counter_ns()
+    arquivo = {"origem": origem, "relativo": relativo, "tamanho": info_arquivo.st_size, "checksum": checksum_hex_calculado, "inicio": timestamp_inicio_envio_arquivo, "inicio_ns": fim_preparacao_ns,
+               "tempos_ns": {"checksum_ns": inicio_preparacao_ns - inicio_checksum_ns, "prepare_ns": fim_preparacao_ns - inicio_preparacao_ns}}
+    if not resposta_servidor_str.startswith("CHUNK_PLAN:"):
+        status_cliente = "SKIPPED_ALREADY_EXISTS" if resposta_servidor_str.startswith("FILE_ALREADY_EXISTS") else "FAIL_UNEXPECTED_PREPARE_RESPONSE"
+        logger_texto.info(f"Servidor respondeu '{resposta_servidor_str}' para '{relativo}' em pedaços.")
+        registrar_envio_arquivo_cliente_bd(conexao_bd_cliente_global, endereco_servidor_str, origem, relativo, arquivo["tamanho"], algoritmo_checksum_global, checksum_hex_calculado, 0, 0, resposta_servidor_str, status_cliente, tempo_evento=timestamp_inicio_envio_arquivo, tempos_ns=arquivo["tempos_ns"])
+        return None
+
+    plano_pedacos = json.loads(resposta_servidor_str.split(":", 1)[1])
+    arquivo["id"] = plano_pedacos["id"]
+    arquivo["pedacos_restantes"] = len(plano_pedacos["missing"])
+    arquivo["bytes_a_enviar"] = sum(min(TAMANHO_PEDACO, arquivo["tamanho"] - i * TAMANHO_PEDACO) for i in plano_pedacos["missing"])
+    logger_texto.info(f"'{relativo}' será enviado em pedaços: faltam {len(plano_pedacos['missing'])}.")
+    for indice_pedaco in plano_pedacos["missing"]:
+        fila_pedacos.put((arquivo, indice_pedaco))
+    return arquivo
+
+def finalizar_arquivo_em_pedacos(canal_servidor, conexao_bd, arquivo, endereco_servidor_str):
+    canal_servidor.enviar_mensagem(f"FINALIZE_CHUNKED_FILE:{arquivo['id']}")
+    resposta_final = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+    status_final_servidor = resposta_final.split(":", 1)[1] if resposta_final.startswith("CHUNKED_FILE_STATUS:") else resposta_final
+    logger_texto.info(f"Status final do servidor para '{arquivo['relativo']}' (em pedaços): {status_final_servidor}")
+    registrar_fim_arquivo_em_pedacos(conexao_bd, arquivo, status_final_servidor, endereco_servidor_str)
+
+def enviar_pedacos_pendentes(canal_servidor, conexao_bd, fila_pedacos, trava_pedacos, endereco_servidor_str):
+    # Um pedaço por vez em cada conexão; quem envia o último pedaço de um arquivo pede a finalização
+    while True:
+        try:
+            arquivo, indice_pedaco = fila_pedacos.get_nowait()
+        except queue.Empty:
+            return
+        offset_pedaco = indice_pedaco * TAMANHO_PEDACO
+        tamanho_pedaco = min(TAMANHO_PEDACO, arquivo["tamanho"] - offset_pedaco)
+        canal_servidor.enviar_mensagem(f"START_CHUNK_DATA:{arquivo['id']}:{indice_pedaco}:{tamanho_pedaco}")
+        if not enviar_dados_arquivo(canal_servidor, arquivo["origem"], offset_pedaco, offset_pedaco + tamanho_pedaco):
+            raise ErroProtocolo(f"Fluxo do pedaço {indice_pedaco} de '{arquivo['relativo']}' interrompido.")
+        resposta_pedaco = canal_servidor.receber_mensagem().decode('utf-8', 'ignore')
+        if not resposta_pedaco.startswith("CHUNK_STATUS:CHUNK_OK:"):
+            logger_texto.error(f"Servidor recusou o pedaço {indice_pedaco} de '{arquivo['relativo']}': {resposta_pedaco}")
+            if not resposta_pedaco.startswith("CHUNK_STATUS:") or resposta_pedaco.startswith("CHUNK_STATUS:CHUNK_DATA_ERROR:"):
+                raise ErroProtocolo(f"Sessão encerrada após erro no pedaço {indice_pedaco} de '{arquivo['relativo']}'.")
+            continue
+        with trava_pedacos:
+            arquivo["pedacos_restantes"] -= 1
+            ultimo_pedaco = arquivo["pedacos_restantes"] == 0
+        if ultimo_pedaco:
+            finalizar_arquivo_em_pedacos(canal_servidor, conexao_bd, arquivo, endereco_servidor_str)
+
+def trabalhador_envio_paralelo(indice, canal_servidor, fila_trabalho, fila_pedacos, trava_pedacos, id_sessao_pasta, nome_pasta_base, pastas_iniciais, futuros_checksums, endereco_servidor_str, resultados):
+    # A conexão principal (índice 0) já chega dentro da sessão de pasta
+    conexao_bd = conexao_bd_cliente_global if indice == 0 else abrir_conexao_bd(ARQUIVO_BD_CLIENTE)
+    try:
+        if canal_servidor is None:
+            canal_servidor = abrir_canal_paralelo_na_sessao(id_sessao_pasta, nome_pasta_base)
+        enviar_pedacos_pendentes(canal_servidor, conexao_bd, fila_pedacos, trava_pedacos, endereco_servidor_str)
+        resultados[indice] = transmitir_lotes(canal_servidor, conexao_bd, gerar_lotes_da_fila(conexao_bd, fila_trabalho, indice, pastas_iniciais, futuros_checksums), endereco_servidor_str)
+    except Exception as e:
+        logger_texto.error(f"Conexão paralela {indice} falhou: {e}", exc_info=True)
+        resultados[indice] = b""
+    finally:
+        if indice != 0:
+            if canal_servidor is not None and resultados[indice] == b"ACK_END_FOLDER":
+                with trava_canais_paralelos:
+                    canais_paralelos_ociosos.append(canal_servidor)
+            elif canal_servidor is not None:
+                canal_servidor.sock.close()
+            conexao_bd.close()
+
+def enviar_arquivos_em_paralelo(canal_servidor, caminho_pasta_origem, nome_pasta_base, endereco_servidor_str, numero_conexoes):
+    # Todas as conexões entram na mesma sessão de pasta do servidor (mesmo id) e dividem os arquivos pela fila.
+    # Arquivos a partir de LIMIAR_ARQUIVO_EM_PEDACOS são divididos em pedaços, enviados antes dos demais por todas as conexões.
+    pastas, arquivos, arquivos_grandes = [], [], []
+    for pastas_diretorio, arquivos_diretorio in varrer_arvore(caminho_pasta_origem):
+        pastas.extend(pastas_diretorio)
+        for entrada_arquivo in arquivos_diretorio:
+            (arquivos_grandes if entrada_arquivo[2].st_size >= LIMIAR_ARQUIVO_EM_PEDACOS else arquivos).append(entrada_arquivo)
+
+    # Checksums completos que faltam no cache (arquivos em pedaços e, fora do modo trailer, todos) vão para o pool de
+    # processos de uma vez; as conexões só esperam pelo checksum do arquivo que vão anunciar. Os grandes vão primeiro.
+    arquivos_a_calcular = [(origem, info.st_size) for origem, _, info in (arquivos_grandes if MODO_CHECKSUM_TRAILER else arquivos_grandes + arquivos)
+                           if not obter_checksum_em_cache_bd(conexao_bd_cliente_global, origem, algoritmo_checksum_global, info)]
+    pool_checksums = criar_pool_checksums() if arquivos_a_calcular else None
+    futuros_checksums = submeter_checksums(pool_checksums, arquivos_a_calcular, algoritmo_checksum_global) if pool_checksums else {}
+    try:
+        return enviar_arquivos_da_varredura(canal_servidor, nome_pasta_base, endereco_servidor_str, numero_conexoes, pastas, arquivos, arquivos_grandes, futuros_checksums)
+    finally:
+        if pool_checksums is not None:
+            pool_checksums.shutdown(cancel_futures=True)
+
+def enviar_arquivos_da_varredura(canal_servidor, nome_pasta_base, endereco_servidor_str, numero_conexoes, pastas, arquivos, arquivos_grandes, futuros_checksums):
+    id_sessao_pasta = uuid.uuid4().hex
+    entrar_sessao_pasta_servidor(canal_servidor, id_sessao_pasta, nome_pasta_base)
+    fila_pedacos = queue.Queue()
+    trava_pedacos = threading.Lock()
+    arquivos_em_pedacos = [a for a in (preparar_arquivo_em_pedacos(canal_servidor, origem, relativo, info, fila_pedacos, endereco_servidor_str, futuros_checksums) for origem, relativo, info in arquivos_grandes) if a]
+    for arquivo in arquivos_em_pedacos:
+        if not arquivo["pedacos_restantes"]:
+            finalizar_arquivo_em_pedacos(canal_servidor, conexao_bd_cliente_global, arquivo, endereco_servidor_str)
+
+    numero_conexoes = max(1, min(numero_conexoes, len(arquivos) + fila_pedacos.qsize()))
+    logger_texto.info(f"Enviando {len(arquivos)} arquivos e {fila_pedacos.qsize()} pedaços de '{nome_pasta_base}' por {numero_conexoes} conexões paralelas.")
+    fila_trabalho = FilaRoubaTrabalho(arquivos, numero_conexoes)
+    resultados = [None] * numero_conexoes
+    threads = [threading.Thread(target=trabalhador_envio_paralelo, args=(i, None, fila_trabalho, fila_pedacos, trava_pedacos, id_sessao_pasta, nome_pasta_base, [], futuros_checksums, endereco_servidor_str, resultados),
+                                name=f"EnvioParalelo-{i}", daemon=True) for i in range(1, numero_conexoes)]
+    for thread in threads:
+        thread.start()
+    trabalhador_envio_paralelo(0, canal_servidor, fila_trabalho, fila_pedacos, trava_pedacos, id_sessao_pasta, nome_pasta_base, pastas, futuros_checksums, endereco_servidor_str, resultados)
+    for thread in threads:
+        thread.join()
+
+    for arquivo in arquivos_em_pedacos:
+        if arquivo["pedacos_restantes"]:
+            logger_texto.error(f"'{arquivo['relativo']}' ficou com {arquivo['pedacos_restantes']} pedaços sem confirmação; serão reenviados na próxima execução.")
+            registrar_fim_arquivo_em_pedacos(conexao_bd_cliente_global, arquivo, "N/A", endereco_servidor_str)
+    return resultados[0] if all(r == b"ACK_END_FOLDER" for r in resultados) else b"".join(r for r in resultados if r != b"ACK_END_FOLDER") or b"PARALLEL_STREAM_FAILED"
+
+
+def registrar_erro_conexao(erro, endereco_servidor_str):
+    if isinstance(erro, ConnectionRefusedError):
+        logger_texto.error("Erro: A conexao foi recusada. Verifique se o servidor esta rodando.", exc_info=erro)
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_CONNECTION_REFUSED", details=f"Servidor: {endereco_servidor_str}")
+    elif isinstance(erro, ErroProtocolo):
+        logger_texto.error(f"Erro de protocolo na comunicação com o servidor: {erro}")
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_PROTOCOL", details=str(erro))
+    elif isinstance(erro, ConnectionAbortedError):
+        logger_texto.error("Erro: A conexão foi abortada.", exc_info=erro)
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_CONNECTION_ABORTED", details=f"Servidor: {endereco_servidor_str}")
     else:
-        logger_texto.warning(f"Servidor não confirmou fim do processamento da pasta: {ack_fim_pasta.decode('utf-8', 'ignore')}")
-    
-    registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "SEND_FOLDER_END", details=f"Pasta: {nome_pasta_base}")
+        logger_texto.critical(f"Ocorreu um erro crítico no cliente: {erro}", exc_info=erro)
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_CRITICAL_EXCEPTION", details=str(erro))
 
+def processo_ativo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
-def main():
-    global conexao_bd_cliente_global
-    conexao_bd_cliente_global = inicializar_banco_dados_cliente(ARQUIVO_BD_CLIENTE)
-    registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CLIENT_START", details=f"Cliente iniciado. Tentará conectar em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}")
-    logger_texto.info(f"Cliente iniciado. Tentará conectar em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}")
+# API para uso por scripts e agendadores: abre o BD e a conexão uma vez e envia quantas pastas forem pedidas por ela
+# (as conexões paralelas extras também são reaproveitadas entre pastas). As funções de envio leem a configuração
+# das constantes e globais do módulo, então iniciar() as ajusta e encerrar() devolve os valores anteriores. Por isso só
+# uma instância pode estar ativa por processo: iniciar() com outra ativa levanta RuntimeError.
+class ClienteTransferencia:
+    trava_instancia_ativa = threading.Lock()
+    instancia_ativa = None
 
-    endereco_servidor_para_log = f"{ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}"
+    def __init__(self, endereco_servidor=None, porta_servidor=None, conexoes_paralelas=None, tamanho_bloco=None, arquivo_bd=None, limite_envio_kbps=None):
+        self.endereco_servidor = endereco_servidor or ENDERECO_IP_SERVIDOR
+        self.porta_servidor = porta_servidor or PORTA_SERVIDOR
+        self.conexoes_paralelas = conexoes_paralelas or NUMERO_CONEXOES_PARALELAS
+        self.tamanho_bloco = tamanho_bloco or TAMANHO_BLOCO_LEITURA
+        self.arquivo_bd = arquivo_bd or ARQUIVO_BD_CLIENTE
+        self.limite_envio_kbps = LIMITE_ENVIO_KBPS if limite_envio_kbps is None else limite_envio_kbps
+        self.endereco_servidor_str = f"{self.endereco_servidor}:{self.porta_servidor}"
+        self.canal_servidor = None
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as socket_principal:
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, tipo_excecao, excecao, rastreamento):
+        self.encerrar()
+
+    def iniciar(self):
+        global ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR, NUMERO_CONEXOES_PARALELAS, TAMANHO_BLOCO_LEITURA, ARQUIVO_BD_CLIENTE, LIMITE_ENVIO_KBPS
+        global conexao_bd_cliente_global, gravador_bd_cliente_global, id_cliente_global
+        with ClienteTransferencia.trava_instancia_ativa:
+            if ClienteTransferencia.instancia_ativa is not None:
+                raise RuntimeError(f"Já há um ClienteTransferencia ativo neste processo ({ClienteTransferencia.instancia_ativa.endereco_servidor_str}); encerre-o antes de iniciar outro.")
+            ClienteTransferencia.instancia_ativa = self
+        self.globais_anteriores = (ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR, NUMERO_CONEXOES_PARALELAS, TAMANHO_BLOCO_LEITURA, ARQUIVO_BD_CLIENTE, LIMITE_ENVIO_KBPS,
+                                   conexao_bd_cliente_global, gravador_bd_cliente_global, id_cliente_global)
         try:
-            logger_texto.info(f"Tentando conectar ao servidor em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}...")
-            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CONNECTING_TO_SERVER", details=f"Servidor: {endereco_servidor_para_log}")
-            socket_principal.connect((ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR))
-            logger_texto.info(f"Conectado ao servidor em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}")
-            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CONNECTED_TO_SERVER", details=f"Servidor: {endereco_servidor_para_log}")
+            ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR = self.endereco_servidor, self.porta_servidor
+            NUMERO_CONEXOES_PARALELAS, TAMANHO_BLOCO_LEITURA, ARQUIVO_BD_CLIENTE = self.conexoes_paralelas, self.tamanho_bloco, self.arquivo_bd
+            LIMITE_ENVIO_KBPS = self.limite_envio_kbps
+            conexao_bd_cliente_global = inicializar_banco_dados_cliente(ARQUIVO_BD_CLIENTE)
+            id_cliente_global = obter_id_cliente_bd(conexao_bd_cliente_global)
+            gravador_bd_cliente_global = GravadorBD(ARQUIVO_BD_CLIENTE)
+            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CLIENT_START", details=f"Cliente iniciado. Tentará conectar em {self.endereco_servidor_str}")
+            limpar_cache_checksums_bd(conexao_bd_cliente_global)
+        except Exception:
+            self._liberar_instancia()
+            raise
+        logger_texto.info(f"Cliente iniciado. Tentará conectar em {self.endereco_servidor_str}")
+        return self
 
-            caminho_pasta_para_enviar = input("Digite o caminho completo da PASTA que deseja enviar: ")
-            
-            if os.path.isdir(caminho_pasta_para_enviar):
-                enviar_pasta(socket_principal, caminho_pasta_para_enviar, endereco_servidor_para_log)
+    def conectar(self):
+        if self.canal_servidor is not None:
+            return self.canal_servidor
+        logger_texto.info(f"Tentando conectar ao servidor em {self.endereco_servidor_str}...")
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CONNECTING_TO_SERVER", details=f"Servidor: {self.endereco_servidor_str}")
+        socket_principal = socket.create_connection((self.endereco_servidor, self.porta_servidor))
+        try:
+            logger_texto.info(f"Conectado ao servidor em {self.endereco_servidor_str}")
+            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CONNECTED_TO_SERVER", details=f"Servidor: {self.endereco_servidor_str}")
+            canal_servidor = CanalMensagens(socket_principal, balde_envio=balde_envio_global)
+            negociar_protocolo(canal_servidor)
+            apresentar_cliente(canal_servidor)
+            negociar_compressao(canal_servidor)
+            negociar_checksum(canal_servidor)
+        except BaseException:
+            socket_principal.close()
+            raise
+        self.canal_servidor = canal_servidor
+        return canal_servidor
+
+    def desconectar(self):
+        if self.canal_servidor is not None:
+            self.canal_servidor.sock.close()
+            self.canal_servidor = None
+        fechar_canais_paralelos_ociosos()
+
+    def enviar_pasta(self, caminho_pasta):
+        canal_servidor = self.conectar()
+        try:
+            return enviar_pasta(canal_servidor, caminho_pasta, self.endereco_servidor_str)
+        except (OSError, ErroProtocolo):
+            self.desconectar() # Conexão em estado desconhecido: a próxima pasta abre outra
+            raise
+
+    def enfileirar(self, pastas):
+        # Uma pasta que já espera na fila não entra de novo
+        enfileiradas = 0
+        for caminho_pasta in pastas:
+            caminho_pasta = os.path.abspath(caminho_pasta)
+            linha = executar_escrita_bd(conexao_bd_cliente_global, '''
+                INSERT INTO client_job_queue (folder_path, server_address)
+                SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM client_job_queue WHERE folder_path = ? AND status = 'QUEUED')
+                RETURNING id''', (caminho_pasta, self.endereco_servidor_str, caminho_pasta), duravel=True, com_resultado=True)
+            if linha:
+                enfileiradas += 1
+                registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "JOB_ENQUEUED", details=f"Tarefa {linha[0]}: {caminho_pasta}")
+        return enfileiradas
+
+    def reenfileirar_tarefas_abandonadas(self):
+        # Tarefas RUNNING de um processo que morreu voltam para a fila (no Windows os.kill(pid, 0) encerraria o processo)
+        if os.name == 'nt':
+            return 0
+        abandonadas = [id_tarefa for id_tarefa, pid in conexao_bd_cliente_global.execute("SELECT id, worker_pid FROM client_job_queue WHERE status = 'RUNNING'")
+                       if not pid or (pid != os.getpid() and not processo_ativo(pid))]
+        for id_tarefa in abandonadas:
+            executar_escrita_bd(conexao_bd_cliente_global, "UPDATE client_job_queue SET status = 'QUEUED', worker_pid = NULL WHERE id = ? AND status = 'RUNNING'", (id_tarefa,), duravel=True)
+        if abandonadas:
+            logger_texto.info(f"{len(abandonadas)} tarefa(s) abandonada(s) por outro processo voltaram para a fila.")
+        return len(abandonadas)
+
+    def reservar_proxima_tarefa(self):
+        # Um único UPDATE escolhe e marca a tarefa, então vários processos podem drenar a mesma fila
+        return executar_escrita_bd(conexao_bd_cliente_global, '''
+            UPDATE client_job_queue SET status = 'RUNNING', attempts = attempts + 1, worker_pid = ?, server_address = ?,
+                started_timestamp = CURRENT_TIMESTAMP, finished_timestamp = NULL, error_details = NULL
+            WHERE id = (SELECT id FROM client_job_queue WHERE status = 'QUEUED' ORDER BY id LIMIT 1)
+            RETURNING id, folder_path, attempts''', (os.getpid(), self.endereco_servidor_str), duravel=True, com_resultado=True)
+
+    def finalizar_tarefa(self, id_tarefa, novo_status, detalhes_erro=None):
+        executar_escrita_bd(conexao_bd_cliente_global, '''
+            UPDATE client_job_queue SET status = ?, error_details = ?, worker_pid = NULL,
+                finished_timestamp = CASE WHEN ? = 'QUEUED' THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE id = ?''', (novo_status, detalhes_erro, novo_status, id_tarefa), duravel=True)
+
+    def processar_fila(self):
+        # Drena a fila pela mesma conexão; retorna (concluídas, com falha)
+        concluidas, falhas = 0, 0
+        while (tarefa := self.reservar_proxima_tarefa()) is not None:
+            id_tarefa, caminho_pasta, tentativas = tarefa
+            logger_texto.info(f"Tarefa {id_tarefa} (tentativa {tentativas}): enviando '{caminho_pasta}'.")
+            try:
+                sucesso = self.enviar_pasta(caminho_pasta)
+            except Exception as e:
+                registrar_erro_conexao(e, self.endereco_servidor_str)
+                novo_status = 'QUEUED' if tentativas < MAXIMO_TENTATIVAS_TAREFA else 'FAILED'
+                self.finalizar_tarefa(id_tarefa, novo_status, str(e))
+                falhas += novo_status == 'FAILED'
+                try:
+                    self.conectar()
+                except Exception as e_reconexao:
+                    registrar_erro_conexao(e_reconexao, self.endereco_servidor_str)
+                    logger_texto.error("Servidor indisponível; as tarefas restantes continuam na fila.")
+                    break
+                continue
+            if sucesso:
+                self.finalizar_tarefa(id_tarefa, 'DONE')
+                concluidas += 1
             else:
-                logger_texto.error(f"O caminho '{caminho_pasta_para_enviar}' não é uma pasta válida ou não existe.")
-                registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_INPUT_PATH_INVALID", details=f"Caminho fornecido: {caminho_pasta_para_enviar}")
-
-        except ConnectionRefusedError:
-            logger_texto.error("Erro: A conexao foi recusada. Verifique se o servidor esta rodando.", exc_info=True)
-            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_CONNECTION_REFUSED", details=f"Servidor: {endereco_servidor_para_log}")
-        except ConnectionAbortedError:
-            logger_texto.error("Erro: A conexão foi abortada.", exc_info=True)
-            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_CONNECTION_ABORTED", details=f"Servidor: {endereco_servidor_para_log}")
+                self.finalizar_tarefa(id_tarefa, 'FAILED', "Pasta inválida ou servidor não confirmou a transferência.")
+                falhas += 1
+        registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "JOB_QUEUE_DRAINED", details=f"Concluídas: {concluidas}, Falhas: {falhas}")
+        return concluidas, falhas
+
+    def resumo_fila(self):
+        return dict(conexao_bd_cliente_global.execute("SELECT status, COUNT(*) FROM client_job_queue GROUP BY status"))
+
+    def encerrar(self):
+        if ClienteTransferencia.instancia_ativa is not self:
+            return
+        try:
+            self.desconectar()
+            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CLIENT_STOP")
+            logger_texto.info("Cliente encerrado.")
+        finally:
+            self._liberar_instancia()
+
+    def _liberar_instancia(self):
+        # Fecha o que iniciar() abriu e devolve as constantes e globais do módulo aos valores de antes
+        global ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR, NUMERO_CONEXOES_PARALELAS, TAMANHO_BLOCO_LEITURA, ARQUIVO_BD_CLIENTE, LIMITE_ENVIO_KBPS
+        global conexao_bd_cliente_global, gravador_bd_cliente_global, id_cliente_global
+        if gravador_bd_cliente_global is not None and gravador_bd_cliente_global is not self.globais_anteriores[7]:
+            gravador_bd_cliente_global.encerrar()
+        if conexao_bd_cliente_global is not None and conexao_bd_cliente_global is not self.globais_anteriores[6]:
+            conexao_bd_cliente_global.close()
+        (ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR, NUMERO_CONEXOES_PARALELAS, TAMANHO_BLOCO_LEITURA, ARQUIVO_BD_CLIENTE, LIMITE_ENVIO_KBPS,
+         conexao_bd_cliente_global, gravador_bd_cliente_global, id_cliente_global) = self.globais_anteriores
+        with ClienteTransferencia.trava_instancia_ativa:
+            ClienteTransferencia.instancia_ativa = None
+
+def criar_parser_argumentos():
+    parser = argparse.ArgumentParser(description="Envia pastas para o servidor de transferência. Pastas passadas na linha de comando "
+                                                 "entram na fila persistente (client_job_queue) e a fila é drenada por uma única conexão.")
+    parser.add_argument("pastas", nargs="*", help="Pastas a enviar; sem pastas e sem opções de fila, o caminho é pedido interativamente")
+    parser.add_argument("--servidor", default=ENDERECO_IP_SERVIDOR, help=f"Endereço do servidor (padrão: {ENDERECO_IP_SERVIDOR})")
+    parser.add_argument("--porta", type=int, default=PORTA_SERVIDOR, help=f"Porta do servidor (padrão: {PORTA_SERVIDOR})")
+    parser.add_argument("--conexoes", type=int, default=NUMERO_CONEXOES_PARALELAS, help="Conexões paralelas por pasta (1 = uma única conexão)")
+    parser.add_argument("--tamanho-bloco", type=int, default=TAMANHO_BLOCO_LEITURA, help="Tamanho em bytes dos blocos de leitura, hash e compressão")
+    parser.add_argument("--limite-kbps", type=float, default=LIMITE_ENVIO_KBPS, help="Limite de envio em KB/s somando todas as conexões (0 = sem limite)")
+    parser.add_argument("--bd", default=ARQUIVO_BD_CLIENTE, help="Banco SQLite do cliente (log, cache de checksums e fila)")
+    parser.add_argument("--so-enfileirar", action="store_true", help="Só coloca as pastas na fila, sem conectar")
+    parser.add_argument("--processar-fila", action="store_true", help="Drena as tarefas pendentes da fila")
+    parser.add_argument("--listar-fila", action="store_true", help="Mostra quantas tarefas há em cada status e sai")
+    parser.add_argument("--benchmark-checksum", nargs="?", const="", metavar="ARQUIVO", help="Mede a vazão dos algoritmos de checksum e sai")
+    return parser
+
+def main(argumentos=None):
+    opcoes = criar_parser_argumentos().parse_args(argumentos)
+    if opcoes.benchmark_checksum is not None:
+        for algoritmo, vazao in medir_velocidade_checksums(opcoes.benchmark_checksum or None):
+            print(f"{algoritmo:>8}: {vazao:9.1f} MiB/s")
+        return 0
+
+    with ClienteTransferencia(opcoes.servidor, opcoes.porta, max(1, opcoes.conexoes), opcoes.tamanho_bloco, opcoes.bd, opcoes.limite_kbps) as cliente:
+        if opcoes.listar_fila:
+            for status, quantidade in sorted(cliente.resumo_fila().items()):
+                print(f"{status:>8}: {quantidade}")
+            return 0
+        usa_fila = bool(opcoes.pastas) or opcoes.so_enfileirar or opcoes.processar_fila
+        if usa_fila:
+            cliente.reenfileirar_tarefas_abandonadas()
+            enfileiradas = cliente.enfileirar(opcoes.pastas)
+            logger_texto.info(f"{enfileiradas} pasta(s) adicionada(s) à fila.")
+            if opcoes.so_enfileirar:
+                return 0
+        try:
+            cliente.conectar()
+            if not usa_fila:
+                caminho_pasta_para_enviar = input("Digite o caminho completo da PASTA que deseja enviar: ")
+                if not os.path.isdir(caminho_pasta_para_enviar):
+                    logger_texto.error(f"O caminho '{caminho_pasta_para_enviar}' não é uma pasta válida ou não existe.")
+                    registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_INPUT_PATH_INVALID", details=f"Caminho fornecido: {caminho_pasta_para_enviar}")
+                    return 1
+                return 0 if cliente.enviar_pasta(caminho_pasta_para_enviar) else 1
         except Exception as e:
-            logger_texto.critical(f"Ocorreu um erro crítico no cliente: {e}", exc_info=True)
-            registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "ERROR_CRITICAL_EXCEPTION", details=str(e))
-    
-    registrar_evento_geral_cliente_bd(conexao_bd_cliente_global, "CLIENT_STOP")
-    logger_texto.info("Cliente encerrado.")
-    if conexao_bd_cliente_global:
-        conexao_bd_cliente_global.close()
+            registrar_erro_conexao(e, cliente.endereco_servidor_str)
+            return 1
+        _, falhas = cliente.processar_fila()
+        return 1 if falhas or cliente.resumo_fila().get('QUEUED') else 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -3,14 +3,71 @@ import os
 import logging
 import time
 import hashlib
+import json
 import sqlite3
+import struct
+import threading
+import queue
+import signal
+import shutil
+import math
+import mmap
+import stat
+import zlib
+import lzma
+import bisect
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+try:
+    import zstandard
+except ImportError: # Opcional: sem ele a compressão fica só com zlib/lzma
+    zstandard = None
 
 ENDERECO_IP_SERVIDOR = '0.0.0.0'
 PORTA_SERVIDOR = 65432
 TAMANHO_BUFFER = 4096
+TAMANHO_BUFFER_RECEPCAO = 1024 * 1024 # Buffer reutilizado por sessão para os dados dos arquivos
+USAR_MMAP = True
+LIMIAR_ARQUIVO_MMAP = 64 * 1024 * 1024 # A partir deste tamanho, hashes e cópias de blocos do delta leem fatias de um mmap
+TAMANHO_FATIA_MMAP = 8 * 1024 * 1024
+TAMANHO_FATIA_LIMITADA = 64 * 1024 # Com limite de envio ativo (só no cliente) os dados saem em fatias menores, para o ritmo ficar uniforme
+MAXIMO_ESTADOS_HASH_PARCIAIS = 1024
+USAR_SPLICE_LINUX = False # socket -> arquivo via os.splice, sem cópia para o espaço de usuário
+VERSOES_PROTOCOLO_SUPORTADAS = (1,)
+ESTRUTURA_CABECALHO_QUADRO = struct.Struct('!BI')
+TAMANHO_MAXIMO_QUADRO = 16 * 1024 * 1024
 PASTA_UPLOADS = "uploads_servidor"
+PASTA_BLOBS = "blobs_servidor" # Fora de PASTA_UPLOADS (mesmo sistema de arquivos, para hardlinks). Armazém endereçado por conteúdo: <algoritmo>/<2 primeiros hex>/<checksum>-<tamanho>
+FICLONE_LINUX = 0x40049409 # fcntl.FICLONE só existe a partir do Python 3.12
 ARQUIVO_LOG_SERVIDOR_TEXTO = "servidor.log"
 ARQUIVO_BD_SERVIDOR = "servidor_log.db" 
+MAXIMO_SESSOES_CONCORRENTES = 32
+TAMANHO_MAXIMO_ID_CLIENTE = 128
+LIMITE_BANDA_GLOBAL_KBPS = 0 # Limites de recepção em KB/s (0 = sem limite): soma de todas as sessões,
+LIMITE_BANDA_POR_CLIENTE_KBPS = 0 # por id de cliente (todas as conexões dele)
+LIMITE_BANDA_POR_PASTA_KBPS = 0 # e por transferência de pasta (todas as conexões paralelas dela)
+ARQUIVO_LIMITES_BANDA = "limites_banda.json" # Sobrepõe os limites acima em tempo de execução; relido quando muda
+INTERVALO_VERIFICACAO_LIMITES_SEGUNDOS = 2
+RAJADA_MAXIMA_BANDA_SEGUNDOS = 0.5 # Folga que um balde ocioso acumula para gastar de uma vez
+# Fases medidas em ns (perf_counter_ns) na recepção de cada arquivo; cada nome é também a coluna do BD
+COLUNAS_TEMPOS_FASES = ("network_receive_ns", "disk_write_ns", "checksum_ns", "verify_ns", "data_transfer_ns")
+TIMEOUT_BD_SEGUNDOS = 30
+MAXIMO_ESCRITAS_LOTE_BD = 500 # Escritas não duráveis acumuladas antes de um commit
+INTERVALO_MAXIMO_LOTE_BD_SEGUNDOS = 0.5
+INTERVALO_CHECKPOINT_BYTES = 64 * 1024 * 1024 # Offset recebido vai para o BD (após fsync) a cada N bytes ou T segundos; 0 desativa
+INTERVALO_CHECKPOINT_SEGUNDOS = 5
+TAMANHO_MINIMO_ARQUIVO_DELTA = 64 * 1024 # Cópias menores que isso no servidor são reenviadas inteiras
+TAMANHO_MINIMO_BLOCO_DELTA = 2048
+MAXIMO_BLOCOS_DELTA = 100000 # Limita o quadro de assinaturas para arquivos muito grandes
+ALGORITMOS_SO_INTEGRIDADE = ("crc32",) # Aceitos para conferir transferências, mas fracos demais para endereçar o armazém de blobs
+ENDERECO_IP_METRICAS = '127.0.0.1' # Endpoint HTTP das métricas: só local por padrão
+PORTA_METRICAS = 9108 # /metrics no formato texto do Prometheus e /metrics.json com o mesmo conteúdo; 0 desativa
+LIMITES_HISTOGRAMA_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STATUS_FINAIS_ARQUIVO = ("SUCCESS_CHECKSUM_OK", "FAIL_CHECKSUM_MISMATCH", "FAIL_DATA_INCOMPLETE", "FAIL_DELTA_ERROR", "FAIL_SERVER_ERROR")
 
 #peguei da internet, é um padrão comum
 def configurar_logger_texto(nome_logger, arquivo_log, nivel=logging.INFO):
@@ -29,21 +86,326 @@ def configurar_logger_texto(nome_logger, arquivo_log, nivel=logging.INFO):
 logger_texto = configurar_logger_texto('LoggerServidorTexto_Fase6', ARQUIVO_LOG_SERVIDOR_TEXTO)
 
 conexao_bd_global = None
+gravador_bd_global = None
 
-def inicializar_banco_dados(arquivo_bd):
-    conexao = sqlite3.connect(arquivo_bd)
-    cursor_bd = conexao.cursor()
-    cursor_bd.execute('''
-    CREATE TABLE IF NOT EXISTS event_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        event_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-        client_address TEXT,
-        event_type TEXT NOT NULL,
-        details TEXT
-    )''')
-    
-    cursor_bd.execute('''
-    CREATE TABLE IF NOT EXISTS file_transfer_log (
+# Registro de métricas em memória. Cada atualização é uma soma sob uma trava sem disputa (na recepção, uma por recv),
+# e a formatação só acontece quando alguém lê o endpoint. Medidores calculados são funções chamadas na leitura.
+class RegistroMetricas:
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.declaracoes = OrderedDict() # nome -> (tipo, descrição)
+        self.valores = {} # nome -> {rótulos: valor}; nos histogramas o valor é [contagens por faixa..., soma, contagem]
+        self.medidores_calculados = {}
+
+    def declarar(self, nome, tipo, descricao, funcao=None, com_rotulos=False):
+        self.declaracoes[nome] = (tipo, descricao)
+        self.valores[nome] = {} if com_rotulos or tipo == "histogram" else {(): 0}
+        if funcao is not None:
+            self.medidores_calculados[nome] = funcao
+
+    def incrementar(self, nome, quantidade=1, rotulos=()):
+        with self.trava:
+            serie = self.valores[nome]
+            serie[rotulos] = serie.get(rotulos, 0) + quantidade
+
+    def observar(self, nome, valor, rotulos=()):
+        faixa = bisect.bisect_left(LIMITES_HISTOGRAMA_SEGUNDOS, valor)
+        with self.trava:
+            serie = self.valores[nome]
+            contagens = serie.get(rotulos)
+            if contagens is None:
+                contagens = serie[rotulos] = [0] * (len(LIMITES_HISTOGRAMA_SEGUNDOS) + 3)
+            contagens[faixa] += 1
+            contagens[-2] += valor
+            contagens[-1] += 1
+
+    def instantaneo(self):
+        calculados = {}
+        for nome, funcao in self.medidores_calculados.items():
+            try:
+                calculados[nome] = {(): funcao()}
+            except Exception as e:
+                logger_texto.error(f"Erro ao calcular a métrica '{nome}': {e}")
+        with self.trava:
+            valores = {nome: {rotulos: list(valor) if isinstance(valor, list) else valor for rotulos, valor in serie.items()}
+                       for nome, serie in self.valores.items()}
+        valores.update(calculados)
+        return valores
+
+    def texto_prometheus(self):
+        linhas = []
+        for nome, serie in self.instantaneo().items():
+            tipo, descricao = self.declaracoes[nome]
+            linhas += [f"# HELP {nome} {descricao}", f"# TYPE {nome} {tipo}"]
+            for rotulos, valor in sorted(serie.items()):
+                if tipo != "histogram":
+                    linhas.append(f"{nome}{formatar_rotulos_metrica(rotulos)} {valor}")
+                    continue
+                acumulado = 0
+                for limite, quantidade in zip((*LIMITES_HISTOGRAMA_SEGUNDOS, "+Inf"), valor[:-2]):
+                    acumulado += quantidade
+                    linhas.append(f"{nome}_bucket{formatar_rotulos_metrica(rotulos + (('le', str(limite)),))} {acumulado}")
+                linhas.append(f"{nome}_sum{formatar_rotulos_metrica(rotulos)} {valor[-2]}")
+                linhas.append(f"{nome}_count{formatar_rotulos_metrica(rotulos)} {valor[-1]}")
+        return "\n".join(linhas) + "\n"
+
+    def json_instantaneo(self):
+        metricas_json = {}
+        for nome, serie in self.instantaneo().items():
+            tipo = self.declaracoes[nome][0]
+            amostras = []
+            for rotulos, valor in serie.items():
+                if tipo == "histogram":
+                    valor = {"buckets": dict(zip(map(str, (*LIMITES_HISTOGRAMA_SEGUNDOS, "+Inf")), valor[:-2])), "sum": valor[-2], "count": valor[-1]}
+                amostras.append({"labels": dict(rotulos), "value": valor})
+            metricas_json[nome] = {"type": tipo, "samples": amostras}
+        return {"timestamp": time.time(), "metrics": metricas_json}
+
+def formatar_rotulos_metrica(rotulos):
+    if not rotulos:
+        return ""
+    pares = []
+    for chave, valor in rotulos:
+        valor_escapado = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pares.append(f'{chave}="{valor_escapado}"')
+    return "{" + ",".join(pares) + "}"
+
+metricas = RegistroMetricas()
+metricas.declarar("file_server_received_bytes_total", "counter", "Bytes lidos dos sockets dos clientes (comandos e dados).")
+metricas.declarar("file_server_sessions_total", "counter", "Conexões de clientes atendidas.")
+metricas.declarar("file_server_sessions_active", "gauge", "Conexões de clientes em atendimento.")
+metricas.declarar("file_server_files_finished_total", "counter", "Arquivos que chegaram a um status final, por status.", com_rotulos=True)
+metricas.declarar("file_server_prepare_decisions_total", "counter", "Decisões de preparação (new, resume, already_ok, deduplicated).", com_rotulos=True)
+metricas.declarar("file_server_transfer_phase_seconds", "histogram", "Tempo de cada fase da recepção de um arquivo.")
+metricas.declarar("file_server_db_commit_seconds", "histogram", "Latência dos commits do gravador do BD.")
+metricas.declarar("file_server_db_writer_queue_depth", "gauge", "Escritas esperando na fila do gravador do BD.",
+                  lambda: gravador_bd_global.fila.qsize() if gravador_bd_global is not None else 0)
+metricas.declarar("file_server_folder_sessions_active", "gauge", "Transferências de pasta em andamento.", lambda: len(sessoes_pasta_ativas))
+
+class ManipuladorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            corpo, tipo_conteudo = metricas.texto_prometheus().encode('utf-8'), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            corpo, tipo_conteudo = json.dumps(metricas.json_instantaneo()).encode('utf-8'), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", tipo_conteudo)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, formato, *argumentos):
+        pass # Uma linha por coleta só poluiria o servidor.log
+
+def iniciar_servidor_metricas():
+    if not PORTA_METRICAS:
+        return None
+    try:
+        servidor_metricas = ThreadingHTTPServer((ENDERECO_IP_METRICAS, PORTA_METRICAS), ManipuladorMetricas)
+    except OSError as e:
+        logger_texto.error(f"Não foi possível abrir o endpoint de métricas em {ENDERECO_IP_METRICAS}:{PORTA_METRICAS}: {e}")
+        return None
+    servidor_metricas.daemon_threads = True
+    threading.Thread(target=servidor_metricas.serve_forever, name="Metricas", daemon=True).start()
+    logger_texto.info(f"Métricas disponíveis em http://{ENDERECO_IP_METRICAS}:{PORTA_METRICAS}/metrics")
+    return servidor_metricas
+
+# Protocolo de quadros (v1): cada mensagem de comando vai como [versão: 1 byte][tamanho: 4 bytes big-endian][payload UTF-8].
+# Os dados dos arquivos continuam indo como bytes brutos logo após o ACK, pois o tamanho já é conhecido pelos dois lados.
+# Sem negociação (clientes antigos) o canal continua no protocolo texto, onde cada recv() é tratado como um comando.
+class ErroProtocolo(Exception):
+    pass
+
+# Mantida idêntica à cópia em cliente.py: o enquadramento é o protocolo, então as duas pontas precisam concordar.
+# O que muda por papel entra pelos ganchos: ao_receber (contagem de bytes no servidor) e balde_envio (limite de envio no cliente).
+class CanalMensagens:
+    def __init__(self, sock, ao_receber=None, balde_envio=None):
+        self.sock = sock
+        self.versao_quadros = 0  # 0 = protocolo texto legado
+        self.codecs_compressao = [] # Negociados com o servidor, na ordem de preferência do cliente
+        self.buffer_leitura = bytearray()
+        self.ao_receber = ao_receber
+        self.balde_envio = balde_envio
+
+    def _recebido(self, quantidade):
+        if self.ao_receber is not None:
+            self.ao_receber(quantidade)
+        return quantidade
+
+    def _enviado(self, quantidade):
+        if self.balde_envio is not None:
+            self.balde_envio.consumir(quantidade)
+
+    def _preencher_buffer(self, minimo_bytes):
+        while len(self.buffer_leitura) < minimo_bytes:
+            bloco = self.sock.recv(max(TAMANHO_BUFFER, minimo_bytes - len(self.buffer_leitura)))
+            if not bloco:
+                return False
+            self._recebido(len(bloco))
+            self.buffer_leitura += bloco
+        return True
+
+    def _consumir_buffer(self, quantidade):
+        dados = bytes(self.buffer_leitura[:quantidade])
+        del self.buffer_leitura[:quantidade]
+        return dados
+
+    def enviar_mensagem(self, mensagem):
+        if isinstance(mensagem, str):
+            mensagem = mensagem.encode('utf-8')
+        if self.versao_quadros:
+            self.sock.sendall(ESTRUTURA_CABECALHO_QUADRO.pack(self.versao_quadros, len(mensagem)) + mensagem)
+        else:
+            self.sock.sendall(mensagem)
+        self._enviado(len(mensagem))
+
+    def receber_mensagem(self):
+        if not self.versao_quadros:
+            if self.buffer_leitura:
+                return self._consumir_buffer(len(self.buffer_leitura))
+            mensagem = self.sock.recv(TAMANHO_BUFFER)
+            self._recebido(len(mensagem))
+            return mensagem
+
+        if not self._preencher_buffer(ESTRUTURA_CABECALHO_QUADRO.size):
+            if self.buffer_leitura:
+                raise ErroProtocolo("Conexão encerrada no meio do cabeçalho de um quadro.")
+            return b""
+        versao, tamanho_payload = ESTRUTURA_CABECALHO_QUADRO.unpack_from(self.buffer_leitura)
+        if versao != self.versao_quadros:
+            raise ErroProtocolo(f"Versão de quadro inesperada: {versao} (negociada: {self.versao_quadros}).")
+        if tamanho_payload > TAMANHO_MAXIMO_QUADRO:
+            raise ErroProtocolo(f"Quadro de {tamanho_payload} bytes excede o limite de {TAMANHO_MAXIMO_QUADRO}.")
+        if not self._preencher_buffer(ESTRUTURA_CABECALHO_QUADRO.size + tamanho_payload):
+            raise ErroProtocolo("Conexão encerrada no meio do payload de um quadro.")
+        del self.buffer_leitura[:ESTRUTURA_CABECALHO_QUADRO.size]
+        return self._consumir_buffer(tamanho_payload)
+
+    def receber_bytes(self, quantidade_maxima):
+        # Dados brutos: primeiro o que sobrou no buffer do leitor de quadros, depois direto do socket
+        if self.buffer_leitura:
+            return self._consumir_buffer(min(quantidade_maxima, len(self.buffer_leitura)))
+        dados = self.sock.recv(quantidade_maxima)
+        self._recebido(len(dados))
+        return dados
+
+    def receber_bytes_em(self, visao_destino):
+        if self.buffer_leitura:
+            quantidade = min(len(visao_destino), len(self.buffer_leitura))
+            visao_destino[:quantidade] = self.buffer_leitura[:quantidade]
+            del self.buffer_leitura[:quantidade]
+            return quantidade
+        return self._recebido(self.sock.recv_into(visao_destino))
+
+    def enviar_bytes(self, dados):
+        if self.balde_envio is None or not self.balde_envio.obter_taxa():
+            self.sock.sendall(dados)
+            return
+        visao_dados = memoryview(dados)
+        for posicao in range(0, len(visao_dados), TAMANHO_FATIA_LIMITADA):
+            fatia = visao_dados[posicao:posicao + TAMANHO_FATIA_LIMITADA]
+            self.sock.sendall(fatia)
+            self._enviado(len(fatia))
+
+# Cada sessão abre sua própria conexão; o timeout faz as escritas concorrentes esperarem o lock do SQLite em vez de falhar
+def abrir_conexao_bd(arquivo_bd):
+    return sqlite3.connect(arquivo_bd, timeout=TIMEOUT_BD_SEGUNDOS)
+
+# Write-behind: as escritas das sessões entram numa fila e uma única thread as aplica em transações agrupadas.
+# Escritas duráveis (estado usado na retomada) só retornam depois do commit que as inclui; as demais vão no próximo lote.
+# Mantida idêntica à cópia em cliente.py: correções no gravador valem para os dois lados.
+class GravadorBD:
+    def __init__(self, arquivo_bd, maximo_escritas_lote=MAXIMO_ESCRITAS_LOTE_BD, intervalo_maximo_lote=INTERVALO_MAXIMO_LOTE_BD_SEGUNDOS, ao_commit=None):
+        self.arquivo_bd = arquivo_bd
+        self.ao_commit = ao_commit # Recebe a duração de cada commit (métricas do servidor)
+        self.maximo_escritas_lote = maximo_escritas_lote
+        self.intervalo_maximo_lote = intervalo_maximo_lote
+        self.fila = queue.Queue()
+        self.thread = threading.Thread(target=self._executar, name="GravadorBD", daemon=True)
+        self.thread.start()
+
+    def executar(self, sql, parametros=(), duravel=False, com_resultado=False):
+        evento = threading.Event() if (duravel or com_resultado) else None
+        resultado = [] if com_resultado else None
+        self.fila.put((sql, parametros, duravel, evento, resultado))
+        if evento is not None:
+            evento.wait()
+        return resultado[0] if resultado else None
+
+    def sincronizar(self):
+        self.executar(None, duravel=True)
+
+    def encerrar(self):
+        self.fila.put(None)
+        self.thread.join()
+
+    def _executar(self):
+        conexao = abrir_conexao_bd(self.arquivo_bd)
+        conexao.execute("PRAGMA synchronous=FULL")
+        escritas_pendentes, aguardando_commit, inicio_lote = 0, [], None
+        encerrando = False
+        while not encerrando:
+            espera = None if inicio_lote is None else max(0, inicio_lote + self.intervalo_maximo_lote - time.monotonic())
+            try:
+                item = self.fila.get(timeout=espera)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                encerrando = True
+            elif item:
+                sql, parametros, duravel, evento, resultado = item
+                if sql is not None:
+                    try:
+                        linhas = conexao.execute(sql, parametros).fetchall()
+                        if resultado is not None:
+                            resultado.append(linhas[0] if linhas else None)
+                    except Exception as e:
+                        logger_texto.error(f"BD Erro (GravadorBD): {e} em {sql.strip()[:120]}", exc_info=True)
+                    escritas_pendentes += 1
+                    if inicio_lote is None:
+                        inicio_lote = time.monotonic()
+                if duravel:
+                    aguardando_commit.append(evento)
+                elif evento is not None:
+                    evento.set()
+
+            if encerrando or aguardando_commit or escritas_pendentes >= self.maximo_escritas_lote or (inicio_lote is not None and time.monotonic() - inicio_lote >= self.intervalo_maximo_lote):
+                inicio_commit = time.perf_counter()
+                try:
+                    conexao.commit()
+                except Exception as e:
+                    logger_texto.error(f"BD Erro (GravadorBD commit): {e}", exc_info=True)
+                if self.ao_commit is not None:
+                    self.ao_commit(time.perf_counter() - inicio_commit)
+                for evento in aguardando_commit:
+                    evento.set()
+                escritas_pendentes, aguardando_commit, inicio_lote = 0, [], None
+        conexao.close()
+
+def executar_escrita_bd(conexao_bd_local, sql, parametros=(), duravel=False, com_resultado=False):
+    # Sem o gravador (ex.: scripts que importam o módulo) a escrita vai direto na conexão recebida
+    if gravador_bd_global is not None:
+        return gravador_bd_global.executar(sql, parametros, duravel, com_resultado)
+    linhas = conexao_bd_local.execute(sql, parametros).fetchall()
+    conexao_bd_local.commit()
+    return linhas[0] if com_resultado and linhas else None
+
+def sincronizar_escritas_bd():
+    if gravador_bd_global is not None:
+        gravador_bd_global.sincronizar()
+
+def adicionar_coluna_se_ausente(cursor_bd, tabela, coluna, definicao):
+    # Bancos criados por versões anteriores não têm as colunas novas
+    colunas_existentes = {linha[1] for linha in cursor_bd.execute(f"PRAGMA table_info({tabela})")}
+    if coluna not in colunas_existentes:
+        cursor_bd.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+
+# A retomada é indexada pelo id estável que o cliente envia em HELLO_CLIENT (ou pelo endereço, para clientes antigos)
+ESQUEMA_FILE_TRANSFER_LOG = '''
+    CREATE TABLE IF NOT EXISTS {tabela} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         client_address TEXT NOT NULL,
         relative_file_path TEXT NOT NULL,
@@ -60,114 +422,549 @@ def inicializar_banco_dados(arquivo_bd):
         final_duration_seconds REAL,
         final_speed_KBps REAL,
         error_details TEXT,
-        UNIQUE(client_address, relative_file_path)
+        precheck_fingerprint TEXT,
+        server_file_path TEXT,
+        client_id TEXT NOT NULL,
+        rate_limit_KBps REAL,
+        prepare_ns INTEGER,
+        network_receive_ns INTEGER,
+        disk_write_ns INTEGER,
+        checksum_ns INTEGER,
+        verify_ns INTEGER,
+        data_transfer_ns INTEGER,
+        UNIQUE(client_id, relative_file_path)
+    )'''
+
+def migrar_transferencias_para_id_cliente(conexao, cursor_bd):
+    # Bancos antigos têm UNIQUE(client_address, relative_file_path); o SQLite não altera restrições, então a tabela é recriada.
+    # As linhas existentes ficam com client_id = client_address, que é o que um cliente antigo continua usando.
+    colunas_existentes = [linha[1] for linha in cursor_bd.execute("PRAGMA table_info(file_transfer_log)")]
+    if "client_id" in colunas_existentes:
+        return
+    logger_texto.info("Migrando file_transfer_log para chave (client_id, relative_file_path)...")
+    lista_colunas = ", ".join(colunas_existentes)
+    cursor_bd.execute("BEGIN")
+    cursor_bd.execute(ESQUEMA_FILE_TRANSFER_LOG.format(tabela="file_transfer_log_nova"))
+    cursor_bd.execute(f"INSERT INTO file_transfer_log_nova ({lista_colunas}, client_id) SELECT {lista_colunas}, client_address FROM file_transfer_log")
+    cursor_bd.execute("DROP TABLE file_transfer_log")
+    cursor_bd.execute("ALTER TABLE file_transfer_log_nova RENAME TO file_transfer_log")
+    conexao.commit()
+
+def inicializar_banco_dados(arquivo_bd):
+    conexao = abrir_conexao_bd(arquivo_bd)
+    conexao.execute("PRAGMA journal_mode=WAL") # Leitores das sessões não bloqueiam o gravador
+    cursor_bd = conexao.cursor()
+    cursor_bd.execute('''
+    CREATE TABLE IF NOT EXISTS event_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        client_address TEXT,
+        event_type TEXT NOT NULL,
+        details TEXT
+    )''')
+    
+    cursor_bd.execute(ESQUEMA_FILE_TRANSFER_LOG.format(tabela="file_transfer_log"))
+    adicionar_coluna_se_ausente(cursor_bd, "file_transfer_log", "precheck_fingerprint", "TEXT")
+    adicionar_coluna_se_ausente(cursor_bd, "file_transfer_log", "server_file_path", "TEXT")
+    migrar_transferencias_para_id_cliente(conexao, cursor_bd)
+    adicionar_coluna_se_ausente(cursor_bd, "file_transfer_log", "rate_limit_KBps", "REAL")
+    for coluna_tempo in ("prepare_ns", *COLUNAS_TEMPOS_FASES):
+        adicionar_coluna_se_ausente(cursor_bd, "file_transfer_log", coluna_tempo, "INTEGER")
+    # A chave única saiu de client_address; este índice mantém rápidas as consultas por endereço
+    cursor_bd.execute("CREATE INDEX IF NOT EXISTS idx_file_transfer_log_client_address ON file_transfer_log(client_address)")
+
+    cursor_bd.execute('''
+    CREATE TABLE IF NOT EXISTS content_blob_index (
+        checksum_algorithm TEXT NOT NULL,
+        checksum_hex TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        blob_path TEXT NOT NULL,
+        created_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (checksum_algorithm, checksum_hex, size_bytes)
+    )''')
+
+    # Arquivos grandes enviados em pedaços: a retomada reenvia só os pedaços que não estão DONE
+    cursor_bd.execute('''
+    CREATE TABLE IF NOT EXISTS file_chunk_log (
+        file_log_id INTEGER NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        chunk_offset INTEGER NOT NULL,
+        chunk_size_bytes INTEGER NOT NULL,
+        status TEXT NOT NULL, /* PENDING, DONE */
+        completed_timestamp DATETIME,
+        PRIMARY KEY (file_log_id, chunk_index)
     )''')
     conexao.commit()
     return conexao
 
 def registrar_evento_geral_bd(conexao_bd_local, tipo_evento, endereco_cliente=None, detalhes_evento=None):
     try:
-        cursor_bd = conexao_bd_local.cursor()
-        cursor_bd.execute("INSERT INTO event_log (client_address, event_type, details) VALUES (?, ?, ?)", 
-                       (endereco_cliente, tipo_evento, detalhes_evento))
-        conexao_bd_local.commit()
+        executar_escrita_bd(conexao_bd_local, "INSERT INTO event_log (client_address, event_type, details) VALUES (?, ?, ?)", 
+                            (endereco_cliente, tipo_evento, detalhes_evento))
     except Exception as e:
         logger_texto.error(f"BD Erro (registrar_evento_geral_bd): {e}", exc_info=True)
 
 
-def registrar_ou_atualizar_metadados_arquivo_bd(conexao_bd_local, end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp, status_inicial='AWAITING_PREPARE'):
+# Conteúdo mudou: tamanho diferente ou o identificador enviado (checksum completo ou impressão rápida) não bate com o registrado
+CONDICAO_METADADOS_MUDARAM = """(excluded.total_file_size_bytes != file_transfer_log.total_file_size_bytes
+    OR (excluded.expected_checksum_hex IS NOT NULL AND excluded.expected_checksum_hex IS NOT file_transfer_log.expected_checksum_hex)
+    OR (excluded.expected_checksum_hex IS NULL AND excluded.precheck_fingerprint IS NOT file_transfer_log.precheck_fingerprint))"""
+
+def registrar_ou_atualizar_metadados_arquivo_bd(conexao_bd_local, id_cliente, end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp, status_inicial='AWAITING_PREPARE', impressao_rapida=None):
     agora_str = time.strftime('%Y-%m-%d %H:%M:%S')
     try:
-        cursor_bd = conexao_bd_local.cursor()
-        cursor_bd.execute('''
-        INSERT INTO file_transfer_log (client_address, relative_file_path, total_file_size_bytes, checksum_algorithm, expected_checksum_hex, status, first_seen_timestamp, last_update_timestamp, current_bytes_transferred)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
-        ON CONFLICT(client_address, relative_file_path) DO UPDATE SET
+        id_linha = executar_escrita_bd(conexao_bd_local, f'''
+        INSERT INTO file_transfer_log (client_id, client_address, relative_file_path, total_file_size_bytes, checksum_algorithm, expected_checksum_hex, precheck_fingerprint, status, first_seen_timestamp, last_update_timestamp, current_bytes_transferred)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        ON CONFLICT(client_id, relative_file_path) DO UPDATE SET
+            client_address=excluded.client_address,
             total_file_size_bytes=excluded.total_file_size_bytes,
             checksum_algorithm=excluded.checksum_algorithm,
-            expected_checksum_hex=excluded.expected_checksum_hex,
+            expected_checksum_hex=CASE
+                WHEN excluded.expected_checksum_hex IS NOT NULL THEN excluded.expected_checksum_hex
+                WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL
+                ELSE file_transfer_log.expected_checksum_hex
+            END,
+            precheck_fingerprint=CASE
+                WHEN excluded.precheck_fingerprint IS NOT NULL THEN excluded.precheck_fingerprint
+                WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL
+                ELSE file_transfer_log.precheck_fingerprint
+            END,
             status=CASE
-                WHEN file_transfer_log.status = 'SUCCESS_CHECKSUM_OK' THEN 'SUCCESS_CHECKSUM_OK'
+                WHEN file_transfer_log.status = 'SUCCESS_CHECKSUM_OK' AND NOT {CONDICAO_METADADOS_MUDARAM} THEN 'SUCCESS_CHECKSUM_OK'
                 ELSE excluded.status
             END,
             last_update_timestamp=excluded.last_update_timestamp,
             current_bytes_transferred=CASE
-                 WHEN file_transfer_log.status = 'SUCCESS_CHECKSUM_OK' THEN file_transfer_log.current_bytes_transferred
-                 WHEN excluded.total_file_size_bytes != file_transfer_log.total_file_size_bytes OR excluded.expected_checksum_hex != file_transfer_log.expected_checksum_hex THEN 0
+                 WHEN {CONDICAO_METADADOS_MUDARAM} THEN 0
                  ELSE file_transfer_log.current_bytes_transferred
             END,
-            final_calculated_checksum_hex=CASE WHEN excluded.total_file_size_bytes != file_transfer_log.total_file_size_bytes OR excluded.expected_checksum_hex != file_transfer_log.expected_checksum_hex THEN NULL ELSE file_transfer_log.final_calculated_checksum_hex END,
-            final_duration_seconds=CASE WHEN excluded.total_file_size_bytes != file_transfer_log.total_file_size_bytes OR excluded.expected_checksum_hex != file_transfer_log.expected_checksum_hex THEN NULL ELSE file_transfer_log.final_duration_seconds END,
-            final_speed_KBps=CASE WHEN excluded.total_file_size_bytes != file_transfer_log.total_file_size_bytes OR excluded.expected_checksum_hex != file_transfer_log.expected_checksum_hex THEN NULL ELSE file_transfer_log.final_speed_KBps END,
-            error_details=CASE WHEN excluded.total_file_size_bytes != file_transfer_log.total_file_size_bytes OR excluded.expected_checksum_hex != file_transfer_log.expected_checksum_hex THEN NULL ELSE file_transfer_log.error_details END
+            final_calculated_checksum_hex=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.final_calculated_checksum_hex END,
+            final_duration_seconds=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.final_duration_seconds END,
+            final_speed_KBps=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.final_speed_KBps END,
+            rate_limit_KBps=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.rate_limit_KBps END,
+            network_receive_ns=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.network_receive_ns END,
+            disk_write_ns=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.disk_write_ns END,
+            checksum_ns=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.checksum_ns END,
+            verify_ns=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.verify_ns END,
+            data_transfer_ns=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.data_transfer_ns END,
+            error_details=CASE WHEN {CONDICAO_METADADOS_MUDARAM} THEN NULL ELSE file_transfer_log.error_details END
         RETURNING id
-        ''', (end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp, status_inicial, agora_str, agora_str))
-        
-        id_linha = cursor_bd.fetchone()
-        conexao_bd_local.commit()
+        ''', (id_cliente, end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp, impressao_rapida, status_inicial, agora_str, agora_str), com_resultado=True)
         return id_linha[0] if id_linha else None
     except Exception as e:
         logger_texto.error(f"BD Erro (registrar_ou_atualizar_metadados_arquivo_bd) para {caminho_rel}: {e}", exc_info=True)
         return None
 
-def atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, novo_status, incremento_bytes=0, total_bytes_atuais=None, detalhes_erro=None, tempo_inicio_dados=None, tempo_fim_dados=None, checksum_final=None, duracao_final=None, velocidade_final=None):
+def atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, novo_status, incremento_bytes=0, total_bytes_atuais=None, detalhes_erro=None, tempo_inicio_dados=None, tempo_fim_dados=None, checksum_final=None, duracao_final=None, velocidade_final=None, checksum_esperado=None, caminho_servidor=None, limite_banda_final=None, tempos_fases_ns=None, duravel=False):
+    # duravel=True para o que a retomada lê (offset, status final): só retorna depois do commit
     agora_str = time.strftime('%Y-%m-%d %H:%M:%S')
     try:
-        cursor_bd = conexao_bd_local.cursor()
         campos_para_atualizar = {"status": novo_status, "last_update_timestamp": agora_str}
         if detalhes_erro is not None: campos_para_atualizar["error_details"] = detalhes_erro
         if tempo_inicio_dados: campos_para_atualizar["transfer_start_data_timestamp"] = tempo_inicio_dados
         if tempo_fim_dados: campos_para_atualizar["transfer_end_data_timestamp"] = tempo_fim_dados
         if checksum_final: campos_para_atualizar["final_calculated_checksum_hex"] = checksum_final
+        if checksum_esperado: campos_para_atualizar["expected_checksum_hex"] = checksum_esperado
+        if caminho_servidor: campos_para_atualizar["server_file_path"] = caminho_servidor
         if duracao_final is not None: campos_para_atualizar["final_duration_seconds"] = duracao_final
         if velocidade_final is not None: campos_para_atualizar["final_speed_KBps"] = velocidade_final
+        if limite_banda_final is not None: campos_para_atualizar["rate_limit_KBps"] = limite_banda_final
+        if tempos_fases_ns: campos_para_atualizar.update(tempos_fases_ns)
         
         if total_bytes_atuais is not None:
              campos_para_atualizar["current_bytes_transferred"] = total_bytes_atuais
-        elif incremento_bytes > 0:
-            cursor_bd.execute("UPDATE file_transfer_log SET current_bytes_transferred = current_bytes_transferred + ? WHERE id = ?", (incremento_bytes, id_log_arquivo))
 
         clausula_set = ", ".join([f"{chave} = ?" for chave in campos_para_atualizar.keys()])
         valores = list(campos_para_atualizar.values())
+        if total_bytes_atuais is None and incremento_bytes > 0:
+            clausula_set += ", current_bytes_transferred = current_bytes_transferred + ?"
+            valores.append(incremento_bytes)
         valores.append(id_log_arquivo)
         
-        cursor_bd.execute(f"UPDATE file_transfer_log SET {clausula_set} WHERE id = ?", valores)
-        conexao_bd_local.commit()
+        executar_escrita_bd(conexao_bd_local, f"UPDATE file_transfer_log SET {clausula_set} WHERE id = ?", valores, duravel=duravel)
     except Exception as e:
         logger_texto.error(f"BD Erro (atualizar_status_transferencia_arquivo_bd) para ID {id_log_arquivo}: {e}", exc_info=True)
+    if novo_status in STATUS_FINAIS_ARQUIVO:
+        metricas.incrementar("file_server_files_finished_total", rotulos=(("status", novo_status),))
+    for coluna_tempo, tempo_ns in (tempos_fases_ns or {}).items():
+        metricas.observar("file_server_transfer_phase_seconds", tempo_ns / 1e9, (("phase", coluna_tempo.removesuffix("_ns")),))
 
-def obter_estado_transferencia_arquivo_bd(conexao_bd_local, end_cliente, caminho_rel):
+def registrar_tempo_preparacao_bd(conexao_bd_local, id_log_arquivo, tempo_preparacao_ns):
+    metricas.observar("file_server_transfer_phase_seconds", tempo_preparacao_ns / 1e9, (("phase", "prepare"),))
+    try:
+        executar_escrita_bd(conexao_bd_local, "UPDATE file_transfer_log SET prepare_ns = ? WHERE id = ?", (tempo_preparacao_ns, id_log_arquivo))
+    except Exception as e:
+        logger_texto.error(f"BD Erro (registrar_tempo_preparacao_bd) para ID {id_log_arquivo}: {e}", exc_info=True)
+
+def obter_estado_transferencia_arquivo_bd(conexao_bd_local, id_cliente, caminho_rel):
     try:
         cursor_bd = conexao_bd_local.cursor()
         cursor_bd.execute('''
-        SELECT id, total_file_size_bytes, expected_checksum_hex, current_bytes_transferred, status 
+        SELECT id, total_file_size_bytes, expected_checksum_hex, current_bytes_transferred, status, precheck_fingerprint, checksum_algorithm, server_file_path
         FROM file_transfer_log 
-        WHERE client_address = ? AND relative_file_path = ?
-        ''', (end_cliente, caminho_rel))
+        WHERE client_id = ? AND relative_file_path = ?
+        ''', (id_cliente, caminho_rel))
         return cursor_bd.fetchone()
     except Exception as e:
         logger_texto.error(f"BD Erro (obter_estado_transferencia_arquivo_bd) para {caminho_rel}: {e}", exc_info=True)
         return None
 
+class HasheadorCRC32:
+    # Checksum não criptográfico (zlib.crc32, em C) com a mesma interface dos objetos do hashlib
+    name = "crc32"
+
+    def __init__(self, valor=0):
+        self.valor = valor
+
+    def update(self, dados):
+        self.valor = zlib.crc32(dados, self.valor)
+
+    def hexdigest(self):
+        return f"{self.valor:08x}"
+
+    def copy(self):
+        return HasheadorCRC32(self.valor)
+
+def mapear_arquivo(arquivo):
+    # Só arquivos regulares a partir de LIMIAR_ARQUIVO_MMAP; pipes, dispositivos ou falha do mmap seguem por leitura
+    if not USAR_MMAP:
+        return None
+    try:
+        info_arquivo = os.fstat(arquivo.fileno())
+        if not stat.S_ISREG(info_arquivo.st_mode) or info_arquivo.st_size < LIMIAR_ARQUIVO_MMAP:
+            return None
+        mapa = mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        logger_texto.warning(f"mmap indisponível para '{arquivo.name}' ({e}); lendo em blocos.")
+        return None
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapa.madvise(mmap.MADV_SEQUENTIAL)
+    return mapa
+
+def ler_fatias_arquivo(arquivo, offset_inicial, tamanho_a_ler, tamanho_fatia=None):
+    # Gera memoryviews do trecho pedido: fatias do próprio mapeamento em arquivos grandes (o mapeamento é solto quando a
+    # última fatia sai de uso) ou um buffer reutilizado por readinto. A fatia não vale depois da próxima iteração.
+    if tamanho_a_ler <= 0:
+        return
+    mapa = mapear_arquivo(arquivo)
+    if mapa is not None:
+        fim = min(offset_inicial + tamanho_a_ler, len(mapa))
+        visao_mapa = memoryview(mapa)
+        for posicao in range(offset_inicial, fim, tamanho_fatia or TAMANHO_FATIA_MMAP):
+            yield visao_mapa[posicao:min(posicao + (tamanho_fatia or TAMANHO_FATIA_MMAP), fim)]
+        return
+    visao_buffer = memoryview(bytearray(tamanho_fatia or TAMANHO_BUFFER_RECEPCAO))
+    arquivo.seek(offset_inicial)
+    lidos_total = 0
+    while lidos_total < tamanho_a_ler:
+        lidos = arquivo.readinto(visao_buffer[:min(len(visao_buffer), tamanho_a_ler - lidos_total)])
+        if not lidos:
+            break
+        yield visao_buffer[:lidos]
+        lidos_total += lidos
+
 def calcular_checksum(caminho_arquivo, algoritmo='md5'):
-    hasheador = hashlib.new(algoritmo)
+    # hashlib.file_digest (3.11+) lê em blocos grandes direto para um buffer reutilizado; arquivos grandes vão do mmap para o hash
+    if criar_hasheador(algoritmo) is None:
+        return None
     try:
         with open(caminho_arquivo, 'rb') as f:
-            while bloco_dados := f.read(TAMANHO_BUFFER):
+            tamanho_arquivo = os.fstat(f.fileno()).st_size
+            if USAR_MMAP and tamanho_arquivo >= LIMIAR_ARQUIVO_MMAP:
+                hasheador = criar_hasheador(algoritmo)
+                for fatia in ler_fatias_arquivo(f, 0, tamanho_arquivo):
+                    hasheador.update(fatia)
+                return hasheador.hexdigest()
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(f, lambda: criar_hasheador(algoritmo)).hexdigest()
+            hasheador = criar_hasheador(algoritmo)
+            while bloco_dados := f.read(TAMANHO_BUFFER_RECEPCAO):
                 hasheador.update(bloco_dados)
-        return hasheador.hexdigest()
+            return hasheador.hexdigest()
     except Exception: 
         return None
 
-def receber_dados_arquivo(socket_cliente, caminho_fisico_arq_servidor, tamanho_total_arq, end_cliente_str, 
-                          id_log_arq_bd, offset_inicial_transferencia, algo_checksum_esperado, checksum_hex_esperado_cliente):
-    global conexao_bd_global
+def criar_hasheador(algoritmo):
+    if algoritmo == "crc32":
+        return HasheadorCRC32()
+    try:
+        return hashlib.new(algoritmo)
+    except (ValueError, TypeError):
+        logger_texto.warning(f"Algoritmo de checksum '{algoritmo}' não suportado para verificação em fluxo.")
+        return None
+
+def calcular_hash_prefixo(caminho_arquivo, algoritmo, tamanho_prefixo):
+    hasheador = criar_hasheador(algoritmo)
+    if hasheador is None:
+        return None
+    try:
+        with open(caminho_arquivo, 'rb') as f:
+            restante = tamanho_prefixo
+            for fatia in ler_fatias_arquivo(f, 0, tamanho_prefixo):
+                hasheador.update(fatia)
+                restante -= len(fatia)
+        return hasheador if restante == 0 else None
+    except OSError:
+        return None
+
+# O hashlib não permite exportar o estado interno de um hash, então o estado parcial de uploads interrompidos
+# fica em memória (id do log -> (offset, hasheador)); após reiniciar o servidor, o prefixo é relido uma única vez.
+estados_hash_parciais = OrderedDict()
+trava_estados_hash = threading.Lock()
+
+def guardar_estado_hash_parcial(id_log_arquivo, offset, hasheador):
+    with trava_estados_hash:
+        estados_hash_parciais[id_log_arquivo] = (offset, hasheador.copy())
+        estados_hash_parciais.move_to_end(id_log_arquivo)
+        while len(estados_hash_parciais) > MAXIMO_ESTADOS_HASH_PARCIAIS:
+            estados_hash_parciais.popitem(last=False)
+
+def retomar_estado_hash(id_log_arquivo, caminho_arquivo, algoritmo, offset):
+    with trava_estados_hash:
+        estado = estados_hash_parciais.pop(id_log_arquivo, None)
+    if estado and estado[0] == offset and estado[1].name == algoritmo:
+        return estado[1]
+    logger_texto.info(f"Sem estado de hash em memória para o log {id_log_arquivo}; relendo {offset} bytes já recebidos.")
+    return calcular_hash_prefixo(caminho_arquivo, algoritmo, offset)
+
+def gravar_checkpoint_recebimento(conexao_bd_local, arquivo_servidor, id_log_arq_bd, total_bytes_no_disco):
+    # fsync antes de gravar o offset: o BD nunca aponta além do que já está no disco
+    arquivo_servidor.flush()
+    os.fsync(arquivo_servidor.fileno())
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "RECEIVING", total_bytes_atuais=total_bytes_no_disco, duravel=True)
+
+class ControleCheckpoint:
+    def __init__(self, funcao_checkpoint):
+        self.funcao_checkpoint = funcao_checkpoint
+        self.bytes_ultimo_checkpoint = 0
+        self.tempo_ultimo_checkpoint = time.monotonic()
+
+    def verificar(self, bytes_recebidos):
+        if not INTERVALO_CHECKPOINT_BYTES:
+            return
+        if bytes_recebidos - self.bytes_ultimo_checkpoint >= INTERVALO_CHECKPOINT_BYTES or time.monotonic() - self.tempo_ultimo_checkpoint >= INTERVALO_CHECKPOINT_SEGUNDOS:
+            self.funcao_checkpoint(bytes_recebidos)
+            self.bytes_ultimo_checkpoint = bytes_recebidos
+            self.tempo_ultimo_checkpoint = time.monotonic()
+
+class BaldeTokens:
+    # Token bucket com débito: reservar() desconta os bytes na hora e devolve quanto esperar até o saldo voltar a zero,
+    # então várias threads dividem a mesma taxa sem dormir segurando a trava. A taxa (bytes/s, 0 = sem limite) vem de
+    # uma função, para que um limite alterado valha já no próximo bloco.
+    def __init__(self, obter_taxa):
+        self.obter_taxa = obter_taxa
+        self.trava = threading.Lock()
+        self.saldo = 0.0
+        self.ultima_reposicao = time.monotonic()
+
+    def reservar(self, quantidade):
+        taxa = self.obter_taxa()
+        with self.trava:
+            agora = time.monotonic()
+            if not taxa:
+                self.saldo, self.ultima_reposicao = 0.0, agora
+                return 0
+            self.saldo = min(taxa * RAJADA_MAXIMA_BANDA_SEGUNDOS, self.saldo + (agora - self.ultima_reposicao) * taxa) - quantidade
+            self.ultima_reposicao = agora
+            return -self.saldo / taxa if self.saldo < 0 else 0
+
+    def consumir(self, quantidade):
+        espera = self.reservar(quantidade)
+        if espera > 0:
+            time.sleep(espera)
+
+class LimitadorBanda:
+    # Os baldes que valem para uma transferência (global, do cliente, da pasta): todos são debitados e espera-se pelo mais atrasado
+    def __init__(self, *baldes):
+        self.baldes = [balde for balde in baldes if balde is not None]
+
+    def consumir(self, quantidade):
+        espera = max((balde.reservar(quantidade) for balde in self.baldes), default=0)
+        if espera > 0:
+            time.sleep(espera)
+
+    def limite_efetivo_kbps(self):
+        taxas = [taxa for taxa in (balde.obter_taxa() for balde in self.baldes) if taxa]
+        return min(taxas) / 1024 if taxas else 0
+
+class TemposFases:
+    # Nanossegundos acumulados por fase na recepção de um arquivo, com o relógio monotônico de alta resolução
+    def __init__(self):
+        self.ns = dict.fromkeys(COLUNAS_TEMPOS_FASES, 0)
+
+    def marcar(self, fase, inicio_ns):
+        # Soma à fase o tempo desde inicio_ns e devolve o instante atual, que é o início da fase seguinte
+        agora_ns = time.perf_counter_ns()
+        self.ns[fase] += agora_ns - inicio_ns
+        return agora_ns
+
+def receber_dados_em_buffer(canal_cliente, arquivo_servidor, bytes_esperados, visao_buffer, hasheador=None, controle_checkpoint=None, limitador_banda=None, tempos_fases=None):
+    # Um único buffer pré-alocado por sessão: recv_into escreve nele e o arquivo recebe fatias de memoryview, sem bytes novos por bloco
+    if tempos_fases is None:
+        tempos_fases = TemposFases()
+    bytes_recebidos = 0
+    instante_ns = time.perf_counter_ns()
+    while bytes_recebidos < bytes_esperados:
+        lidos = canal_cliente.receber_bytes_em(visao_buffer[:min(len(visao_buffer), bytes_esperados - bytes_recebidos)])
+        if not lidos:
+            break
+        instante_ns = tempos_fases.marcar("network_receive_ns", instante_ns)
+        arquivo_servidor.write(visao_buffer[:lidos])
+        instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+        if hasheador is not None:
+            hasheador.update(visao_buffer[:lidos])
+            instante_ns = tempos_fases.marcar("checksum_ns", instante_ns)
+        bytes_recebidos += lidos
+        if controle_checkpoint is not None:
+            controle_checkpoint.verificar(bytes_recebidos)
+            instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+        if limitador_banda is not None:
+            limitador_banda.consumir(lidos)
+            instante_ns = time.perf_counter_ns() # A espera do limite de banda não entra em nenhuma fase
+    return bytes_recebidos
+
+# Descompressores em fluxo por codec negociado. descomprimir() entrega a saída em pedaços de até maximo bytes, então um
+# quadro pequeno que infla para gigabytes (bomba de compressão) nunca fica inteiro na memória
+class DescompressorZlib:
+    def __init__(self):
+        self.descompressor = zlib.decompressobj()
+
+    def descomprimir(self, dados, maximo, entregar):
+        while True:
+            saida = self.descompressor.decompress(dados, maximo)
+            if saida:
+                entregar(saida)
+            dados = self.descompressor.unconsumed_tail
+            if not dados and len(saida) < maximo:
+                break
+
+class DescompressorLzma:
+    def __init__(self):
+        self.descompressor = lzma.LZMADecompressor()
+
+    def descomprimir(self, dados, maximo, entregar):
+        saida = self.descompressor.decompress(dados, maximo)
+        while True:
+            if saida:
+                entregar(saida)
+            if self.descompressor.needs_input or self.descompressor.eof:
+                break
+            saida = self.descompressor.decompress(b"", maximo)
+
+class DescompressorZstd:
+    # O zstandard não limita a saída de decompressobj(); o stream_writer repassa a saída em pedaços de write_size
+    def __init__(self):
+        self.entregar = None
+        self.escritor = zstandard.ZstdDecompressor().stream_writer(self, write_size=TAMANHO_BUFFER_RECEPCAO)
+
+    def write(self, dados):
+        self.entregar(bytes(dados))
+        return len(dados)
+
+    def descomprimir(self, dados, maximo, entregar):
+        self.entregar = entregar
+        self.escritor.write(dados)
+
+DESCOMPRESSORES = {
+    "zlib": DescompressorZlib,
+    "lzma": DescompressorLzma,
+}
+if zstandard:
+    DESCOMPRESSORES["zstd"] = DescompressorZstd
+
+def receber_dados_comprimidos(canal_cliente, arquivo_servidor, bytes_esperados, descompressor, hasheador=None, controle_checkpoint=None, limitador_banda=None, tempos_fases=None):
+    # Quadros com a saída do compressor do cliente até um quadro vazio; a contagem é em bytes descomprimidos e o limite de banda, nos da rede
+    if tempos_fases is None:
+        tempos_fases = TemposFases()
+    bytes_recebidos = 0
+    instante_ns = time.perf_counter_ns()
+
+    def gravar_pedaco(dados):
+        nonlocal bytes_recebidos, instante_ns
+        if bytes_recebidos + len(dados) > bytes_esperados:
+            raise ErroProtocolo(f"Dados descomprimidos excedem os {bytes_esperados} bytes anunciados.")
+        instante_ns = time.perf_counter_ns() # A descompressão só aparece no tempo total
+        arquivo_servidor.write(dados)
+        instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+        if hasheador is not None:
+            hasheador.update(dados)
+            instante_ns = tempos_fases.marcar("checksum_ns", instante_ns)
+        bytes_recebidos += len(dados)
+        if controle_checkpoint is not None:
+            controle_checkpoint.verificar(bytes_recebidos)
+            instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+
+    while True:
+        try:
+            quadro = canal_cliente.receber_mensagem()
+        except ErroProtocolo:
+            break # Conexão caiu no meio de um quadro: tratado como desconexão
+        if not quadro:
+            break
+        tempos_fases.marcar("network_receive_ns", instante_ns)
+        # Um byte além do que falta basta para detectar excesso sem inflar o resto
+        descompressor.descomprimir(quadro, min(TAMANHO_BUFFER_RECEPCAO, bytes_esperados - bytes_recebidos + 1), gravar_pedaco)
+        if limitador_banda is not None:
+            limitador_banda.consumir(len(quadro))
+            instante_ns = time.perf_counter_ns()
+    return bytes_recebidos
+
+def receber_dados_splice(canal_cliente, arquivo_servidor, offset_inicial, bytes_esperados, controle_checkpoint=None, limitador_banda=None, tempos_fases=None):
+    # Linux: socket -> pipe -> arquivo inteiramente no kernel. Rede é o splice para o pipe; disco, do pipe para o arquivo
+    if tempos_fases is None:
+        tempos_fases = TemposFases()
+    bytes_recebidos = 0
+    while canal_cliente.buffer_leitura and bytes_recebidos < bytes_esperados:
+        bloco = canal_cliente.receber_bytes(bytes_esperados - bytes_recebidos)
+        arquivo_servidor.write(bloco)
+        bytes_recebidos += len(bloco)
+    arquivo_servidor.flush()
+
+    fd_leitura_pipe, fd_escrita_pipe = os.pipe()
+    try:
+        if fcntl and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(fd_escrita_pipe, fcntl.F_SETPIPE_SZ, TAMANHO_BUFFER_RECEPCAO)
+            except OSError:
+                pass # Sem permissão para aumentar o pipe: segue com o tamanho padrão
+        fd_socket = canal_cliente.sock.fileno()
+        fd_arquivo = arquivo_servidor.fileno()
+        instante_ns = time.perf_counter_ns()
+        while bytes_recebidos < bytes_esperados:
+            bytes_antes_splice = bytes_recebidos
+            no_pipe = os.splice(fd_socket, fd_escrita_pipe, min(TAMANHO_BUFFER_RECEPCAO, bytes_esperados - bytes_recebidos))
+            if not no_pipe:
+                break
+            metricas.incrementar("file_server_received_bytes_total", no_pipe)
+            instante_ns = tempos_fases.marcar("network_receive_ns", instante_ns)
+            while no_pipe:
+                gravados = os.splice(fd_leitura_pipe, fd_arquivo, no_pipe, offset_dst=offset_inicial + bytes_recebidos)
+                no_pipe -= gravados
+                bytes_recebidos += gravados
+            if controle_checkpoint is not None:
+                controle_checkpoint.verificar(bytes_recebidos)
+            instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+            if limitador_banda is not None:
+                limitador_banda.consumir(bytes_recebidos - bytes_antes_splice)
+                instante_ns = time.perf_counter_ns()
+    finally:
+        os.close(fd_leitura_pipe)
+        os.close(fd_escrita_pipe)
+    return bytes_recebidos
+
+def receber_dados_arquivo(conexao_bd_local, canal_cliente, caminho_fisico_arq_servidor, tamanho_total_arq, end_cliente_str, 
+                          id_log_arq_bd, offset_inicial_transferencia, algo_checksum_esperado, checksum_hex_esperado_cliente, buffer_recepcao=None, codec_compressao=None, limitador_banda=None):
     logger_texto.info(f"Recebendo dados para '{os.path.basename(caminho_fisico_arq_servidor)}'. Total: {tamanho_total_arq} bytes. Offset inicial: {offset_inicial_transferencia}.")
     
     bytes_escritos_nesta_sessao = 0
     status_final_para_cliente = "FILE_DATA_ERROR"
+    hasheador_fluxo = None
+    tempos_fases = TemposFases()
     
     modo_abertura_arquivo = 'wb' if offset_inicial_transferencia == 0 else 'r+b'
+    if offset_inicial_transferencia == 0 and os.path.lexists(caminho_fisico_arq_servidor):
+        os.remove(caminho_fisico_arq_servidor) # Pode ser um hardlink para um blob: truncar no lugar alteraria o blob
     
     try:
         with open(caminho_fisico_arq_servidor, modo_abertura_arquivo) as arquivo_servidor:
@@ -178,59 +975,92 @@ def receber_dados_arquivo(socket_cliente, caminho_fisico_arq_servidor, tamanho_t
             bytes_esperados_nesta_sessao = tamanho_total_arq - offset_inicial_transferencia
             
             status_recebimento = "RECEIVING"
+            # Marcas de tempo guardadas localmente: as escritas não duráveis podem ainda não estar no BD quando a duração é calculada
+            tempo_inicio_dados_str = None
             if offset_inicial_transferencia == 0:
-                 atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, status_recebimento, tempo_inicio_dados=time.strftime('%Y-%m-%d %H:%M:%S'))
+                 tempo_inicio_dados_str = time.strftime('%Y-%m-%d %H:%M:%S')
+                 atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, status_recebimento, tempo_inicio_dados=tempo_inicio_dados_str, caminho_servidor=caminho_fisico_arq_servidor)
             else:
-                 atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, status_recebimento)
-
-            while bytes_escritos_nesta_sessao < bytes_esperados_nesta_sessao:
-                bytes_para_ler_agora = min(TAMANHO_BUFFER, bytes_esperados_nesta_sessao - bytes_escritos_nesta_sessao)
-                bloco_recebido = socket_cliente.recv(bytes_para_ler_agora)
-                if not bloco_recebido:
-                    logger_texto.warning(f"Conexão perdida por {end_cliente_str} durante transferência de '{os.path.basename(caminho_fisico_arq_servidor)}'.")
-                    atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "PAUSED_DISCONNECT", 
-                                                total_bytes_atuais=(offset_inicial_transferencia + bytes_escritos_nesta_sessao),
-                                                detalhes_erro="Conexão perdida durante transferência de dados.")
-                    return "FILE_DATA_ERROR"
-                arquivo_servidor.write(bloco_recebido)
-                bytes_escritos_nesta_sessao += len(bloco_recebido)
+                 atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, status_recebimento, caminho_servidor=caminho_fisico_arq_servidor)
+            controle_checkpoint = ControleCheckpoint(lambda bytes_recebidos: gravar_checkpoint_recebimento(conexao_bd_local, arquivo_servidor, id_log_arq_bd, offset_inicial_transferencia + bytes_recebidos))
+
+            # Duração e fases desta sessão, em ns monotônicos: numa retomada contam só os bytes recebidos agora
+            inicio_dados_ns = time.perf_counter_ns()
+            if USAR_SPLICE_LINUX and hasattr(os, 'splice') and not codec_compressao:
+                # Os dados não passam pelo espaço de usuário: o checksum é calculado relendo o arquivo no final
+                bytes_escritos_nesta_sessao = receber_dados_splice(canal_cliente, arquivo_servidor, offset_inicial_transferencia, bytes_esperados_nesta_sessao, controle_checkpoint, limitador_banda, tempos_fases)
+            else:
+                if offset_inicial_transferencia > 0:
+                    hasheador_fluxo = retomar_estado_hash(id_log_arq_bd, caminho_fisico_arq_servidor, algo_checksum_esperado, offset_inicial_transferencia)
+                else:
+                    hasheador_fluxo = criar_hasheador(algo_checksum_esperado)
+                tempos_fases.marcar("checksum_ns", inicio_dados_ns)
+                if codec_compressao:
+                    bytes_escritos_nesta_sessao = receber_dados_comprimidos(canal_cliente, arquivo_servidor, bytes_esperados_nesta_sessao, DESCOMPRESSORES[codec_compressao](), hasheador_fluxo, controle_checkpoint, limitador_banda, tempos_fases)
+                else:
+                    if buffer_recepcao is None:
+                        buffer_recepcao = bytearray(TAMANHO_BUFFER_RECEPCAO)
+                    bytes_escritos_nesta_sessao = receber_dados_em_buffer(canal_cliente, arquivo_servidor, bytes_esperados_nesta_sessao, memoryview(buffer_recepcao), hasheador_fluxo, controle_checkpoint, limitador_banda, tempos_fases)
+
+            if bytes_escritos_nesta_sessao < bytes_esperados_nesta_sessao:
+                if hasheador_fluxo is not None:
+                    guardar_estado_hash_parcial(id_log_arq_bd, offset_inicial_transferencia + bytes_escritos_nesta_sessao, hasheador_fluxo)
+                logger_texto.warning(f"Conexão perdida por {end_cliente_str} durante transferência de '{os.path.basename(caminho_fisico_arq_servidor)}'.")
+                atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "PAUSED_DISCONNECT", 
+                                            total_bytes_atuais=(offset_inicial_transferencia + bytes_escritos_nesta_sessao),
+                                            detalhes_erro="Conexão perdida durante transferência de dados.", duravel=True)
+                return "FILE_DATA_ERROR"
 
         total_bytes_atuais_no_disco = offset_inicial_transferencia + bytes_escritos_nesta_sessao
-        atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "COMPLETED_DATA_RECEIVED", 
+        if checksum_hex_esperado_cliente is None:
+            # Modo trailer: o cliente calcula o checksum enquanto envia e o manda logo após o último byte
+            instante_ns = time.perf_counter_ns()
+            mensagem_trailer = canal_cliente.receber_mensagem().decode('utf-8', 'ignore')
+            tempos_fases.marcar("network_receive_ns", instante_ns)
+            if not mensagem_trailer.startswith("FILE_CHECKSUM_TRAILER:"):
+                logger_texto.warning(f"Trailer de checksum ausente para '{os.path.basename(caminho_fisico_arq_servidor)}' ({mensagem_trailer[:100] or 'conexão encerrada'}).")
+                if hasheador_fluxo is not None:
+                    guardar_estado_hash_parcial(id_log_arq_bd, total_bytes_atuais_no_disco, hasheador_fluxo)
+                atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "PAUSED_DISCONNECT", total_bytes_atuais=total_bytes_atuais_no_disco,
+                                            detalhes_erro="Dados recebidos, mas o trailer de checksum não chegou.", duravel=True)
+                return "FILE_DATA_ERROR"
+            checksum_hex_esperado_cliente = mensagem_trailer.split(":", 1)[1]
+            atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "RECEIVING", checksum_esperado=checksum_hex_esperado_cliente)
+
+        tempos_fases.marcar("data_transfer_ns", inicio_dados_ns)
+        tempo_fim_dados_str = time.strftime('%Y-%m-%d %H:%M:%S')
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "COMPLETED_DATA_RECEIVED", 
                                     total_bytes_atuais=total_bytes_atuais_no_disco,
-                                    tempo_fim_dados=time.strftime('%Y-%m-%d %H:%M:%S'))
+                                    tempo_fim_dados=tempo_fim_dados_str)
         logger_texto.info(f"Todos os dados esperados para '{os.path.basename(caminho_fisico_arq_servidor)}' recebidos. Total no disco: {total_bytes_atuais_no_disco} bytes.")
 
         if total_bytes_atuais_no_disco == tamanho_total_arq:
-            logger_texto.info(f"Arquivo '{os.path.basename(caminho_fisico_arq_servidor)}' completo. Calculando checksum...")
-            checksum_calculado_servidor = calcular_checksum(caminho_fisico_arq_servidor, algo_checksum_esperado)
+            inicio_verificacao_ns = time.perf_counter_ns()
+            if hasheador_fluxo is not None:
+                checksum_calculado_servidor = hasheador_fluxo.hexdigest()
+            else:
+                logger_texto.info(f"Arquivo '{os.path.basename(caminho_fisico_arq_servidor)}' completo. Calculando checksum...")
+                checksum_calculado_servidor = calcular_checksum(caminho_fisico_arq_servidor, algo_checksum_esperado)
+            tempos_fases.marcar("verify_ns", inicio_verificacao_ns)
             logger_texto.info(f"Checksum calculado no servidor ({algo_checksum_esperado}): {checksum_calculado_servidor}")
 
-            cursor_bd = conexao_bd_global.cursor()
-            cursor_bd.execute("SELECT transfer_start_data_timestamp, transfer_end_data_timestamp FROM file_transfer_log WHERE id = ?", (id_log_arq_bd,))
-            marcas_tempo = cursor_bd.fetchone()
-            duracao_transferencia = 0
-            velocidade_transferencia = 0
-            if marcas_tempo and marcas_tempo[0] and marcas_tempo[1]:
-                try:
-                    inicio_dt = time.mktime(time.strptime(marcas_tempo[0], '%Y-%m-%d %H:%M:%S'))
-                    fim_dt = time.mktime(time.strptime(marcas_tempo[1], '%Y-%m-%d %H:%M:%S'))
-                    duracao_transferencia = fim_dt - inicio_dt
-                    if duracao_transferencia > 0:
-                        velocidade_transferencia = (tamanho_total_arq / 1024) / duracao_transferencia
-                except ValueError:
-                     logger_texto.warning("Não foi possível parsear timestamps para cálculo de duração/velocidade.")
+            duracao_transferencia = tempos_fases.ns["data_transfer_ns"] / 1e9
+            velocidade_transferencia = (bytes_escritos_nesta_sessao / 1024) / duracao_transferencia if duracao_transferencia > 0 else 0
+            limite_banda_kbps = limitador_banda.limite_efetivo_kbps() if limitador_banda is not None else 0
 
             if checksum_calculado_servidor == checksum_hex_esperado_cliente:
                 logger_texto.info(f"CHECKSUM OK para '{os.path.basename(caminho_fisico_arq_servidor)}'.")
-                atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "SUCCESS_CHECKSUM_OK", 
-                                            checksum_final=checksum_calculado_servidor, duracao_final=duracao_transferencia, velocidade_final=velocidade_transferencia)
+                atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "SUCCESS_CHECKSUM_OK", 
+                                            checksum_final=checksum_calculado_servidor, duracao_final=duracao_transferencia, velocidade_final=velocidade_transferencia, limite_banda_final=limite_banda_kbps,
+                                            tempos_fases_ns=tempos_fases.ns, duravel=True)
+                guardar_no_armazem_blobs(conexao_bd_local, caminho_fisico_arq_servidor, algo_checksum_esperado, checksum_calculado_servidor, tamanho_total_arq)
                 status_final_para_cliente = "FILE_CHECKSUM_OK"
             else:
                 logger_texto.error(f"CHECKSUM MISMATCH para '{os.path.basename(caminho_fisico_arq_servidor)}'. Esperado: {checksum_hex_esperado_cliente}, Calculado: {checksum_calculado_servidor}")
                 detalhes = f"Esperado: {checksum_hex_esperado_cliente}, Calculado: {checksum_calculado_servidor}"
-                atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "FAIL_CHECKSUM_MISMATCH", 
-                                            checksum_final=checksum_calculado_servidor, duracao_final=duracao_transferencia, velocidade_final=velocidade_transferencia, detalhes_erro=detalhes)
+                atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "FAIL_CHECKSUM_MISMATCH", total_bytes_atuais=0,
+                                            checksum_final=checksum_calculado_servidor, duracao_final=duracao_transferencia, velocidade_final=velocidade_transferencia, limite_banda_final=limite_banda_kbps,
+                                            tempos_fases_ns=tempos_fases.ns, detalhes_erro=detalhes, duravel=True)
                 try:
                     os.remove(caminho_fisico_arq_servidor)
                     logger_texto.info(f"Arquivo corrompido '{caminho_fisico_arq_servidor}' removido.")
@@ -239,172 +1069,883 @@ def receber_dados_arquivo(socket_cliente, caminho_fisico_arq_servidor, tamanho_t
                 status_final_para_cliente = "FILE_CHECKSUM_MISMATCH"
         else:
              status_final_para_cliente = "FILE_DATA_ERROR" 
-             atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "FAIL_DATA_INCOMPLETE", detalhes_erro=f"Cliente enviou dados, mas arquivo finalizou com {total_bytes_atuais_no_disco}/{tamanho_total_arq} bytes.")
+             atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "FAIL_DATA_INCOMPLETE", detalhes_erro=f"Cliente enviou dados, mas arquivo finalizou com {total_bytes_atuais_no_disco}/{tamanho_total_arq} bytes.", duravel=True)
 
     except FileNotFoundError:
         logger_texto.error(f"FNF Erro ao tentar abrir/escrever em '{caminho_fisico_arq_servidor}' (offset {offset_inicial_transferencia}).", exc_info=True)
-        atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "FAIL_SERVER_ERROR", detalhes_erro=f"FileNotFound ao tentar escrever: {caminho_fisico_arq_servidor}")
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "FAIL_SERVER_ERROR", detalhes_erro=f"FileNotFound ao tentar escrever: {caminho_fisico_arq_servidor}")
         status_final_para_cliente = "FILE_DATA_ERROR" 
     except Exception as e:
         logger_texto.error(f"Exceção em receber_dados_arquivo para '{os.path.basename(caminho_fisico_arq_servidor)}': {e}", exc_info=True)
-        atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arq_bd, "FAIL_SERVER_ERROR", 
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "FAIL_SERVER_ERROR", 
                                     total_bytes_atuais=(offset_inicial_transferencia + bytes_escritos_nesta_sessao),
-                                    detalhes_erro=str(e))
+                                    detalhes_erro=str(e), duravel=True)
         status_final_para_cliente = "FILE_DATA_ERROR" 
         
     return status_final_para_cliente
 
+def mesmo_conteudo_registrado(estado_arquivo_bd, tamanho_total, checksum_esp, impressao_rapida):
+    # (id, total_size, expected_checksum, current_bytes, status, precheck_fingerprint, checksum_algorithm, server_file_path)
+    if not estado_arquivo_bd or estado_arquivo_bd[1] != tamanho_total:
+        return False
+    if checksum_esp:
+        return estado_arquivo_bd[2] == checksum_esp
+    return impressao_rapida is not None and estado_arquivo_bd[5] == impressao_rapida
+
+def mesma_copia_em_outro_algoritmo(estado_arquivo_bd, tamanho_total, algo_checksum, checksum_esp):
+    # Cliente trocou de algoritmo de checksum: a cópia já confirmada é rechecada no novo algoritmo em vez de reenviada
+    if not estado_arquivo_bd or not checksum_esp or estado_arquivo_bd[4] != 'SUCCESS_CHECKSUM_OK' or estado_arquivo_bd[6] == algo_checksum:
+        return False
+    if estado_arquivo_bd[1] != tamanho_total or not estado_arquivo_bd[7] or not os.path.isfile(estado_arquivo_bd[7]):
+        return False
+    return calcular_checksum(estado_arquivo_bd[7], algo_checksum) == checksum_esp
+
+def decidir_preparacao_arquivo(conexao_bd_local, id_cliente, end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp, impressao_rapida=None):
+    # Retorna (resposta de protocolo, id do log); id None indica falha no BD.
+    # Sem checksum (modo trailer), a decisão de pular/retomar usa a impressão rápida enviada pelo cliente.
+    estado_anterior_bd = obter_estado_transferencia_arquivo_bd(conexao_bd_local, id_cliente, caminho_rel)
+    copia_rechecada = mesma_copia_em_outro_algoritmo(estado_anterior_bd, tamanho_total, algo_checksum, checksum_esp)
+    id_log_arquivo = registrar_ou_atualizar_metadados_arquivo_bd(conexao_bd_local, id_cliente, end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp, 'AWAITING_PREPARE', impressao_rapida)
+    if not id_log_arquivo:
+        return "ERROR_SERVER_DB_ISSUE", None
+
+    if copia_rechecada:
+        # O registro acabou de ser reiniciado por causa do checksum diferente: volta ao estado confirmado
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "SUCCESS_CHECKSUM_OK", total_bytes_atuais=tamanho_total, checksum_final=checksum_esp)
+    conteudo_igual = copia_rechecada or mesmo_conteudo_registrado(estado_anterior_bd, tamanho_total, checksum_esp, impressao_rapida)
+    if conteudo_igual and estado_anterior_bd[4] == 'SUCCESS_CHECKSUM_OK':
+        logger_texto.info(f"Arquivo '{caminho_rel}' já existe e checksum OK. Informando cliente.")
+        metricas.incrementar("file_server_prepare_decisions_total", rotulos=(("decision", "already_ok"),))
+        return "FILE_ALREADY_EXISTS_CHECKSUM_OK", id_log_arquivo
+    elif conteudo_igual:
+        offset_para_retomar = estado_anterior_bd[3]
+        logger_texto.info(f"Retomando '{caminho_rel}' do offset {offset_para_retomar}. Total {tamanho_total}.")
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "AWAITING_DATA")
+        metricas.incrementar("file_server_prepare_decisions_total", rotulos=(("decision", "resume"),))
+        return f"RESUME_FROM_OFFSET:{offset_para_retomar}", id_log_arquivo
+    else: 
+        logger_texto.info(f"Iniciando nova transferência para '{caminho_rel}'. Offset 0. Total {tamanho_total}.")
+        if estado_anterior_bd:
+             atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "AWAITING_PREPARE", total_bytes_atuais=0, detalhes_erro="Metadados do arquivo mudaram, reiniciando.")
+            
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "AWAITING_DATA")
+        metricas.incrementar("file_server_prepare_decisions_total", rotulos=(("decision", "new"),))
+        return "SEND_FROM_OFFSET:0", id_log_arquivo
+
+def preparar_destino_arquivo(conexao_bd_local, id_log_arquivo, caminho_base_upload):
+    cursor_bd = conexao_bd_local.cursor()
+    cursor_bd.execute("SELECT relative_file_path, total_file_size_bytes, current_bytes_transferred, checksum_algorithm, expected_checksum_hex FROM file_transfer_log WHERE id = ?", (id_log_arquivo,))
+    info_arquivo_bd = cursor_bd.fetchone()
+    if not info_arquivo_bd:
+        logger_texto.error(f"Não foi possível encontrar info no BD para file_log_id {id_log_arquivo}")
+        return None
+
+    cam_rel_bd, tam_total_bd, offset_bd, cs_algo_bd, cs_hex_bd = info_arquivo_bd
+    caminho_fisico_completo_arq = os.path.join(caminho_base_upload, cam_rel_bd)
+    diretorio_do_arquivo = os.path.dirname(caminho_fisico_completo_arq)
+    if not os.path.exists(diretorio_do_arquivo): os.makedirs(diretorio_do_arquivo, exist_ok=True)
+    return caminho_fisico_completo_arq, tam_total_bd, offset_bd, cs_algo_bd, cs_hex_bd
+
+def caminho_blob(algoritmo, checksum_hex, tamanho):
+    return os.path.join(PASTA_BLOBS, algoritmo, checksum_hex[:2], f"{checksum_hex}-{tamanho}")
+
+def clonar_arquivo(caminho_origem, caminho_destino):
+    # Hardlink quando possível; senão reflink (Linux, FICLONE) e, por último, cópia. O destino é trocado atomicamente.
+    caminho_temporario = f"{caminho_destino}.dedup-{threading.get_ident()}"
+    try:
+        os.link(caminho_origem, caminho_temporario)
+    except OSError:
+        with open(caminho_origem, 'rb') as arquivo_origem, open(caminho_temporario, 'wb') as arquivo_destino:
+            try:
+                if not fcntl:
+                    raise OSError("reflink indisponível")
+                fcntl.ioctl(arquivo_destino.fileno(), getattr(fcntl, 'FICLONE', FICLONE_LINUX), arquivo_origem.fileno())
+            except OSError:
+                shutil.copyfileobj(arquivo_origem, arquivo_destino, TAMANHO_BUFFER_RECEPCAO)
+    os.replace(caminho_temporario, caminho_destino)
+
+def buscar_blob_bd(conexao_bd_local, algoritmo, checksum_hex, tamanho):
+    cursor_bd = conexao_bd_local.cursor()
+    cursor_bd.execute("SELECT blob_path FROM content_blob_index WHERE checksum_algorithm = ? AND checksum_hex = ? AND size_bytes = ?", (algoritmo, checksum_hex, tamanho))
+    linha = cursor_bd.fetchone()
+    if not linha:
+        return None
+    if not os.path.isfile(linha[0]) or os.path.getsize(linha[0]) != tamanho:
+        logger_texto.warning(f"Blob '{linha[0]}' sumiu ou mudou de tamanho; removendo do índice.")
+        executar_escrita_bd(conexao_bd_local, "DELETE FROM content_blob_index WHERE checksum_algorithm = ? AND checksum_hex = ? AND size_bytes = ?", (algoritmo, checksum_hex, tamanho))
+        return None
+    return linha[0]
+
+def guardar_no_armazem_blobs(conexao_bd_local, caminho_fisico_arq, algoritmo, checksum_hex, tamanho):
+    # Chamado depois do checksum OK: conteúdo novo vira blob; conteúdo já conhecido troca a cópia recebida por um link para o blob
+    if algoritmo in ALGORITMOS_SO_INTEGRIDADE:
+        return
+    try:
+        caminho_blob_existente = buscar_blob_bd(conexao_bd_local, algoritmo, checksum_hex, tamanho)
+        if caminho_blob_existente:
+            if not os.path.samefile(caminho_blob_existente, caminho_fisico_arq):
+                clonar_arquivo(caminho_blob_existente, caminho_fisico_arq)
+            return
+        caminho_blob_novo = caminho_blob(algoritmo, checksum_hex, tamanho)
+        os.makedirs(os.path.dirname(caminho_blob_novo), exist_ok=True)
+        if not os.path.exists(caminho_blob_novo):
+            clonar_arquivo(caminho_fisico_arq, caminho_blob_novo)
+        executar_escrita_bd(conexao_bd_local, "INSERT OR IGNORE INTO content_blob_index (checksum_algorithm, checksum_hex, size_bytes, blob_path) VALUES (?, ?, ?, ?)",
+                            (algoritmo, checksum_hex, tamanho, caminho_blob_novo))
+    except Exception as e:
+        logger_texto.error(f"Erro ao guardar '{caminho_fisico_arq}' no armazém de blobs: {e}", exc_info=True)
+
+def deduplicar_preparacao(conexao_bd_local, resposta_preparacao, id_log_arquivo, end_cliente, caminho_base_upload, caminho_rel, tamanho_total, algo_checksum, checksum_esp):
+    # Conteúdo já presente no armazém (de qualquer cliente, pasta ou nome): materializa o arquivo e dispensa o envio
+    if not id_log_arquivo or not checksum_esp or algo_checksum in ALGORITMOS_SO_INTEGRIDADE or not resposta_preparacao.startswith(("SEND_FROM_OFFSET:", "RESUME_FROM_OFFSET:")):
+        return resposta_preparacao
+    caminho_blob_existente = buscar_blob_bd(conexao_bd_local, algo_checksum, checksum_esp, tamanho_total)
+    if not caminho_blob_existente:
+        return resposta_preparacao
+    caminho_fisico_completo_arq = os.path.join(caminho_base_upload, caminho_rel)
+    try:
+        os.makedirs(os.path.dirname(caminho_fisico_completo_arq), exist_ok=True)
+        clonar_arquivo(caminho_blob_existente, caminho_fisico_completo_arq)
+    except OSError as e:
+        logger_texto.error(f"Falha ao materializar '{caminho_rel}' a partir do blob: {e}. Seguindo com o envio normal.")
+        return resposta_preparacao
+    agora_str = time.strftime('%Y-%m-%d %H:%M:%S')
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "SUCCESS_CHECKSUM_OK", total_bytes_atuais=tamanho_total, checksum_final=checksum_esp,
+                                              tempo_inicio_dados=agora_str, tempo_fim_dados=agora_str, caminho_servidor=caminho_fisico_completo_arq, detalhes_erro="Deduplicado a partir do armazém de blobs.", duravel=True)
+    registrar_evento_geral_bd(conexao_bd_local, "FILE_DEDUPLICATED", end_cliente, f"Arquivo: {caminho_rel}, Blob: {caminho_blob_existente}")
+    logger_texto.info(f"'{caminho_rel}' deduplicado a partir de '{caminho_blob_existente}'. Cliente não precisa enviar.")
+    metricas.incrementar("file_server_prepare_decisions_total", rotulos=(("decision", "deduplicated"),))
+    return "FILE_ALREADY_EXISTS_CHECKSUM_OK"
+
+# Transferência delta (estilo rsync): o servidor manda assinaturas por bloco da cópia que já tem
+# (Adler-32 como fraca, BLAKE2b de 128 bits como forte) e o cliente responde com literais e cópias de blocos.
+def tamanho_bloco_delta(tamanho_arquivo):
+    tamanho_bloco = max(TAMANHO_MINIMO_BLOCO_DELTA, math.isqrt(tamanho_arquivo), -(-tamanho_arquivo // MAXIMO_BLOCOS_DELTA))
+    return -(-tamanho_bloco // 1024) * 1024
+
+def calcular_assinaturas_delta(caminho_arquivo, tamanho_bloco):
+    fracas, fortes = [], []
+    with open(caminho_arquivo, 'rb') as f:
+        for bloco_dados in ler_fatias_arquivo(f, 0, os.fstat(f.fileno()).st_size, tamanho_bloco):
+            fracas.append(zlib.adler32(bloco_dados))
+            fortes.append(hashlib.blake2b(bloco_dados, digest_size=16).hexdigest())
+    return fracas, fortes
+
+def oferecer_transferencia_delta(caminho_base_upload, caminho_rel, resposta_preparacao):
+    # Retorna (resposta de protocolo, assinaturas ou None). Só vale para envios desde o início com uma cópia antiga no disco.
+    if resposta_preparacao not in ("SEND_FROM_OFFSET:0", "RESUME_FROM_OFFSET:0"):
+        return resposta_preparacao, None
+    caminho_fisico_completo_arq = os.path.join(caminho_base_upload, caminho_rel)
+    try:
+        if not os.path.isfile(caminho_fisico_completo_arq) or os.path.getsize(caminho_fisico_completo_arq) < TAMANHO_MINIMO_ARQUIVO_DELTA:
+            return resposta_preparacao, None
+        tamanho_bloco = tamanho_bloco_delta(os.path.getsize(caminho_fisico_completo_arq))
+        fracas, fortes = calcular_assinaturas_delta(caminho_fisico_completo_arq, tamanho_bloco)
+    except OSError as e:
+        logger_texto.warning(f"Não foi possível calcular assinaturas delta de '{caminho_rel}': {e}. Envio completo.")
+        return resposta_preparacao, None
+    logger_texto.info(f"Oferecendo delta para '{caminho_rel}': {len(fracas)} blocos de {tamanho_bloco} bytes.")
+    return f"SEND_DELTA:{tamanho_bloco}", {"path": caminho_rel, "block_size": tamanho_bloco, "weak": fracas, "strong": fortes}
+
+def descartar_quadros_delta(canal_cliente):
+    while mensagem := canal_cliente.receber_mensagem():
+        if mensagem.startswith(b"DELTA_END:"):
+            return True
+    return False
+
+def receber_delta_arquivo(conexao_bd_local, canal_cliente, caminho_fisico_arq_servidor, tamanho_total_arq, end_cliente_str,
+                          id_log_arq_bd, tamanho_bloco, algo_checksum_esperado, checksum_hex_esperado_cliente, limitador_banda=None):
+    # O arquivo novo é montado num temporário a partir da cópia antiga (que pode ser um hardlink para um blob) e só a substitui depois do checksum OK.
+    # Os status de falha próprios do delta ficam fora da reconciliação de offsets: o arquivo no disco é a versão anterior, não um envio parcial.
+    caminho_temporario = f"{caminho_fisico_arq_servidor}.delta-{id_log_arq_bd}"
+    hasheador_fluxo = criar_hasheador(algo_checksum_esperado)
+    tempos_fases = TemposFases()
+    inicio_dados_ns = time.perf_counter_ns()
+    tempo_inicio_dados_str = time.strftime('%Y-%m-%d %H:%M:%S')
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "RECEIVING_DELTA", total_bytes_atuais=0, tempo_inicio_dados=tempo_inicio_dados_str, caminho_servidor=caminho_fisico_arq_servidor)
+    bytes_literais = bytes_copiados = 0
+    checksum_trailer = None
+    try:
+        tamanho_base = os.path.getsize(caminho_fisico_arq_servidor)
+        with open(caminho_fisico_arq_servidor, 'rb') as arquivo_base, open(caminho_temporario, 'wb') as arquivo_novo:
+            instante_ns = time.perf_counter_ns()
+            while checksum_trailer is None:
+                mensagem = canal_cliente.receber_mensagem()
+                instante_ns = tempos_fases.marcar("network_receive_ns", instante_ns)
+                if not mensagem:
+                    logger_texto.warning(f"Conexão perdida por {end_cliente_str} durante o delta de '{os.path.basename(caminho_fisico_arq_servidor)}'.")
+                    arquivo_novo.close()
+                    os.remove(caminho_temporario)
+                    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "PAUSED_DELTA_DISCONNECT", total_bytes_atuais=0,
+                                                              detalhes_erro="Conexão perdida durante transferência delta.", duravel=True)
+                    return "FILE_DATA_ERROR"
+                if mensagem.startswith(b"DELTA_LITERAL:"):
+                    dados = memoryview(mensagem)[len(b"DELTA_LITERAL:"):]
+                    arquivo_novo.write(dados)
+                    instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+                    if hasheador_fluxo is not None:
+                        hasheador_fluxo.update(dados)
+                        instante_ns = tempos_fases.marcar("checksum_ns", instante_ns)
+                    bytes_literais += len(dados)
+                    if limitador_banda is not None:
+                        limitador_banda.consumir(len(dados))
+                        instante_ns = time.perf_counter_ns()
+                elif mensagem.startswith(b"DELTA_COPY:"):
+                    _, indice_bloco, quantidade_blocos = mensagem.decode('utf-8').split(":")
+                    posicao = int(indice_bloco) * tamanho_bloco
+                    restante = min(int(quantidade_blocos) * tamanho_bloco, tamanho_base - posicao)
+                    if posicao < 0 or restante <= 0:
+                        raise ErroProtocolo(f"DELTA_COPY fora da cópia do servidor: {mensagem[:100]!r}")
+                    for dados in ler_fatias_arquivo(arquivo_base, posicao, restante):
+                        arquivo_novo.write(dados)
+                        instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+                        if hasheador_fluxo is not None:
+                            hasheador_fluxo.update(dados)
+                            instante_ns = tempos_fases.marcar("checksum_ns", instante_ns)
+                        bytes_copiados += len(dados)
+                elif mensagem.startswith(b"DELTA_END:"):
+                    checksum_trailer = mensagem.decode('utf-8').split(":", 1)[1]
+                else:
+                    raise ErroProtocolo(f"Quadro inesperado no delta: {mensagem[:100]!r}")
+            arquivo_novo.flush()
+            os.fsync(arquivo_novo.fileno())
+            tamanho_montado = arquivo_novo.tell()
+            instante_ns = tempos_fases.marcar("disk_write_ns", instante_ns)
+
+        if checksum_hex_esperado_cliente is None:
+            checksum_hex_esperado_cliente = checksum_trailer
+        checksum_calculado_servidor = hasheador_fluxo.hexdigest() if hasheador_fluxo is not None else calcular_checksum(caminho_temporario, algo_checksum_esperado)
+        tempos_fases.marcar("verify_ns", instante_ns)
+        tempos_fases.marcar("data_transfer_ns", inicio_dados_ns)
+        duracao_transferencia = tempos_fases.ns["data_transfer_ns"] / 1e9
+        velocidade_transferencia = (tamanho_total_arq / 1024) / duracao_transferencia if duracao_transferencia > 0 else 0
+        tempo_fim_dados_str = time.strftime('%Y-%m-%d %H:%M:%S')
+        logger_texto.info(f"Delta de '{os.path.basename(caminho_fisico_arq_servidor)}' montado: {bytes_literais} bytes literais, {bytes_copiados} copiados da versão anterior.")
+
+        if tamanho_montado == tamanho_total_arq and checksum_calculado_servidor == checksum_hex_esperado_cliente:
+            os.replace(caminho_temporario, caminho_fisico_arq_servidor)
+            atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "SUCCESS_CHECKSUM_OK", total_bytes_atuais=tamanho_total_arq, tempo_fim_dados=tempo_fim_dados_str,
+                                                      checksum_final=checksum_calculado_servidor, duracao_final=duracao_transferencia, velocidade_final=velocidade_transferencia,
+                                                      limite_banda_final=limitador_banda.limite_efetivo_kbps() if limitador_banda is not None else 0, tempos_fases_ns=tempos_fases.ns, duravel=True)
+            registrar_evento_geral_bd(conexao_bd_local, "FILE_DELTA_APPLIED", end_cliente_str, f"Arquivo: {caminho_fisico_arq_servidor}, Literais: {bytes_literais}, Copiados: {bytes_copiados}")
+            guardar_no_armazem_blobs(conexao_bd_local, caminho_fisico_arq_servidor, algo_checksum_esperado, checksum_calculado_servidor, tamanho_total_arq)
+            return "FILE_CHECKSUM_OK"
+
+        detalhes = f"Delta montou {tamanho_montado}/{tamanho_total_arq} bytes. Esperado: {checksum_hex_esperado_cliente}, Calculado: {checksum_calculado_servidor}"
+        logger_texto.error(f"CHECKSUM MISMATCH no delta de '{os.path.basename(caminho_fisico_arq_servidor)}'. {detalhes}")
+        os.remove(caminho_temporario)
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "FAIL_CHECKSUM_MISMATCH", total_bytes_atuais=0, tempo_fim_dados=tempo_fim_dados_str,
+                                                  checksum_final=checksum_calculado_servidor, tempos_fases_ns=tempos_fases.ns, detalhes_erro=detalhes, duravel=True)
+        return "FILE_CHECKSUM_MISMATCH"
+    except Exception as e:
+        logger_texto.error(f"Exceção em receber_delta_arquivo para '{os.path.basename(caminho_fisico_arq_servidor)}': {e}", exc_info=True)
+        if os.path.exists(caminho_temporario):
+            os.remove(caminho_temporario)
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arq_bd, "FAIL_DELTA_ERROR", total_bytes_atuais=0, detalhes_erro=str(e), duravel=True)
+        return "FILE_DATA_ERROR"
+
+def descartar_bytes(canal_cliente, quantidade):
+    while quantidade > 0:
+        bloco = canal_cliente.receber_bytes(min(TAMANHO_BUFFER, quantidade))
+        if not bloco:
+            return False
+        quantidade -= len(bloco)
+    return True
+
+def gravar_na_posicao(fd_arquivo, dados, posicao):
+    # os.pwrite não existe no Windows; lá cada conexão tem seu próprio descritor, então lseek + write é equivalente
+    while dados:
+        if hasattr(os, 'pwrite'):
+            gravados = os.pwrite(fd_arquivo, dados, posicao)
+        else:
+            os.lseek(fd_arquivo, posicao, os.SEEK_SET)
+            gravados = os.write(fd_arquivo, dados)
+        dados = dados[gravados:]
+        posicao += gravados
+
+def preparar_arquivo_em_pedacos(conexao_bd_local, id_cliente, end_cliente, caminho_base_upload, caminho_rel, tamanho_total, algo_checksum, checksum_esp, tamanho_pedaco):
+    # Retorna (resposta de protocolo, id do log, índices dos pedaços que faltam)
+    resposta_preparacao, id_log_arquivo = decidir_preparacao_arquivo(conexao_bd_local, id_cliente, end_cliente, caminho_rel, tamanho_total, algo_checksum, checksum_esp)
+    resposta_preparacao = deduplicar_preparacao(conexao_bd_local, resposta_preparacao, id_log_arquivo, end_cliente, caminho_base_upload, caminho_rel, tamanho_total, algo_checksum, checksum_esp)
+    if not id_log_arquivo or resposta_preparacao.startswith("FILE_ALREADY_EXISTS"):
+        return resposta_preparacao, id_log_arquivo, []
+    sincronizar_escritas_bd() # A linha recém-criada precisa estar visível para a leitura abaixo
+
+    caminho_fisico_completo_arq = preparar_destino_arquivo(conexao_bd_local, id_log_arquivo, caminho_base_upload)[0]
+    cursor_bd = conexao_bd_local.cursor()
+    cursor_bd.execute("SELECT chunk_index, chunk_size_bytes, status FROM file_chunk_log WHERE file_log_id = ? ORDER BY chunk_index", (id_log_arquivo,))
+    pedacos_registrados = cursor_bd.fetchall()
+    numero_pedacos = max(1, -(-tamanho_total // tamanho_pedaco))
+    # Só aproveita pedaços já gravados se o conteúdo é o mesmo, a divisão não mudou e o arquivo no disco ainda está lá
+    reaproveita_pedacos = (resposta_preparacao.startswith("RESUME_FROM_OFFSET:") and len(pedacos_registrados) == numero_pedacos
+                           and pedacos_registrados[0][1] == min(tamanho_pedaco, tamanho_total)
+                           and os.path.exists(caminho_fisico_completo_arq) and os.path.getsize(caminho_fisico_completo_arq) == tamanho_total)
+    if not reaproveita_pedacos:
+        executar_escrita_bd(conexao_bd_local, "DELETE FROM file_chunk_log WHERE file_log_id = ?", (id_log_arquivo,))
+        for i in range(numero_pedacos):
+            executar_escrita_bd(conexao_bd_local, "INSERT INTO file_chunk_log (file_log_id, chunk_index, chunk_offset, chunk_size_bytes, status) VALUES (?, ?, ?, ?, 'PENDING')",
+                                (id_log_arquivo, i, i * tamanho_pedaco, min(tamanho_pedaco, tamanho_total - i * tamanho_pedaco)))
+        if os.path.lexists(caminho_fisico_completo_arq):
+            os.remove(caminho_fisico_completo_arq) # Pode ser um hardlink para um blob
+        with open(caminho_fisico_completo_arq, 'wb') as arquivo_servidor:
+            arquivo_servidor.truncate(tamanho_total) # Reserva o tamanho final: cada pedaço é gravado na sua posição
+        pedacos_registrados = [(i, None, 'PENDING') for i in range(numero_pedacos)]
+
+    pedacos_faltantes = [indice for indice, _, status in pedacos_registrados if status != 'DONE']
+    bytes_ja_recebidos = tamanho_total - sum(min(tamanho_pedaco, tamanho_total - i * tamanho_pedaco) for i in pedacos_faltantes)
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "AWAITING_CHUNKS", total_bytes_atuais=bytes_ja_recebidos, tempo_inicio_dados=time.strftime('%Y-%m-%d %H:%M:%S'), duravel=True)
+    logger_texto.info(f"'{caminho_rel}' em {numero_pedacos} pedaços de {tamanho_pedaco} bytes; faltam {len(pedacos_faltantes)}.")
+    return "CHUNK_PLAN:" + json.dumps({"id": id_log_arquivo, "missing": pedacos_faltantes}), id_log_arquivo, pedacos_faltantes
+
+def receber_pedaco_arquivo(conexao_bd_local, canal_cliente, caminho_base_upload, id_log_arquivo, indice_pedaco, bytes_a_seguir, visao_buffer, limitador_banda=None):
+    cursor_bd = conexao_bd_local.cursor()
+    cursor_bd.execute("SELECT chunk_offset, chunk_size_bytes, status FROM file_chunk_log WHERE file_log_id = ? AND chunk_index = ?", (id_log_arquivo, indice_pedaco))
+    info_pedaco = cursor_bd.fetchone()
+    info_arquivo_bd = preparar_destino_arquivo(conexao_bd_local, id_log_arquivo, caminho_base_upload) if info_pedaco else None
+    if not info_arquivo_bd or info_pedaco[1] != bytes_a_seguir:
+        logger_texto.error(f"START_CHUNK_DATA inválido (id {id_log_arquivo}, pedaço {indice_pedaco}). Descartando {bytes_a_seguir} bytes.")
+        return "ERROR_UNKNOWN_CHUNK" if descartar_bytes(canal_cliente, bytes_a_seguir) else "CHUNK_DATA_ERROR"
+
+    offset_pedaco, tamanho_pedaco, status_anterior = info_pedaco
+    bytes_recebidos = 0
+    fd_arquivo = os.open(info_arquivo_bd[0], os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        while bytes_recebidos < tamanho_pedaco:
+            lidos = canal_cliente.receber_bytes_em(visao_buffer[:min(len(visao_buffer), tamanho_pedaco - bytes_recebidos)])
+            if not lidos:
+                break
+            gravar_na_posicao(fd_arquivo, visao_buffer[:lidos], offset_pedaco + bytes_recebidos)
+            bytes_recebidos += lidos
+            if limitador_banda is not None:
+                limitador_banda.consumir(lidos)
+        if bytes_recebidos < tamanho_pedaco:
+            logger_texto.warning(f"Pedaço {indice_pedaco} do id {id_log_arquivo} incompleto: {bytes_recebidos}/{tamanho_pedaco} bytes.")
+            return "CHUNK_DATA_ERROR"
+        # O pedaço só vira DONE no BD depois de estar no disco: numa retomada ele não precisa ser reenviado
+        os.fsync(fd_arquivo)
+    finally:
+        os.close(fd_arquivo)
+
+    executar_escrita_bd(conexao_bd_local, "UPDATE file_chunk_log SET status = 'DONE', completed_timestamp = ? WHERE file_log_id = ? AND chunk_index = ?", (time.strftime('%Y-%m-%d %H:%M:%S'), id_log_arquivo, indice_pedaco))
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "RECEIVING_CHUNKS", incremento_bytes=tamanho_pedaco if status_anterior != 'DONE' else 0, duravel=True)
+    return "CHUNK_OK"
+
+def finalizar_arquivo_em_pedacos(conexao_bd_local, caminho_base_upload, id_log_arquivo):
+    cursor_bd = conexao_bd_local.cursor()
+    cursor_bd.execute("SELECT COUNT(*) FROM file_chunk_log WHERE file_log_id = ? AND status != 'DONE'", (id_log_arquivo,))
+    pedacos_pendentes = cursor_bd.fetchone()[0]
+    info_arquivo_bd = preparar_destino_arquivo(conexao_bd_local, id_log_arquivo, caminho_base_upload)
+    if not info_arquivo_bd:
+        return "ERROR_SERVER_DB_LOOKUP_FAIL"
+    if pedacos_pendentes:
+        logger_texto.error(f"Finalização do id {id_log_arquivo} com {pedacos_pendentes} pedaços pendentes.")
+        return "ERROR_CHUNKS_MISSING"
+
+    caminho_fisico_completo_arq, tam_total_bd, _, cs_algo_bd, cs_hex_bd = info_arquivo_bd
+    # Os pedaços chegam fora de ordem por conexões diferentes: o checksum do arquivo inteiro só pode ser feito no final
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "COMPLETED_DATA_RECEIVED", tempo_fim_dados=time.strftime('%Y-%m-%d %H:%M:%S'))
+    checksum_calculado_servidor = calcular_checksum(caminho_fisico_completo_arq, cs_algo_bd)
+    if checksum_calculado_servidor == cs_hex_bd:
+        logger_texto.info(f"Checksum OK para '{caminho_fisico_completo_arq}' recebido em pedaços.")
+        atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "SUCCESS_CHECKSUM_OK", checksum_final=checksum_calculado_servidor, duravel=True)
+        guardar_no_armazem_blobs(conexao_bd_local, caminho_fisico_completo_arq, cs_algo_bd, checksum_calculado_servidor, tam_total_bd)
+        return "FILE_CHECKSUM_OK"
+
+    logger_texto.error(f"Checksum FALHOU para '{caminho_fisico_completo_arq}' recebido em pedaços. Esperado: {cs_hex_bd}, Calculado: {checksum_calculado_servidor}")
+    executar_escrita_bd(conexao_bd_local, "UPDATE file_chunk_log SET status = 'PENDING', completed_timestamp = NULL WHERE file_log_id = ?", (id_log_arquivo,))
+    atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "FAIL_CHECKSUM_MISMATCH", total_bytes_atuais=0, checksum_final=checksum_calculado_servidor, detalhes_erro=f"Esperado {cs_hex_bd}, Calculado {checksum_calculado_servidor}", duravel=True)
+    return "FILE_CHECKSUM_MISMATCH"
+
+# Limites de banda em vigor (KB/s, 0 = sem limite); "clients" sobrepõe o limite por cliente para ids específicos
+limites_banda_atuais = {"global_KBps": LIMITE_BANDA_GLOBAL_KBPS, "per_client_KBps": LIMITE_BANDA_POR_CLIENTE_KBPS,
+                        "per_folder_KBps": LIMITE_BANDA_POR_PASTA_KBPS, "clients": {}}
+
+def ler_limites_banda(caminho_arquivo):
+    with open(caminho_arquivo, 'r', encoding='utf-8') as arquivo_limites:
+        dados_limites = json.load(arquivo_limites)
+    novos_limites = {chave: float(dados_limites.get(chave, 0)) for chave in ("global_KBps", "per_client_KBps", "per_folder_KBps")}
+    novos_limites["clients"] = {str(id_cliente): float(limite) for id_cliente, limite in dados_limites.get("clients", {}).items()}
+    if min([*novos_limites["clients"].values(), *(novos_limites[chave] for chave in ("global_KBps", "per_client_KBps", "per_folder_KBps"))]) < 0:
+        raise ValueError("limites de banda não podem ser negativos")
+    return novos_limites
+
+def vigiar_limites_banda(caminho_arquivo):
+    # Relê o arquivo de limites quando ele muda; os baldes consultam limites_banda_atuais a cada bloco, então vale na hora
+    global limites_banda_atuais
+    conexao_bd_limites = abrir_conexao_bd(ARQUIVO_BD_SERVIDOR)
+    assinatura_anterior = None
+    while True:
+        try:
+            stat_arquivo = os.stat(caminho_arquivo)
+            assinatura_atual = (stat_arquivo.st_mtime_ns, stat_arquivo.st_size)
+        except FileNotFoundError:
+            assinatura_atual = None
+        if assinatura_atual != assinatura_anterior:
+            try:
+                if assinatura_atual is None:
+                    novos_limites = {"global_KBps": LIMITE_BANDA_GLOBAL_KBPS, "per_client_KBps": LIMITE_BANDA_POR_CLIENTE_KBPS,
+                                     "per_folder_KBps": LIMITE_BANDA_POR_PASTA_KBPS, "clients": {}}
+                else:
+                    novos_limites = ler_limites_banda(caminho_arquivo)
+                if novos_limites != limites_banda_atuais:
+                    limites_banda_atuais = novos_limites
+                    logger_texto.info(f"Limites de banda atualizados: {novos_limites}")
+                    registrar_evento_geral_bd(conexao_bd_limites, "RATE_LIMITS_UPDATED", detalhes_evento=json.dumps(novos_limites))
+            except (OSError, ValueError, TypeError, AttributeError) as e_limites:
+                logger_texto.error(f"Arquivo de limites de banda '{caminho_arquivo}' inválido, mantendo os atuais: {e_limites}")
+            assinatura_anterior = assinatura_atual
+        time.sleep(INTERVALO_VERIFICACAO_LIMITES_SEGUNDOS)
+
+balde_banda_global = BaldeTokens(lambda: limites_banda_atuais["global_KBps"] * 1024)
+
+# Um balde por id de cliente, compartilhado pelas conexões paralelas dele: id -> balde e nº de conexões por IP.
+# O registro também serve de dono do id: enquanto houver sessão viva com ele, outro IP não pode assumi-lo.
+baldes_banda_clientes = {}
+trava_baldes_clientes = threading.Lock()
+
+def taxa_banda_cliente(id_cliente):
+    limites = limites_banda_atuais
+    return limites["clients"].get(id_cliente, limites["per_client_KBps"]) * 1024
+
+def adquirir_balde_cliente(id_cliente, ip_cliente):
+    # Retorna None se o id está em uso por uma sessão viva vinda de outro IP
+    with trava_baldes_clientes:
+        registro_balde = baldes_banda_clientes.get(id_cliente)
+        if registro_balde is None:
+            registro_balde = {"balde": BaldeTokens(lambda: taxa_banda_cliente(id_cliente)), "conexoes_por_ip": {}}
+            baldes_banda_clientes[id_cliente] = registro_balde
+        elif ip_cliente not in registro_balde["conexoes_por_ip"]:
+            return None
+        registro_balde["conexoes_por_ip"][ip_cliente] = registro_balde["conexoes_por_ip"].get(ip_cliente, 0) + 1
+        return registro_balde["balde"]
+
+def liberar_balde_cliente(id_cliente, ip_cliente):
+    with trava_baldes_clientes:
+        registro_balde = baldes_banda_clientes[id_cliente]
+        registro_balde["conexoes_por_ip"][ip_cliente] -= 1
+        if registro_balde["conexoes_por_ip"][ip_cliente] == 0:
+            del registro_balde["conexoes_por_ip"][ip_cliente]
+        if not registro_balde["conexoes_por_ip"]:
+            del baldes_banda_clientes[id_cliente]
+
+def criar_balde_pasta():
+    return BaldeTokens(lambda: limites_banda_atuais["per_folder_KBps"] * 1024)
+
+# Sessões de pasta compartilhadas por várias conexões paralelas do mesmo cliente: id -> caminho base, balde de banda e nº de conexões
+sessoes_pasta_ativas = {}
+trava_sessoes_pasta = threading.Lock()
+
+def entrar_sessao_pasta(id_sessao_pasta, nome_da_pasta, id_cliente):
+    # Retorna None se a sessão pertence a outro cliente. "ids_pedacos" guarda os ids de arquivos em pedaços preparados
+    # nesta sessão: só eles podem receber START_CHUNK_DATA/FINALIZE_CHUNKED_FILE, por qualquer conexão da sessão
+    with trava_sessoes_pasta:
+        sessao_pasta = sessoes_pasta_ativas.get(id_sessao_pasta)
+        if sessao_pasta is None:
+            sessao_pasta = {"caminho_base": os.path.join(PASTA_UPLOADS, os.path.basename(nome_da_pasta)), "balde": criar_balde_pasta(),
+                            "id_cliente": id_cliente, "ids_pedacos": set(), "conexoes": 0}
+            sessoes_pasta_ativas[id_sessao_pasta] = sessao_pasta
+        elif sessao_pasta["id_cliente"] != id_cliente:
+            return None
+        sessao_pasta["conexoes"] += 1
+        return sessao_pasta["caminho_base"], sessao_pasta["conexoes"] == 1, sessao_pasta["balde"], sessao_pasta["ids_pedacos"]
+
+def sair_sessao_pasta(id_sessao_pasta):
+    with trava_sessoes_pasta:
+        sessao_pasta = sessoes_pasta_ativas[id_sessao_pasta]
+        sessao_pasta["conexoes"] -= 1
+        if sessao_pasta["conexoes"] == 0:
+            del sessoes_pasta_ativas[id_sessao_pasta]
+            return True
+        return False
+
+def atender_cliente(socket_cliente, endereco_cliente_tupla, semaforo_sessoes):
+    endereco_cliente_str = f"{endereco_cliente_tupla[0]}:{endereco_cliente_tupla[1]}"
+    id_cliente_sessao = endereco_cliente_str # Clientes sem HELLO_CLIENT continuam identificados pelo endereço
+    caminho_base_upload_atual = "" 
+    id_log_arquivo_em_progresso_bd = None
+    ids_log_arquivos_lote = {}
+    ids_pedacos_pasta = None # Ids de arquivos em pedaços preparados na transferência de pasta atual
+    id_sessao_pasta_atual = None
+    buffer_recepcao_sessao = bytearray(TAMANHO_BUFFER_RECEPCAO)
+    conexao_bd_sessao = None
+    canal_cliente = CanalMensagens(socket_cliente, ao_receber=lambda quantidade: metricas.incrementar("file_server_received_bytes_total", quantidade))
+    ip_cliente = str(endereco_cliente_tupla[0])
+    balde_cliente_sessao = adquirir_balde_cliente(id_cliente_sessao, ip_cliente)
+    balde_pasta_sessao = None
+    metricas.incrementar("file_server_sessions_total")
+    metricas.incrementar("file_server_sessions_active")
+
+    try:
+        with socket_cliente:
+            conexao_bd_sessao = abrir_conexao_bd(ARQUIVO_BD_SERVIDOR)
+            logger_texto.info(f"Conexão estabelecida com {endereco_cliente_str}")
+            registrar_evento_geral_bd(conexao_bd_sessao, "CLIENT_CONNECT", endereco_cliente=endereco_cliente_str)
+            
+            conexao_com_cliente_ativa = True
+            while conexao_com_cliente_ativa:
+                try:
+                    bytes_cabecalho_recebidos = canal_cliente.receber_mensagem()
+                    if not bytes_cabecalho_recebidos:
+                        logger_texto.info(f"Cliente {endereco_cliente_str} encerrou a conexão (sem cabeçalho).")
+                        registrar_evento_geral_bd(conexao_bd_sessao, "CLIENT_DISCONNECT", endereco_cliente=endereco_cliente_str, detalhes_evento="Cabeçalho vazio.")
+                        conexao_com_cliente_ativa = False
+                        break
+                        
+                    cabecalho_str = bytes_cabecalho_recebidos.decode('utf-8')
+                    logger_texto.debug(f"Comando de {endereco_cliente_str}: {cabecalho_str[:200]}")
+
+                    # Strings de protocolo mantidas em INGLÊS
+                    if cabecalho_str.startswith("NEGOTIATE_PROTOCOL:") and not canal_cliente.versao_quadros:
+                        versoes_cliente = {int(v) for v in cabecalho_str.split(":", 1)[1].split(",") if v.strip().isdigit()}
+                        versoes_em_comum = versoes_cliente.intersection(VERSOES_PROTOCOLO_SUPORTADAS)
+                        versao_escolhida = max(versoes_em_comum) if versoes_em_comum else 0
+                        canal_cliente.enviar_mensagem(f"ACK_PROTOCOL:{versao_escolhida}")
+                        canal_cliente.versao_quadros = versao_escolhida
+                        logger_texto.info(f"Protocolo negociado com {endereco_cliente_str}: {'quadros v' + str(versao_escolhida) if versao_escolhida else 'texto legado'}.")
+
+                    elif cabecalho_str.startswith("HELLO_CLIENT:"):
+                        id_cliente_recebido = cabecalho_str.split(":", 1)[1].strip()
+                        # Ids com ":" poderiam se passar pelo id por endereço ("ip:porta") de um cliente antigo
+                        if not id_cliente_recebido or len(id_cliente_recebido) > TAMANHO_MAXIMO_ID_CLIENTE or ":" in id_cliente_recebido:
+                            canal_cliente.enviar_mensagem(b"ERROR_INVALID_CLIENT_ID")
+                            continue
+                        # O id não é autenticado; só se evita que duas máquinas usem o mesmo id ao mesmo tempo e
+                        # retomem ou sobrescrevam os arquivos uma da outra sem aviso
+                        balde_cliente_recebido = adquirir_balde_cliente(id_cliente_recebido, ip_cliente)
+                        if balde_cliente_recebido is None:
+                            logger_texto.warning(f"{endereco_cliente_str} apresentou o id {id_cliente_recebido}, em uso por uma sessão ativa de outro endereço. Id recusado.")
+                            registrar_evento_geral_bd(conexao_bd_sessao, "CLIENT_ID_IN_USE", endereco_cliente_str, f"Cliente: {id_cliente_recebido}")
+                            canal_cliente.enviar_mensagem(b"ERROR_CLIENT_ID_IN_USE")
+                            continue
+                        liberar_balde_cliente(id_cliente_sessao, ip_cliente)
+                        balde_cliente_sessao = balde_cliente_recebido
+                        id_cliente_sessao = id_cliente_recebido
+                        registrar_evento_geral_bd(conexao_bd_sessao, "CLIENT_HELLO", endereco_cliente_str, f"Cliente: {id_cliente_sessao}")
+                        canal_cliente.enviar_mensagem(b"ACK_HELLO_CLIENT")
+
+                    elif cabecalho_str.startswith("NEGOTIATE_COMPRESSION:"):
+                        codecs_cliente = cabecalho_str.split(":", 1)[1].split(",")
+                        codecs_em_comum = [codec for codec in codecs_cliente if codec in DESCOMPRESSORES]
+                        canal_cliente.enviar_mensagem("ACK_COMPRESSION:" + ",".join(codecs_em_comum))
+                        logger_texto.info(f"Compressão aceita para {endereco_cliente_str}: {', '.join(codecs_em_comum) or 'nenhuma'}.")
+
+                    elif cabecalho_str.startswith("NEGOTIATE_CHECKSUM:"):
+                        # Primeiro algoritmo da lista do cliente que este servidor consegue calcular
+                        algoritmos_cliente = cabecalho_str.split(":", 1)[1].split(",")
+                        algoritmo_escolhido = next((algoritmo for algoritmo in algoritmos_cliente if criar_hasheador(algoritmo) is not None), "")
+                        canal_cliente.enviar_mensagem(f"ACK_CHECKSUM:{algoritmo_escolhido}")
+
+                    elif cabecalho_str.startswith("PREPARE_FILE_TRANSFER:"):
+                        partes_cabecalho = cabecalho_str.split(":", 4)
+                        caminho_relativo_arq = partes_cabecalho[1]
+                        tamanho_total_arq_cliente = int(partes_cabecalho[2])
+                        algo_checksum_arq = partes_cabecalho[3]
+                        checksum_esperado_arq = partes_cabecalho[4]
+
+                        inicio_preparacao_ns = time.perf_counter_ns()
+                        resposta_preparacao, id_log_arquivo_em_progresso_bd = decidir_preparacao_arquivo(conexao_bd_sessao, id_cliente_sessao, endereco_cliente_str, caminho_relativo_arq, tamanho_total_arq_cliente, algo_checksum_arq, checksum_esperado_arq)
+                        resposta_preparacao = deduplicar_preparacao(conexao_bd_sessao, resposta_preparacao, id_log_arquivo_em_progresso_bd, endereco_cliente_str, caminho_base_upload_atual,
+                                                                    caminho_relativo_arq, tamanho_total_arq_cliente, algo_checksum_arq, checksum_esperado_arq)
+                        if id_log_arquivo_em_progresso_bd:
+                            registrar_tempo_preparacao_bd(conexao_bd_sessao, id_log_arquivo_em_progresso_bd, time.perf_counter_ns() - inicio_preparacao_ns)
+                        sincronizar_escritas_bd()
+                        canal_cliente.enviar_mensagem(resposta_preparacao) # Protocolo
+                        if not id_log_arquivo_em_progresso_bd:
+                            conexao_com_cliente_ativa = False; break
+
+                    elif cabecalho_str.startswith("PREPARE_FILE_BATCH:"):
+                        # Manifesto em lote: uma única resposta com a decisão de cada arquivo, na mesma ordem do manifesto
+                        manifesto_lote = json.loads(cabecalho_str.split(":", 1)[1])
+                        for caminho_rel_pasta in manifesto_lote.get("folders", []):
+                            os.makedirs(os.path.join(caminho_base_upload_atual, caminho_rel_pasta), exist_ok=True)
+                        decisoes_lote = []
+                        assinaturas_delta_lote = []
+                        for entrada_arquivo in manifesto_lote.get("files", []):
+                            inicio_preparacao_ns = time.perf_counter_ns()
+                            resposta_preparacao, id_log_arquivo = decidir_preparacao_arquivo(conexao_bd_sessao, id_cliente_sessao, endereco_cliente_str, entrada_arquivo["path"], int(entrada_arquivo["size"]), entrada_arquivo["algorithm"], entrada_arquivo.get("checksum"), entrada_arquivo.get("fingerprint"))
+                            resposta_preparacao = deduplicar_preparacao(conexao_bd_sessao, resposta_preparacao, id_log_arquivo, endereco_cliente_str, caminho_base_upload_atual,
+                                                                        entrada_arquivo["path"], int(entrada_arquivo["size"]), entrada_arquivo["algorithm"], entrada_arquivo.get("checksum"))
+                            assinaturas_delta = None
+                            if manifesto_lote.get("delta") and id_log_arquivo:
+                                resposta_preparacao, assinaturas_delta = oferecer_transferencia_delta(caminho_base_upload_atual, entrada_arquivo["path"], resposta_preparacao)
+                            if assinaturas_delta:
+                                assinaturas_delta_lote.append(assinaturas_delta)
+                            if id_log_arquivo:
+                                ids_log_arquivos_lote[entrada_arquivo["path"]] = (id_log_arquivo, not entrada_arquivo.get("checksum"), assinaturas_delta and assinaturas_delta["block_size"])
+                                registrar_tempo_preparacao_bd(conexao_bd_sessao, id_log_arquivo, time.perf_counter_ns() - inicio_preparacao_ns)
+                            decisoes_lote.append(resposta_preparacao)
+                        registrar_evento_geral_bd(conexao_bd_sessao, "PREPARE_FILE_BATCH", endereco_cliente_str, f"Arquivos: {len(decisoes_lote)}, Pastas: {len(manifesto_lote.get('folders', []))}")
+                        sincronizar_escritas_bd() # Um único commit para as decisões do lote inteiro, antes de respondê-las
+                        canal_cliente.enviar_mensagem("BATCH_DECISIONS:" + json.dumps(decisoes_lote))
+                        # Uma mensagem por arquivo com SEND_DELTA, na ordem das decisões
+                        for assinaturas_delta in assinaturas_delta_lote:
+                            canal_cliente.enviar_mensagem("DELTA_SIGNATURES:" + json.dumps(assinaturas_delta))
+
+                    elif cabecalho_str.startswith(("START_FILE_DATA_PIPELINED:", "START_FILE_DATA_COMPRESSED:")):
+                        # Os dados seguem imediatamente o comando, sem ACK; o status vai depois como FILE_STATUS.
+                        # Na variante comprimida eles vêm em quadros do codec negociado, terminados por um quadro vazio.
+                        comando, argumentos_dados = cabecalho_str.split(":", 1)
+                        codec_compressao = None
+                        if comando == "START_FILE_DATA_COMPRESSED":
+                            codec_compressao, argumentos_dados = argumentos_dados.split(":", 1)
+                        offset_cliente, bytes_a_seguir, caminho_relativo_arq = argumentos_dados.split(":", 2)
+                        offset_cliente, bytes_a_seguir = int(offset_cliente), int(bytes_a_seguir)
+                        id_log_arquivo, usa_trailer_checksum, _ = ids_log_arquivos_lote.pop(caminho_relativo_arq, (None, False, None))
+                        info_arquivo_bd = preparar_destino_arquivo(conexao_bd_sessao, id_log_arquivo, caminho_base_upload_atual) if id_log_arquivo else None
+
+                        if not info_arquivo_bd or info_arquivo_bd[2] != offset_cliente or (codec_compressao and codec_compressao not in DESCOMPRESSORES):
+                            logger_texto.error(f"{comando} inválido para '{caminho_relativo_arq}' (id {id_log_arquivo}, offset cliente {offset_cliente}). Descartando {bytes_a_seguir} bytes.")
+                            if codec_compressao:
+                                while canal_cliente.receber_mensagem():
+                                    pass # Descarta os quadros comprimidos até o quadro vazio
+                            elif not descartar_bytes(canal_cliente, bytes_a_seguir):
+                                conexao_com_cliente_ativa = False; break
+                            canal_cliente.enviar_mensagem(f"FILE_STATUS:ERROR_NO_PREPARE_CALL:{caminho_relativo_arq}")
+                            continue
+
+                        caminho_fisico_completo_arq, tam_total_bd, offset_bd, cs_algo_bd, cs_hex_bd = info_arquivo_bd
+                        if usa_trailer_checksum:
+                            cs_hex_bd = None # O checksum chega como trailer depois dos dados
+                        status_final_do_recebimento = receber_dados_arquivo(conexao_bd_sessao, canal_cliente, caminho_fisico_completo_arq, tam_total_bd, endereco_cliente_str, 
+                                                                id_log_arquivo, offset_bd, cs_algo_bd, cs_hex_bd, buffer_recepcao_sessao, codec_compressao,
+                                                                LimitadorBanda(balde_banda_global, balde_cliente_sessao, balde_pasta_sessao))
+                        canal_cliente.enviar_mensagem(f"FILE_STATUS:{status_final_do_recebimento}:{caminho_relativo_arq}")
+                        if status_final_do_recebimento == "FILE_DATA_ERROR":
+                            # Não dá para saber quantos bytes do fluxo ficaram sem ler: encerra para não interpretar dados como comandos
+                            logger_texto.warning(f"Encerrando sessão pipeline com {endereco_cliente_str} após erro de dados em '{caminho_relativo_arq}'.")
+                            conexao_com_cliente_ativa = False; break
+
+                    elif cabecalho_str.startswith("START_FILE_DELTA:"):
+                        # Seguem quadros DELTA_LITERAL/DELTA_COPY até DELTA_END; o status vai depois como FILE_STATUS
+                        caminho_relativo_arq = cabecalho_str.split(":", 1)[1]
+                        id_log_arquivo, usa_trailer_checksum, tamanho_bloco = ids_log_arquivos_lote.pop(caminho_relativo_arq, (None, False, None))
+                        info_arquivo_bd = preparar_destino_arquivo(conexao_bd_sessao, id_log_arquivo, caminho_base_upload_atual) if id_log_arquivo and tamanho_bloco else None
+                        if not info_arquivo_bd:
+                            logger_texto.error(f"START_FILE_DELTA inválido para '{caminho_relativo_arq}' (id {id_log_arquivo}). Descartando instruções.")
+                            if not descartar_quadros_delta(canal_cliente):
+                                conexao_com_cliente_ativa = False; break
+                            canal_cliente.enviar_mensagem(f"FILE_STATUS:ERROR_NO_PREPARE_CALL:{caminho_relativo_arq}")
+                            continue
+
+                        caminho_fisico_completo_arq, tam_total_bd, _, cs_algo_bd, cs_hex_bd = info_arquivo_bd
+                        status_final_do_recebimento = receber_delta_arquivo(conexao_bd_sessao, canal_cliente, caminho_fisico_completo_arq, tam_total_bd, endereco_cliente_str,
+                                                                            id_log_arquivo, tamanho_bloco, cs_algo_bd, None if usa_trailer_checksum else cs_hex_bd,
+                                                                            LimitadorBanda(balde_banda_global, balde_cliente_sessao, balde_pasta_sessao))
+                        canal_cliente.enviar_mensagem(f"FILE_STATUS:{status_final_do_recebimento}:{caminho_relativo_arq}")
+                        if status_final_do_recebimento == "FILE_DATA_ERROR":
+                            logger_texto.warning(f"Encerrando sessão pipeline com {endereco_cliente_str} após erro no delta de '{caminho_relativo_arq}'.")
+                            conexao_com_cliente_ativa = False; break
+
+                    elif cabecalho_str.startswith("PREPARE_CHUNKED_FILE:"):
+                        if not caminho_base_upload_atual or ids_pedacos_pasta is None:
+                            logger_texto.error(f"PREPARE_CHUNKED_FILE de {endereco_cliente_str} fora de uma transferência de pasta.")
+                            canal_cliente.enviar_mensagem(b"ERROR_NO_FOLDER_TRANSFER")
+                            continue
+                        pedido_pedacos = json.loads(cabecalho_str.split(":", 1)[1])
+                        resposta_preparacao, id_log_arquivo, _ = preparar_arquivo_em_pedacos(conexao_bd_sessao, id_cliente_sessao, endereco_cliente_str, caminho_base_upload_atual, pedido_pedacos["path"], int(pedido_pedacos["size"]),
+                                                                                            pedido_pedacos["algorithm"], pedido_pedacos["checksum"], int(pedido_pedacos["chunk_size"]))
+                        if id_log_arquivo and resposta_preparacao.startswith("CHUNK_PLAN:"):
+                            ids_pedacos_pasta.add(id_log_arquivo)
+                        canal_cliente.enviar_mensagem(resposta_preparacao)
+
+                    elif cabecalho_str.startswith("START_CHUNK_DATA:"):
+                        # Pedaços do mesmo arquivo podem chegar por qualquer conexão da sessão de pasta
+                        _, id_log_arquivo, indice_pedaco, bytes_a_seguir = cabecalho_str.split(":", 3)
+                        if not caminho_base_upload_atual or ids_pedacos_pasta is None or int(id_log_arquivo) not in ids_pedacos_pasta:
+                            # Id que não foi preparado nesta sessão de pasta (antigo, de outro cliente ou forjado): os dados são descartados
+                            logger_texto.error(f"START_CHUNK_DATA de {endereco_cliente_str} para id {id_log_arquivo} não preparado nesta pasta. Descartando {bytes_a_seguir} bytes.")
+                            status_pedaco = "ERROR_UNKNOWN_CHUNK" if descartar_bytes(canal_cliente, int(bytes_a_seguir)) else "CHUNK_DATA_ERROR"
+                        else:
+                            status_pedaco = receber_pedaco_arquivo(conexao_bd_sessao, canal_cliente, caminho_base_upload_atual, int(id_log_arquivo), int(indice_pedaco), int(bytes_a_seguir), memoryview(buffer_recepcao_sessao),
+                                                                  LimitadorBanda(balde_banda_global, balde_cliente_sessao, balde_pasta_sessao))
+                        canal_cliente.enviar_mensagem(f"CHUNK_STATUS:{status_pedaco}:{id_log_arquivo}:{indice_pedaco}")
+                        if status_pedaco == "CHUNK_DATA_ERROR":
+                            conexao_com_cliente_ativa = False; break
+
+                    elif cabecalho_str.startswith("FINALIZE_CHUNKED_FILE:"):
+                        id_log_arquivo = int(cabecalho_str.split(":", 1)[1])
+                        if not caminho_base_upload_atual or ids_pedacos_pasta is None or id_log_arquivo not in ids_pedacos_pasta:
+                            logger_texto.error(f"FINALIZE_CHUNKED_FILE de {endereco_cliente_str} para id {id_log_arquivo} não preparado nesta pasta.")
+                            canal_cliente.enviar_mensagem("CHUNKED_FILE_STATUS:ERROR_UNKNOWN_CHUNK")
+                            continue
+                        status_finalizacao = finalizar_arquivo_em_pedacos(conexao_bd_sessao, caminho_base_upload_atual, id_log_arquivo)
+                        if status_finalizacao == "FILE_CHECKSUM_OK":
+                            ids_pedacos_pasta.discard(id_log_arquivo)
+                        canal_cliente.enviar_mensagem("CHUNKED_FILE_STATUS:" + status_finalizacao)
+
+                    elif cabecalho_str.startswith("START_FILE_DATA:"):
+                        if not id_log_arquivo_em_progresso_bd:
+                            logger_texto.error("Recebido START_FILE_DATA sem um PREPARE_FILE_TRANSFER anterior.")
+                            canal_cliente.enviar_mensagem(b"ERROR_NO_PREPARE_CALL")
+                            continue
+
+                        info_arquivo_bd = preparar_destino_arquivo(conexao_bd_sessao, id_log_arquivo_em_progresso_bd, caminho_base_upload_atual)
+                        if not info_arquivo_bd:
+                            canal_cliente.enviar_mensagem(b"ERROR_SERVER_DB_LOOKUP_FAIL")
+                            continue
+                            
+                        caminho_fisico_completo_arq, tam_total_bd, offset_bd, cs_algo_bd, cs_hex_bd = info_arquivo_bd
+                        canal_cliente.enviar_mensagem(b"ACK_START_FILE_DATA")
+                            
+                        status_final_do_recebimento = receber_dados_arquivo(conexao_bd_sessao, canal_cliente, caminho_fisico_completo_arq, tam_total_bd, endereco_cliente_str, 
+                                                                id_log_arquivo_em_progresso_bd, offset_bd, cs_algo_bd, cs_hex_bd, buffer_recepcao_sessao,
+                                                                limitador_banda=LimitadorBanda(balde_banda_global, balde_cliente_sessao, balde_pasta_sessao))
+                        canal_cliente.enviar_mensagem(status_final_do_recebimento.encode('utf-8'))
+                        id_log_arquivo_em_progresso_bd = None 
+
+                    elif cabecalho_str.startswith("START_FOLDER_TRANSFER:"):
+                        nome_da_pasta = cabecalho_str.split(":", 1)[1]
+                        caminho_base_upload_atual = os.path.join(PASTA_UPLOADS, os.path.basename(nome_da_pasta))
+                        if not os.path.exists(caminho_base_upload_atual): os.makedirs(caminho_base_upload_atual)
+                        balde_pasta_sessao = criar_balde_pasta()
+                        ids_pedacos_pasta = set()
+                        registrar_evento_geral_bd(conexao_bd_sessao, "START_FOLDER_TRANSFER", endereco_cliente_str, f"Pasta: {nome_da_pasta}, Destino: {caminho_base_upload_atual}")
+                        canal_cliente.enviar_mensagem(b"ACK_START_FOLDER")
+                        
+                    elif cabecalho_str.startswith("START_FOLDER_TRANSFER_SESSION:"):
+                        # Conexão paralela entrando numa transferência de pasta: o início é registrado só pela primeira
+                        _, id_sessao_pasta, nome_da_pasta = cabecalho_str.split(":", 2)
+                        entrada_sessao = entrar_sessao_pasta(id_sessao_pasta, nome_da_pasta, id_cliente_sessao)
+                        if entrada_sessao is None:
+                            logger_texto.error(f"{endereco_cliente_str} (cliente {id_cliente_sessao}) tentou entrar na sessão de pasta {id_sessao_pasta} de outro cliente.")
+                            registrar_evento_geral_bd(conexao_bd_sessao, "FOLDER_SESSION_REJECTED", endereco_cliente_str, f"Sessão: {id_sessao_pasta}")
+                            canal_cliente.enviar_mensagem(b"ERROR_FOLDER_SESSION_OWNER")
+                            continue
+                        id_sessao_pasta_atual = id_sessao_pasta
+                        caminho_base_upload_atual, primeira_conexao, balde_pasta_sessao, ids_pedacos_pasta = entrada_sessao
+                        os.makedirs(caminho_base_upload_atual, exist_ok=True)
+                        if primeira_conexao:
+                            registrar_evento_geral_bd(conexao_bd_sessao, "START_FOLDER_TRANSFER", endereco_cliente_str, f"Pasta: {nome_da_pasta}, Destino: {caminho_base_upload_atual}, Sessão: {id_sessao_pasta_atual}")
+                        canal_cliente.enviar_mensagem(b"ACK_START_FOLDER")
+
+                    elif cabecalho_str.startswith("NEW_FOLDER:"):
+                        caminho_rel_pasta = cabecalho_str.split(":",1)[1]
+                        caminho_completo_pasta = os.path.join(caminho_base_upload_atual, caminho_rel_pasta)
+                        os.makedirs(caminho_completo_pasta, exist_ok=True)
+                        registrar_evento_geral_bd(conexao_bd_sessao, "NEW_FOLDER_CREATED", endereco_cliente_str, f"Pasta: {caminho_completo_pasta}")
+                        canal_cliente.enviar_mensagem(b"ACK_NEW_FOLDER") 
+
+                    elif cabecalho_str == "END_FOLDER_TRANSFER":
+                        ultima_conexao = True
+                        if id_sessao_pasta_atual:
+                            ultima_conexao = sair_sessao_pasta(id_sessao_pasta_atual)
+                            id_sessao_pasta_atual = None
+                        if ultima_conexao:
+                            registrar_evento_geral_bd(conexao_bd_sessao, "END_FOLDER_TRANSFER", endereco_cliente_str, f"Pasta: {os.path.basename(caminho_base_upload_atual if caminho_base_upload_atual else 'N/A')}")
+                        canal_cliente.enviar_mensagem(b"ACK_END_FOLDER")
+                        caminho_base_upload_atual = "" 
+                        balde_pasta_sessao = None
+                        ids_pedacos_pasta = None
+                        
+                    else:
+                        logger_texto.warning(f"Comando desconhecido de {endereco_cliente_str}: {cabecalho_str}")
+                        registrar_evento_geral_bd(conexao_bd_sessao, "UNKNOWN_COMMAND", endereco_cliente_str, cabecalho_str)
+
+                except ConnectionResetError:
+                    logger_texto.error(f"Conexão resetada por {endereco_cliente_str}.", exc_info=False)
+                    registrar_evento_geral_bd(conexao_bd_sessao, "ERROR_CONNECTION_RESET", endereco_cliente=endereco_cliente_str)
+                    conexao_com_cliente_ativa = False
+                except ErroProtocolo as e_protocolo:
+                    logger_texto.error(f"Erro de protocolo com {endereco_cliente_str}: {e_protocolo}")
+                    registrar_evento_geral_bd(conexao_bd_sessao, "ERROR_PROTOCOL", endereco_cliente=endereco_cliente_str, detalhes_evento=str(e_protocolo))
+                    conexao_com_cliente_ativa = False
+                except UnicodeDecodeError:
+                    logger_texto.error(f"Erro ao decodificar cabeçalho de {endereco_cliente_str}.", exc_info=True)
+                    registrar_evento_geral_bd(conexao_bd_sessao, "ERROR_UNICODE_DECODE", endereco_cliente=endereco_cliente_str)
+                    conexao_com_cliente_ativa = False
+                except socket.timeout:
+                    logger_texto.warning(f"Socket timeout para {endereco_cliente_str}.")
+                    registrar_evento_geral_bd(conexao_bd_sessao, "ERROR_SOCKET_TIMEOUT", endereco_cliente=endereco_cliente_str)
+                    conexao_com_cliente_ativa = False
+                except Exception as e_loop_cliente:
+                    logger_texto.error(f"Erro no loop de tratamento do cliente {endereco_cliente_str}: {e_loop_cliente}", exc_info=True)
+                    registrar_evento_geral_bd(conexao_bd_sessao, "ERROR_UNEXPECTED_CLIENT_LOOP", endereco_cliente=endereco_cliente_str, detalhes_evento=str(e_loop_cliente))
+                    conexao_com_cliente_ativa = False
+                
+            logger_texto.info(f"Sessão com cliente {endereco_cliente_str} encerrada.")
+    except Exception as e_sessao:
+        logger_texto.error(f"Erro fatal na sessão do cliente {endereco_cliente_str}: {e_sessao}", exc_info=True)
+    finally:
+        if id_sessao_pasta_atual:
+            sair_sessao_pasta(id_sessao_pasta_atual)
+        liberar_balde_cliente(id_cliente_sessao, ip_cliente)
+        if conexao_bd_sessao:
+            conexao_bd_sessao.close()
+        metricas.incrementar("file_server_sessions_active", -1)
+        semaforo_sessoes.release()
+
+
+def reconciliar_offsets_com_disco(conexao_bd_local):
+    # Depois de uma queda, o arquivo parcial pode ter mais bytes que o último checkpoint (ou menos, se foi apagado):
+    # o offset passa a ser o tamanho real no disco, e o checksum final confere o conteúdo de qualquer forma
+    cursor_bd = conexao_bd_local.cursor()
+    cursor_bd.execute('''
+    SELECT id, server_file_path, total_file_size_bytes, current_bytes_transferred FROM file_transfer_log
+    WHERE server_file_path IS NOT NULL AND status IN ('RECEIVING', 'PAUSED_DISCONNECT', 'COMPLETED_DATA_RECEIVED', 'FAIL_SERVER_ERROR')
+    ''')
+    reconciliados = 0
+    for id_log_arquivo, caminho_fisico_arq, tamanho_total, offset_bd in cursor_bd.fetchall():
+        if os.path.isfile(caminho_fisico_arq) and os.stat(caminho_fisico_arq).st_nlink > 1:
+            continue # Compartilhado com o armazém de blobs: não é um arquivo parcial
+        tamanho_no_disco = os.path.getsize(caminho_fisico_arq) if os.path.isfile(caminho_fisico_arq) else 0
+        if tamanho_no_disco > tamanho_total:
+            with open(caminho_fisico_arq, 'r+b') as arquivo_servidor:
+                arquivo_servidor.truncate(tamanho_total)
+            tamanho_no_disco = tamanho_total
+        if tamanho_no_disco != offset_bd:
+            logger_texto.info(f"Offset de '{caminho_fisico_arq}' reconciliado com o disco: {offset_bd} -> {tamanho_no_disco}.")
+            atualizar_status_transferencia_arquivo_bd(conexao_bd_local, id_log_arquivo, "PAUSED_DISCONNECT", total_bytes_atuais=tamanho_no_disco, detalhes_erro="Offset reconciliado com o arquivo parcial no disco.")
+            reconciliados += 1
+    if reconciliados:
+        registrar_evento_geral_bd(conexao_bd_local, "RECONCILE_OFFSETS", detalhes_evento=f"Arquivos: {reconciliados}")
+
+def interromper_por_sinal(numero_sinal, quadro):
+    raise KeyboardInterrupt
 
 def main():
-    global conexao_bd_global
+    global conexao_bd_global, gravador_bd_global
     conexao_bd_global = inicializar_banco_dados(ARQUIVO_BD_SERVIDOR)
+    reconciliar_offsets_com_disco(conexao_bd_global)
+    gravador_bd_global = GravadorBD(ARQUIVO_BD_SERVIDOR, ao_commit=lambda segundos: metricas.observar("file_server_db_commit_seconds", segundos))
+    # SIGTERM segue o mesmo caminho do Ctrl+C, para que o gravador descarregue a fila antes de sair
+    signal.signal(signal.SIGTERM, interromper_por_sinal)
     registrar_evento_geral_bd(conexao_bd_global, "SERVER_START", detalhes_evento=f"Servidor escutando em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}")
     if not os.path.exists(PASTA_UPLOADS): os.makedirs(PASTA_UPLOADS)
+    threading.Thread(target=vigiar_limites_banda, args=(ARQUIVO_LIMITES_BANDA,), name="LimitesBanda", daemon=True).start()
+    servidor_metricas = iniciar_servidor_metricas()
+
+    # Uma thread por conexão; o semáforo limita as sessões ativas e as excedentes esperam no backlog do listen
+    semaforo_sessoes = threading.BoundedSemaphore(MAXIMO_SESSOES_CONCORRENTES)
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as socket_servidor:
         socket_servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         socket_servidor.bind((ENDERECO_IP_SERVIDOR, PORTA_SERVIDOR))
         socket_servidor.listen()
-        logger_texto.info(f"Servidor iniciado e escutando em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR}")
+        logger_texto.info(f"Servidor iniciado e escutando em {ENDERECO_IP_SERVIDOR}:{PORTA_SERVIDOR} (máximo de {MAXIMO_SESSOES_CONCORRENTES} sessões simultâneas)")
 
         while True:
             try:
+                semaforo_sessoes.acquire()
                 socket_cliente, endereco_cliente_tupla = socket_servidor.accept()
             except KeyboardInterrupt:
                 logger_texto.info("Servidor interrompido pelo usuário (Ctrl+C).")
                 break
             except Exception as e_accept:
+                semaforo_sessoes.release()
                 logger_texto.error(f"Erro ao aceitar conexão: {e_accept}", exc_info=True)
                 continue
 
-            endereco_cliente_str = f"{endereco_cliente_tupla[0]}:{endereco_cliente_tupla[1]}"
-            caminho_base_upload_atual = "" 
-            id_log_arquivo_em_progresso_bd = None
-
-            with socket_cliente:
-                logger_texto.info(f"Conexão estabelecida com {endereco_cliente_str}")
-                registrar_evento_geral_bd(conexao_bd_global, "CLIENT_CONNECT", endereco_cliente=endereco_cliente_str)
-                
-                conexao_com_cliente_ativa = True
-                while conexao_com_cliente_ativa:
-                    try:
-                        bytes_cabecalho_recebidos = socket_cliente.recv(TAMANHO_BUFFER)
-                        if not bytes_cabecalho_recebidos:
-                            logger_texto.info(f"Cliente {endereco_cliente_str} encerrou a conexão (sem cabeçalho).")
-                            registrar_evento_geral_bd(conexao_bd_global, "CLIENT_DISCONNECT", endereco_cliente=endereco_cliente_str, detalhes_evento="Cabeçalho vazio.")
-                            conexao_com_cliente_ativa = False
-                            break
-                        
-                        cabecalho_str = bytes_cabecalho_recebidos.decode('utf-8')
-                        logger_texto.debug(f"Comando de {endereco_cliente_str}: {cabecalho_str[:200]}")
-
-                        # Strings de protocolo mantidas em INGLÊS
-                        if cabecalho_str.startswith("PREPARE_FILE_TRANSFER:"):
-                            partes_cabecalho = cabecalho_str.split(":", 4)
-                            caminho_relativo_arq = partes_cabecalho[1]
-                            tamanho_total_arq_cliente = int(partes_cabecalho[2])
-                            algo_checksum_arq = partes_cabecalho[3]
-                            checksum_esperado_arq = partes_cabecalho[4]
-
-                            id_log_arquivo_em_progresso_bd = registrar_ou_atualizar_metadados_arquivo_bd(conexao_bd_global, endereco_cliente_str, caminho_relativo_arq, tamanho_total_arq_cliente, algo_checksum_arq, checksum_esperado_arq, 'AWAITING_PREPARE')
-                            
-                            if not id_log_arquivo_em_progresso_bd:
-                                socket_cliente.sendall(b"ERROR_SERVER_DB_ISSUE") # Protocolo
-                                conexao_com_cliente_ativa = False; break
-
-                            estado_arquivo_bd = obter_estado_transferencia_arquivo_bd(conexao_bd_global, endereco_cliente_str, caminho_relativo_arq)
-
-                            # (id, total_size, expected_checksum, current_bytes, status)
-                            if estado_arquivo_bd and estado_arquivo_bd[4] == 'SUCCESS_CHECKSUM_OK' and estado_arquivo_bd[1] == tamanho_total_arq_cliente and estado_arquivo_bd[2] == checksum_esperado_arq:
-                                logger_texto.info(f"Arquivo '{caminho_relativo_arq}' já existe e checksum OK. Informando cliente.")
-                                socket_cliente.sendall(b"FILE_ALREADY_EXISTS_CHECKSUM_OK") # Protocolo
-                            elif estado_arquivo_bd and estado_arquivo_bd[1] == tamanho_total_arq_cliente and estado_arquivo_bd[2] == checksum_esperado_arq:
-                                offset_para_retomar = estado_arquivo_bd[3]
-                                logger_texto.info(f"Retomando '{caminho_relativo_arq}' do offset {offset_para_retomar}. Total {tamanho_total_arq_cliente}.")
-                                atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arquivo_em_progresso_bd, "AWAITING_DATA")
-                                socket_cliente.sendall(f"RESUME_FROM_OFFSET:{offset_para_retomar}".encode('utf-8')) # Protocolo
-                            else: 
-                                logger_texto.info(f"Iniciando nova transferência para '{caminho_relativo_arq}'. Offset 0. Total {tamanho_total_arq_cliente}.")
-                                if estado_arquivo_bd and (estado_arquivo_bd[1] != tamanho_total_arq_cliente or estado_arquivo_bd[2] != checksum_esperado_arq):
-                                     atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arquivo_em_progresso_bd, "AWAITING_PREPARE", total_bytes_atuais=0, detalhes_erro="Metadados do arquivo mudaram, reiniciando.")
-                                
-                                atualizar_status_transferencia_arquivo_bd(conexao_bd_global, id_log_arquivo_em_progresso_bd, "AWAITING_DATA")
-                                socket_cliente.sendall(b"SEND_FROM_OFFSET:0")
-
-                        elif cabecalho_str.startswith("START_FILE_DATA:"):
-                            if not id_log_arquivo_em_progresso_bd:
-                                logger_texto.error("Recebido START_FILE_DATA sem um PREPARE_FILE_TRANSFER anterior.")
-                                socket_cliente.sendall(b"ERROR_NO_PREPARE_CALL")
-                                continue
-
-                            cursor_bd = conexao_bd_global.cursor()
-                            cursor_bd.execute("SELECT relative_file_path, total_file_size_bytes, current_bytes_transferred, checksum_algorithm, expected_checksum_hex FROM file_transfer_log WHERE id = ?", (id_log_arquivo_em_progresso_bd,))
-                            info_arquivo_bd = cursor_bd.fetchone()
-
-                            if not info_arquivo_bd:
-                                logger_texto.error(f"Não foi possível encontrar info no BD para file_log_id {id_log_arquivo_em_progresso_bd}")
-                                socket_cliente.sendall(b"ERROR_SERVER_DB_LOOKUP_FAIL")
-                                continue
-                            
-                            cam_rel_bd, tam_total_bd, offset_bd, cs_algo_bd, cs_hex_bd = info_arquivo_bd
-                            caminho_fisico_completo_arq = os.path.join(caminho_base_upload_atual, cam_rel_bd)
-                            
-                            diretorio_do_arquivo = os.path.dirname(caminho_fisico_completo_arq)
-                            if not os.path.exists(diretorio_do_arquivo): os.makedirs(diretorio_do_arquivo, exist_ok=True)
-
-                            socket_cliente.sendall(b"ACK_START_FILE_DATA")
-                            
-                            status_final_do_recebimento = receber_dados_arquivo(socket_cliente, caminho_fisico_completo_arq, tam_total_bd, endereco_cliente_str, 
-                                                                    id_log_arquivo_em_progresso_bd, offset_bd, cs_algo_bd, cs_hex_bd)
-                            socket_cliente.sendall(status_final_do_recebimento.encode('utf-8'))
-                            id_log_arquivo_em_progresso_bd = None 
-
-                        elif cabecalho_str.startswith("START_FOLDER_TRANSFER:"):
-                            nome_da_pasta = cabecalho_str.split(":", 1)[1]
-                            caminho_base_upload_atual = os.path.join(PASTA_UPLOADS, os.path.basename(nome_da_pasta))
-                            if not os.path.exists(caminho_base_upload_atual): os.makedirs(caminho_base_upload_atual)
-                            registrar_evento_geral_bd(conexao_bd_global, "START_FOLDER_TRANSFER", endereco_cliente_str, f"Pasta: {nome_da_pasta}, Destino: {caminho_base_upload_atual}")
-                            socket_cliente.sendall(b"ACK_START_FOLDER")
-                        
-                        elif cabecalho_str.startswith("NEW_FOLDER:"):
-                            caminho_rel_pasta = cabecalho_str.split(":",1)[1]
-                            caminho_completo_pasta = os.path.join(caminho_base_upload_atual, caminho_rel_pasta)
-                            os.makedirs(caminho_completo_pasta, exist_ok=True)
-                            registrar_evento_geral_bd(conexao_bd_global, "NEW_FOLDER_CREATED", endereco_cliente_str, f"Pasta: {caminho_completo_pasta}")
-                            socket_cliente.sendall(b"ACK_NEW_FOLDER") 
-
-                        elif cabecalho_str == "END_FOLDER_TRANSFER":
-                            registrar_evento_geral_bd(conexao_bd_global, "END_FOLDER_TRANSFER", endereco_cliente_str, f"Pasta: {os.path.basename(caminho_base_upload_atual if caminho_base_upload_atual else 'N/A')}")
-                            socket_cliente.sendall(b"ACK_END_FOLDER")
-                            caminho_base_upload_atual = "" 
-                        
-                        else:
-                            logger_texto.warning(f"Comando desconhecido de {endereco_cliente_str}: {cabecalho_str}")
-                            registrar_evento_geral_bd(conexao_bd_global, "UNKNOWN_COMMAND", endereco_cliente_str, cabecalho_str)
-
-                    except ConnectionResetError:
-                        logger_texto.error(f"Conexão resetada por {endereco_cliente_str}.", exc_info=False)
-                        registrar_evento_geral_bd(conexao_bd_global, "ERROR_CONNECTION_RESET", endereco_cliente=endereco_cliente_str)
-                        conexao_com_cliente_ativa = False
-                    except UnicodeDecodeError:
-                        logger_texto.error(f"Erro ao decodificar cabeçalho de {endereco_cliente_str}.", exc_info=True)
-                        registrar_evento_geral_bd(conexao_bd_global, "ERROR_UNICODE_DECODE", endereco_cliente=endereco_cliente_str)
-                        conexao_com_cliente_ativa = False
-                    except socket.timeout:
-                        logger_texto.warning(f"Socket timeout para {endereco_cliente_str}.")
-                        registrar_evento_geral_bd(conexao_bd_global, "ERROR_SOCKET_TIMEOUT", endereco_cliente=endereco_cliente_str)
-                        conexao_com_cliente_ativa = False
-                    except Exception as e_loop_cliente:
-                        logger_texto.error(f"Erro no loop de tratamento do cliente {endereco_cliente_str}: {e_loop_cliente}", exc_info=True)
-                        registrar_evento_geral_bd(conexao_bd_global, "ERROR_UNEXPECTED_CLIENT_LOOP", endereco_cliente=endereco_cliente_str, detalhes_evento=str(e_loop_cliente))
-                        conexao_com_cliente_ativa = False
-                
-                logger_texto.info(f"Sessão com cliente {endereco_cliente_str} encerrada.")
+            thread_sessao = threading.Thread(target=atender_cliente, args=(socket_cliente, endereco_cliente_tupla, semaforo_sessoes),
+                                             name=f"Sessao-{endereco_cliente_tupla[0]}:{endereco_cliente_tupla[1]}", daemon=True)
+            thread_sessao.start()
     
     registrar_evento_geral_bd(conexao_bd_global, "SERVER_STOP")
+    if servidor_metricas is not None:
+        servidor_metricas.shutdown()
+    gravador_bd_global.encerrar()
     logger_texto.info("Servidor encerrado.")
     if conexao_bd_global:
         conexao_bd_global.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()